@@ -0,0 +1,100 @@
+''' Benchmark of the time and memory taken by `import OceanOptics`. Each
+    import is timed in a new interpreter, as a cron job starting a short
+    acquisition would see it, and the modules it loaded are checked so that
+    none of the heavy optional dependencies (scipy, matplotlib) creep back
+    into the import of the driver:
+
+        python Benchmarks/import_benchmark.py
+        python Benchmarks/import_benchmark.py --module OceanOptics.sts_utils
+
+    The exit status is 1 if a heavy module was imported, or if the median
+    import time is over --max-ms.
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HEAVY_MODULES = ('scipy', 'matplotlib')
+
+# Run in the new interpreter, numpy is imported first as every use of the
+#    driver needs it and its own import time is not the driver's.
+_CHILD = '''
+import json, resource, sys, time
+import numpy
+before = set(sys.modules)
+start = time.time()
+import %s
+elapsed = time.time() - start
+loaded = sorted(set(sys.modules) - before)
+print(json.dumps({'seconds': elapsed, 'loaded': loaded,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+'''
+
+
+def time_import(module):
+    ''' Imports module in a new interpreter and returns the time it took,
+        the modules it loaded and the peak memory of the interpreter.
+    '''
+    out = subprocess.check_output([sys.executable, '-c', _CHILD % module],
+                                  cwd=ROOT)
+    return json.loads(out.decode('ascii').strip().split('\n')[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--module', default='OceanOptics',
+                        help='module whose import is timed')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='number of interpreters started')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='fail if the median import takes longer')
+    args = parser.parse_args()
+
+    runs = [time_import(args.module) for ab in range(args.repeat)]
+    seconds = np.array([run['seconds'] for run in runs])
+    rss = np.array([run['max_rss_kb'] for run in runs])
+    loaded = runs[-1]['loaded']
+    heavy = sorted(set(name.split('.')[0] for name in loaded
+                       if name.split('.')[0] in HEAVY_MODULES))
+
+    print('import %s' % args.module)
+    print('  median %.1f ms, min %.1f ms, max %.1f ms over %d runs' %
+          (1e3*np.median(seconds), 1e3*seconds.min(), 1e3*seconds.max(),
+           args.repeat))
+    print('  peak RSS %.1f MB, %d modules loaded' %
+          (np.median(rss)/1024.0, len(loaded)))
+
+    failed = False
+    if heavy:
+        print('  heavy modules imported: %s' % ', '.join(heavy))
+        failed = True
+    if args.max_ms is not None and 1e3*np.median(seconds) > args.max_ms:
+        print('  slower than %.1f ms' % args.max_ms)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
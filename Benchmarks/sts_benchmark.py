@@ -0,0 +1,253 @@
+''' Benchmark suite for the command path of the STS driver. It runs the driver
+    against the simulated device in OceanOptics.sts_simulator and measures
+    commands per second, spectra per second, latency percentiles and the CPU
+    time used per call for the driver and the sts_utils processing functions.
+
+    Each run is appended to a history file (one JSON record per line) and
+    compared with the previous run made on the same machine, so the effect
+    of a change to the driver can be seen straight away:
+
+        python Benchmarks/sts_benchmark.py
+        python Benchmarks/sts_benchmark.py --realistic --repeat 50
+
+    By default the simulator answers instantly so that only the host side
+    overhead (packet building, sleeps, decoding) is measured. With
+    --realistic the simulator models USB transfer and detector readout times.
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from OceanOptics import STSVIS
+from OceanOptics.STS import _Message
+from OceanOptics import sts_utils
+from OceanOptics.sts_calibration import read_calibration
+from OceanOptics.sts_processing import SpectrumProcessor
+from OceanOptics.sts_simulator import STSSimulator
+
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'results.jsonl')
+
+
+def cpu_time():
+    ''' User plus system CPU time of this process in seconds.
+    '''
+    times = os.times()
+    return times[0] + times[1]
+
+
+def measure(function, repeat):
+    ''' Calls function repeat times and returns a dictionary of the rate,
+        latency percentiles (in milliseconds) and CPU time per call.
+    '''
+    function()  # Warm up any caches before timing
+    latencies = np.zeros(repeat)
+    cpu_start = cpu_time()
+    wall_start = time.time()
+    for ab in range(repeat):
+        start = time.time()
+        function()
+        latencies[ab] = time.time() - start
+    wall = time.time() - wall_start
+    cpu = cpu_time() - cpu_start
+    return {
+        'calls': repeat,
+        'per_second': repeat/wall,
+        'p50_ms': 1e3*np.percentile(latencies, 50),
+        'p90_ms': 1e3*np.percentile(latencies, 90),
+        'p99_ms': 1e3*np.percentile(latencies, 99),
+        'max_ms': 1e3*latencies.max(),
+        'cpu_ms': 1e3*cpu/repeat,
+    }
+
+
+def driver_benchmarks(spec, repeat):
+    ''' The benchmarks of the STSVIS command path.
+    '''
+    message = _Message(0x00400002, b'', None, (0, 0, 0, 0))
+    # Three bands of 128 pixels in all, to compare with the full readout
+    spec.set_partial_spectrum_mode([(100, 32), (480, 64), (900, 32)], 1)
+
+    def query_with_stats():
+        spec.enable_stats()
+        try:
+            spec._query_device(0x00400002, 1)
+        finally:
+            spec.disable_stats()
+
+    return [
+        ('build_packet', lambda: spec._build_packet(message, 0), repeat*100),
+        ('query_device', lambda: spec._query_device(0x00400002, 1), repeat),
+        ('query_device_stats', query_with_stats, repeat),
+        ('send_command', lambda: spec._send_command_to_device(
+            0x00121010, 1, immediate=b'\x00'), repeat),
+        ('set_boxcar_unchanged', lambda: spec.set_boxcar(0, 1), repeat*100),
+        ('read_all_temperature', lambda: spec.read_all_temperature(1),
+         repeat),
+        ('get_corrected_spectrum', lambda: spec.get_corrected_spectrum(1),
+         repeat),
+        ('get_raw_spectrum', lambda: spec.get_raw_spectrum(1), repeat),
+        ('get_partial_corrected', lambda: spec.get_partial_corrected(1),
+         repeat),
+        ('get_wav_coeffs', lambda: spec.get_wav_coeffs(1), repeat),
+        ('get_nonlin_coeffs', lambda: spec.get_nonlin_coeffs(1), repeat),
+    ]
+
+
+def processing_benchmarks(spec, repeat):
+    ''' The benchmarks of the sts_utils processing functions, run on a real
+        (simulated) spectrum and calibration.
+    '''
+    bins = sts_utils.calculate_wavlengths(spec)
+    coeff = sts_utils.get_non_linear_correction(spec)
+    calibration = spec.get_irrad_calib()
+    raw = spec.get_corrected_spectrum(1)
+    dark = np.full(len(raw), 1500.0)
+    bin_factor = sts_utils.find_bin_factor(bins)
+    processor = SpectrumProcessor(read_calibration(spec), 0.1, dark)
+    out = np.empty(len(raw))
+    stack = np.tile(raw, (100, 1))
+    stack_out = np.empty(stack.shape)
+    return [
+        ('find_bin_factor', lambda: sts_utils.find_bin_factor(bins),
+         repeat*100),
+        ('get_multiplication', lambda: sts_utils.get_multiplication(
+            None, bin_factor, calibration, 0.1), repeat*100),
+        ('do_non_lin', lambda: sts_utils.do_non_lin(raw, coeff, dark, 0.1),
+         repeat*100),
+        ('calculate_wavlengths', lambda: sts_utils.calculate_wavlengths(spec),
+         max(repeat//4, 1)),
+        ('processor', lambda: processor.process(raw, out), repeat*100),
+        ('processor_stack_100', lambda: processor.process(stack, stack_out),
+         repeat),
+    ]
+
+
+def git_revision():
+    ''' The commit the benchmark is run on, so results can be matched up
+        with changes.
+    '''
+    try:
+        with open(os.devnull, 'w') as devnull:
+            out = subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(history, machine, realistic):
+    ''' Finds the last run in the history file from the same machine and
+        with the same simulator timing.
+    '''
+    if not os.path.exists(history):
+        return None
+    last = None
+    with open(history) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record['machine'] == machine and \
+                    record['realistic'] == realistic:
+                last = record
+    return last
+
+
+def report(results, previous):
+    ''' Prints the results as a table, with the change in rate compared to
+        the previous run where there is one.
+    '''
+    print('%-24s %10s %9s %9s %9s %9s %8s' % ('benchmark', 'per sec',
+          'p50 ms', 'p90 ms', 'p99 ms', 'cpu ms', 'change'))
+    for name in sorted(results):
+        res = results[name]
+        change = ''
+        if previous is not None and name in previous['results']:
+            old = previous['results'][name]['per_second']
+            change = '%+7.1f%%' % (100.0*(res['per_second'] - old)/old)
+        print('%-24s %10.1f %9.3f %9.3f %9.3f %9.3f %8s' % (name,
+              res['per_second'], res['p50_ms'], res['p90_ms'], res['p99_ms'],
+              res['cpu_ms'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of calls timed for each USB benchmark')
+    parser.add_argument('--realistic', action='store_true',
+                        help='simulate USB and detector timing')
+    parser.add_argument('--integration-us', type=int, default=10,
+                        help='integration time used for the spectra')
+    parser.add_argument('--only', default=None,
+                        help='comma separated list of benchmarks to run')
+    parser.add_argument('--history', default=HISTORY,
+                        help='file the results are appended to')
+    parser.add_argument('--no-save', action='store_true',
+                        help='do not append the results to the history')
+    args = parser.parse_args()
+
+    if args.realistic:
+        sim = STSSimulator()
+    else:
+        sim = STSSimulator(command_latency=0, packet_time=0, readout_time=0)
+    spec = STSVIS(find=sim.find)
+    spec.set_integration_time(args.integration_us, 1)
+
+    benchmarks = driver_benchmarks(spec, args.repeat) + \
+        processing_benchmarks(spec, args.repeat)
+    if args.only is not None:
+        wanted = args.only.split(',')
+        benchmarks = [bench for bench in benchmarks if bench[0] in wanted]
+
+    results = {}
+    for name, function, repeat in benchmarks:
+        results[name] = measure(function, repeat)
+
+    machine = platform.node()
+    record = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': git_revision(),
+        'machine': machine,
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'realistic': args.realistic,
+        'integration_us': args.integration_us,
+        'results': results,
+    }
+    report(results, previous_result(args.history, machine, args.realistic))
+    if not args.no_save:
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
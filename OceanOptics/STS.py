@@ -29,10 +29,116 @@
 
 import usb.core
 import usb
+import array
+import collections
+import errno
+import functools
 import struct
+import threading
 import numpy as np
 import time
 
+from .sts_stream import SpectrumStream
+from .sts_stats import Transaction, TransactionStats, _Tally
+from . import sts_trace
+
+# Time allowed for the device to reply to a message, in milliseconds. Most
+#    messages are answered within a USB round trip, writes to the flash take
+#    longer and spectra take as long as the acquisition itself. In a
+#    triggered mode a spectrum is also allowed time for the trigger to come.
+_RESPONSE_TIMEOUT_MS = 500
+_FLASH_TIMEOUT_MS = 2000
+_TRIGGER_WAIT_MS = 5000
+_MAX_INTEGRATION_US = 10000000
+#Time allowed for each read when draining a line after a failed transaction
+_DRAIN_TIMEOUT_MS = 10
+#Packets read looking for the start of a reply before giving up
+_MAX_SKIPPED_PACKETS = 64
+
+#Layout of the packets, the first 12 bytes of the header depend only on the
+#    message type and flags.
+_COMMAND_HEADER = struct.Struct('<8BI')
+_PACKET_HEADER = struct.Struct('<12s4B6xBB16sI')
+#Every packet starts with the header bytes and every message ends with the
+#    footer bytes, so a lost or stale packet can be found.
+_HEADER_BYTES = (0xC1, 0xC0)
+_FOOTER_BYTES = (0xC5, 0xC4, 0xC3, 0xC2)
+_NACK_FLAG = 8
+
+#The meaning of each error number the device sends back with a NACK
+_ERROR_MESSAGES = {
+    0: "No detectable errors",
+    1: "Invalid/unsupported protocol",
+    2: "Unknown message type",
+    3: "Bad checksum",
+    4: "Message too large",
+    5: "Payload length does not match message type",
+    6: "Payload data invalid",
+    7: "Device not ready for given message type",
+    8: "Unknown checksum type",
+    9: "Device reset unexpectedly",
+    10: "Too many buses (Commands have come from too many bus interfaces)",
+    11: "Out of memory. Failed to allocate enough space to complete "
+        "request.",
+    12: "Command is valid, but desired information does not exist.",
+    13: "Int Device Error. May be unrecoverable.",
+    100: "Could not decrypt properly",
+    101: "Firmware layout invalid",
+    102: "Data packet was wrong size (not 64 bytes)",
+    103: "Hardware revision not compatible with firmware ",
+    104: "Existing flash map not compatible with firmware",
+    255: "Operation/Response Deferred. Operation will take some time to "
+        "complete. Do not ACK or NACK yet.",
+}
+
+_PIXELS = 1024 #Pixels on the detector, before binning
+_SPECTRUM_COMMANDS = (0x00101000, 0x00101100, 0x00100928)
+# Partial spectrum specification: a 2-byte mode, then for mode 1 the first
+#    pixel and number of pixels of each of up to 3 ranges.
+_PARTIAL_RANGES_MODE = 1
+_MAX_PARTIAL_RANGES = 3
+_FLASH_COMMANDS = (0x00000001, 0x00000210, 0x00000310, 0x00110295, \
+    0x00180111, 0x00181111, 0x00182010, 0x00182011, 0x00183111, 0x00186010)
+#Commands which must not be sent twice: reset and the trigger pulse
+_NO_RETRY_COMMANDS = (0x00000000, 0x00110120)
+
+#A message for the device. Each command builds its own and never changes it,
+#    so commands on the two lines can be sent from different threads.
+#    immediate holds up to 16 bytes sent in the header, payload any longer
+#    data sent after the header (or None).
+_Message = collections.namedtuple('_Message', ['command', 'immediate', \
+    'payload', 'regarding'])
+_NO_REGARDING = (0, 0, 0, 0)
+
+def _observed(method):
+    ''' Wraps a method taking the message type and line which makes one
+        transaction, so that it is passed to the transaction hooks as a
+        Transaction. With no hooks the method is called straight away.
+    '''
+    @functools.wraps(method)
+    def observed(self, command, line, *args, **kwargs):
+        if not self._hooks:
+            return method(self, command, line, *args, **kwargs)
+        with self._line_lock(line):
+            previous = self._tallies[line]
+            tally = self._tallies[line] = _Tally()
+            started = time.time()
+            failure = None
+            try:
+                return method(self, command, line, *args, **kwargs)
+            except Exception as error:
+                failure = error
+                raise
+            finally:
+                self._tallies[line] = previous
+                transaction = Transaction(command, line, started, \
+                    tally.written, time.time(), tally.bytes_out, \
+                    tally.bytes_in, tally.packets, tally.retries, \
+                    tally.nacks, tally.error_code, failure)
+                for hook in self._hooks:
+                    hook(transaction)
+    return observed
+
 class STSVIS(object):
     """ class STSVIS:
         This classfile for STS-VIS spectrometer communication was written using
@@ -42,13 +148,24 @@ class STSVIS(object):
         spec sheet.
     """
 
-    def __init__(self, index=0):
+    #Time in seconds the device takes to come back after reset_device
+    reset_time = 1.5
+    #A transaction which times out or gets a garbled reply is sent again up
+    #    to retries times, after retry_backoff_s seconds and then twice as
+    #    long each time.
+    retries = 2
+    retry_backoff_s = 0.005
+
+    def __init__(self, index=0, find=None, fixed_delays=False):
         ''' Initialization of the device, this finds the device and prints the
             address. Also sets up the default values for the packet for sending
             data to the device. May edit to make more robust later.
+            The find argument replaces usb.core.find for locating devices,
+            this is how the simulator in sts_simulator is plugged in.
+            Replies are waited for with a deadline sized to the message type,
+            setting fixed_delays restores the fixed sleeps after every write.
         '''
-        device_list = usb.core.find(find_all=True, idVendor=0x2457, \
-            idProduct=0x4000)
+        device_list = find_devices(find)
         self.list = len(device_list)
         if device_list is None:
             raise STS_Error('No OceanOptics STS-VIS spectrometer found!')
@@ -72,26 +189,57 @@ class STSVIS(object):
         self._EP1_in_size = 64
         self._EP2_in_size = 64
 
-        #Initialize the different fields for packet size. This is important
-        #    as the packet is stitched together from these data fields. Each
-        #    command that requires an adjustment to these default values will
-        #    set that itself, and then re set to the default itself also.
+        #Initialize the fields of the packet which are the same for every
+        #    message. The fields which change (message type, regarding,
+        #    immediate data and payload) are given by each command in a
+        #    _Message, so no command changes state another one relies on.
 
         self.headerTop = np.array([193, 192])
         self.protocolVersion = np.array([17, 0])
         self.flags = np.array([0, 0])
         self.errorNumber = np.array([0, 0])
-        self.messageType = None
-        self.regarding = np.array([0, 0, 0, 0])
         self.reserved = np.array([0, 0, 0, 0, 0, 0])
         self.checksumType = 0
-        self.immediateDataLength = 0
-        self.immediateData = np.zeros(16)
-        self.bytesRemaining = np.array([20, 0, 0, 0])
-        self.payload = None
         self.checksum = np.zeros(16)
         self.footer = np.array([197, 196, 195, 194])
 
+        #Each line is used by one transaction (write then read) at a time,
+        #    the two lines can be used at the same time.
+        self._line_locks = {1: threading.RLock(), 2: threading.RLock()}
+
+        #Settings known to be on the device, used to size the time allowed
+        #    for a reply and to skip sending a setting the device already has.
+        #    Filled in as the settings are acknowledged or read back.
+        self.fixed_delays = fixed_delays
+        self._settings = {}
+
+        #Buffers the multi-packet replies are read into, kept between reads
+        #    and keyed by line and size so a spectrum reuses the same memory.
+        self._receive_buffers = {}
+        #Likewise for building packets (keyed the same way), with the headers
+        #    of the message types that have been sent and the constant end of
+        #    the packet.
+        self._packet_buffers = {}
+        self._header_cache = {}
+        self._footer_bytes = bytearray(self.checksum.astype(np.uint8)) + \
+            bytearray(self.footer.astype(np.uint8))
+
+        #The continuous acquisition started by start_stream
+        self._stream = None
+
+        #Functions called with each Transaction, and what is counted during
+        #    the transaction in progress on each line (None when there are no
+        #    hooks, so the reads and writes only check for None).
+        self._hooks = []
+        self._tallies = {1: None, 2: None}
+        self.stats = None
+
+        #Time in milliseconds allowed for the reply to a message type,
+        #    replacing the one derived from the settings, and (if not None)
+        #    the wait for a spectrum in a triggered mode.
+        self.timeouts = {}
+        self.trigger_timeout_ms = None
+
         #Flags: RESPONSE_FLAG -> 1, ACK_FLAG -> 2, ACK_REQUESTED_FLAG -> 4,
         #    NACK_FLAG -> 8, EXCEPTION_FLAG -> 16.
         serial = self.get_serial()
@@ -105,17 +253,20 @@ class STSVIS(object):
     #      These are the general control functions      #
     # ################################################# #
 
-    def reset_device(self, line=1):
+    def reset_device(self, line=1, wait=True):
         ''' Sends the reset signal to the device. Needs to except core.USBError
             and device may not work afterwards, it seems to be unavailable, may
             be only useful for when multiple devices are connected to the same
-            board/computer.
+            board/computer. If wait is False, waiting reset_time for the
+            device to come back is left to the caller.
         '''
         try:
             self._send_command_to_device(0x00000000, line)
         except usb.core.USBError:
             pass
-        time.sleep(1.5)
+        self.invalidate_settings()
+        if wait:
+            time.sleep(self.reset_time)
 
     def reset_defaults(self, line=1):
         ''' Clears certain persisted values including default baud rate and
@@ -123,6 +274,14 @@ class STSVIS(object):
             calibration, or user strings.
         '''
         self._send_command_to_device(0x00000001, line)
+        self.invalidate_settings()
+
+    def invalidate_settings(self):
+        ''' Forgets the settings known to be on the device, so the next set
+            of each is sent even if it has the same value. Done by the resets,
+            call it if something else may have changed the settings.
+        '''
+        self._settings.clear()
 
     def get_hardware_revision(self, line=1):
         ''' This value is sensed from the hardware itself. Request has no
@@ -139,7 +298,7 @@ class STSVIS(object):
             Returns the integer value.
         '''
         data = self._query_device(0x00000090, line)
-        return data[0] + data[1]*256
+        return struct.unpack('<H', data[0:2].tobytes())[0]
 
     def get_serial(self, line=1):
         ''' Returns the serial number of the device, returned as a string,
@@ -148,7 +307,7 @@ class STSVIS(object):
         string = self._query_device(0x00000100, line)
         result = ''
         for ab in range(len(string)):
-            result += str(unichr(int(string[ab])))
+            result += str(chr(int(string[ab])))
         return result
 
     def get_serial_length(self, line=1):
@@ -172,20 +331,17 @@ class STSVIS(object):
         string = self._query_device(0x00000200, line)
         result = ''
         for ab in range(len(string)):
-            result += str(unichr(int(string[ab])))
+            result += str(chr(int(string[ab])))
         return result
 
     def set_alias(self, stringname, line=1):
         ''' Sets the user allocated alias of the device, given as a string.
         '''
         if len(stringname) <= 16:
-            for ab in range(len(stringname)):
-                self.immediateData[ab] = ord(stringname[ab])
-            self.immediateDataLength = len(stringname)
-            self._send_command_to_device(0x00000210, line)
-            self.immediateDataLength = 0
+            self._send_command_to_device(0x00000210, line, \
+                immediate=_ascii(stringname))
         else:
-            print "Alias Length cannot be longer than 16 characters"
+            print("Alias Length cannot be longer than 16 characters")
 
     def get_user_string_count(self, line=1):
         ''' This function returns the integer number of user defined strings
@@ -198,53 +354,38 @@ class STSVIS(object):
             strings
         '''
         string = self._query_device(0x00000301, line)
-        length = string[0] + 256*string[1]
+        length = struct.unpack('<H', string[0:2].tobytes())[0]
         return int(length)
 
     def get_user_string(self, ind, line=1):
         ''' This function returns the user defined string of index ind
         '''
-        self.immediateDataLength = 1
-        self.immediateData[0] = ind
-        string = self._query_device(0x00000302, line)
-        self.immediateDataLength = 0
+        string = self._query_device(0x00000302, line, struct.pack('<B', ind))
         result = ''
-        if string == None:
-            print "There is no User String with this Index"
+        if string is None:
+            print("There is no User String with this Index")
         else:
             for ab in range(len(string)):
-                dat = str(unichr(int(string[ab])))
-                if dat != struct.pack('<B', 0):
-                    result += str(unichr(int(string[ab])))
+                dat = str(chr(int(string[ab])))
+                if dat != '\x00':
+                    result += str(chr(int(string[ab])))
         return result
 
     def set_user_string(self, stringname, string_ind, line=1):
         ''' Sets the user string with index string_ind, given as a string.
         '''
-        self.regarding = np.array([0, 1, 0, 2])
+        regarding = (0, 1, 0, 2)
         if len(stringname) <= 348:
+            data = struct.pack('<B', string_ind) + _ascii(stringname)
             if len(stringname) <= 15:
-                self.immediateData[0] = string_ind
-                for ab in range(len(stringname)):
-                    self.immediateData[ab+1] = ord(stringname[ab])
-                self.immediateDataLength = len(stringname) + 1
-                self._send_command_to_device(0x00000310, line)
-                self.immediateDataLength = 0
+                self._send_command_to_device(0x00000310, line, \
+                    immediate=data, regarding=regarding)
             else:
-                data = np.zeros(len(stringname) + 1)
-                data[0] = string_ind
-                for ab in range(len(stringname)):
-                    data[ab+1] = ord(stringname[ab])
-                bb = ((len(data)/64) + 1)*64
-
-                self._update_bytes_remaining(bb)
-                self._send_command_to_device(0x00000310, line, True, data)
+                self._send_command_to_device(0x00000310, line, True, data, \
+                    regarding=regarding)
         else:
-            print "Alias Length cannot be longer than %d \
-                characters" & self.get_user_string_length()
-
-        self.regarding = np.array([0, 0, 0, 0])
-        self._update_bytes_remaining(0)
+            print("Alias Length cannot be longer than %d characters" % \
+                self.get_user_string_length())
 
     #Not Implemented methods
     #    get_RS232_baud()
@@ -266,14 +407,11 @@ class STSVIS(object):
                 revert to its normal operation.
         '''
         if (command == 1) or (command == 2):
-            self.immediateData[0] = 0
-            self.immediateData[0] = command
-            self.immediateDataLength = 2
-            self._send_command_to_device(0x00001010, line)
-            self.immediateDataLength = 0
+            self._send_command_to_device(0x00001010, line, \
+                immediate=struct.pack('<2B', 0, command))
         else:
-            print "Please enter either 1 or 2 for status led commands"
-            print "Refer to the software documentation for more information"
+            print("Please enter either 1 or 2 for status led commands")
+            print("Refer to the software documentation for more information")
 
     def reprogramming_mode(self, line=1):
         ''' Causes the device to accept a .OBP file provided by Ocean Optics.
@@ -284,27 +422,25 @@ class STSVIS(object):
     #        These are the spectrometer commands        #
     # ################################################# #
 
-    def get_corrected_spectrum(self, line=1):
+    def get_corrected_spectrum(self, line=1, out=None):
         ''' Request corrected spectra from device and read the response, by
             corrected it returns the intensity of every pixel on the detector.
             If the response is in the correct format, return is as a spectrum
-            of intensity values.
+            of intensity values. If an array is given as out the spectrum is
+            written into it, otherwise a new float array is returned.
         '''
-        data = self._query_device(0x00101000, line)
-        spectrum = np.zeros(len(data)/2)
-        for ab in range(len(spectrum)):
-            spectrum[ab] = data[ab*2] + 256*(data[ab*2 + 1])
-        return spectrum
+        with self._line_lock(line): #The reply buffer is reused by the line
+            data = self._query_device(0x00101000, line)
+            return self._decode_spectrum(data, out)
 
-    def get_raw_spectrum(self, line=1):
+    def get_raw_spectrum(self, line=1, out=None):
         ''' Request spectra from device and read the response, this returns the
-            raw data, that is the actual ADC output of the pixels.
+            raw data, that is the actual ADC output of the pixels. If an array
+            is given as out the spectrum is written into it.
         '''
-        data = self._query_device(0x00101100, line)
-        spectrum = np.zeros(len(data)/2)
-        for ab in range(len(spectrum)):
-            spectrum[ab] = data[ab*2] + 256*(data[ab*2 + 1])
-        return spectrum
+        with self._line_lock(line):
+            data = self._query_device(0x00101100, line)
+            return self._decode_spectrum(data, out)
 
     def get_partial_spectrum_mode(self, line=1):
         ''' Returns a specification for partial spectrum retrieval (see the
@@ -312,25 +448,99 @@ class STSVIS(object):
             set since the device was started, this will return a NACK
             indicating "no value available".
         '''
-        raise NotImplementedError
-
-    #Not Implemented methods
-    #     set_partial_spectrum_mode()
-    #     get_partial_corrected()
+        try:
+            data = self._query_device(0x00102080, line)
+        except STS_DeviceError:
+            print('There is no partial spectrum mode set.')
+        else:
+            data = data.tobytes()
+            count = (len(data) - 2)//4
+            values = struct.unpack('<%dH' % (2*count), data[2:2 + 4*count])
+            return [(values[2*n], values[2*n + 1]) for n in range(count)]
+
+    def set_partial_spectrum_mode(self, ranges, line=1):
+        ''' Sets which pixels get_partial_corrected() returns, ranges is a
+            list of up to 3 (first pixel, number of pixels) pairs. The pixels
+            of each range are returned one after the other. Pixels are those
+            of the binning factor in use.
+        '''
+        ranges = [(int(start), int(count)) for start, count in ranges]
+        if not 0 < len(ranges) <= _MAX_PARTIAL_RANGES:
+            raise STS_Error('Between 1 and %d partial spectrum ranges can ' \
+                'be set' % _MAX_PARTIAL_RANGES)
+        pixels = self.get_pixel_count(line)
+        for start, count in ranges:
+            if start < 0 or count < 1 or start + count > pixels:
+                raise STS_Error('Partial spectrum range (%d, %d) is not on ' \
+                    'the detector' % (start, count))
+        values = [value for pair in ranges for value in pair]
+        self._send_command_to_device(0x00102090, line, \
+            immediate=struct.pack('<%dH' % (1 + len(values)), \
+            _PARTIAL_RANGES_MODE, *values))
+        self._settings['partial_ranges'] = ranges
+
+    def set_partial_wavelength_ranges(self, wavelength_ranges, \
+        wavelengths=None, line=1):
+        ''' Sets the partial spectrum mode to read the pixels whose centre is
+            within each (low, high) wavelength range in nm, using the
+            wavelength of each pixel at the binning factor in use (from the
+            wavelength coefficients if wavelengths is not given). Returns the
+            wavelengths of the pixels get_partial_corrected() will return.
+        '''
+        if wavelengths is None:
+            coeffs = self.get_wav_coeffs(line)
+            wavelengths = bin_pixels(np.polyval(coeffs[::-1], \
+                np.arange(_PIXELS)), self.get_active_binning_factor(line))
+        ranges = pixel_ranges(wavelengths, wavelength_ranges)
+        self.set_partial_spectrum_mode(ranges, line)
+        return np.concatenate([wavelengths[start:start + count] \
+            for start, count in ranges])
+
+    def get_partial_corrected(self, line=1, out=None):
+        ''' Request the corrected spectrum of only the pixels set by
+            set_partial_spectrum_mode(). Less data is transferred and decoded
+            than for the full spectrum. If an array is given as out the
+            spectrum is written into it.
+        '''
+        with self._line_lock(line):
+            data = self._query_device(0x00100928, line)
+            return self._decode_spectrum(data, out)
+
+    def get_triggered_spectra(self, out, timestamps, depth=2, timeout_ms=None,
+                              raw=False, line=1):
+        ''' For a triggered mode: collects a spectrum into each row of out,
+            keeping depth requests armed on the device so that a trigger
+            arriving while a spectrum is read is not missed, and stores the
+            time.time() each was received in timestamps. Waits up to
+            timeout_ms for each spectrum (as for any spectrum if None). Returns
+            the number of spectra received, fewer than the rows of out if one
+            timed out. Requests still armed are completed by simulated trigger
+            pulses on the other line and their spectra discarded, so the burst
+            holds both lines until it ends.
+        '''
+        command = 0x00101100 if raw else 0x00101000
+        if timeout_ms is None:
+            timeout_ms = self._response_timeout(command, line)
+        #Line 1 is always locked first, so two bursts can't deadlock
+        with self._line_lock(1), self._line_lock(2):
+            return self._query_device_armed(command, line, out, timestamps, \
+                depth, timeout_ms)
 
     def set_integration_time(self, time_us, line=1):
         ''' Sets the integration time on the device to be time_us in micro
             seconds.
         '''
-        a_bit = (time_us/(256**3))%256
-        b_bit = (time_us/(256**2))%256
-        c_bit = (time_us/256)%256
-        d_bit = time_us%256
-        self.immediateData[0:4] = np.array([d_bit, c_bit, b_bit, a_bit])
-        self.immediateDataLength = 4
-        self._send_command_to_device(0x00110010, line)
-        self.immediateDataLength = 0
-        time.sleep(.5)
+        sent = self._send_setting('integration_time_us', int(round(time_us)), \
+            0x00110010, '<I', line)
+        if sent and self.fixed_delays:
+            time.sleep(.5)
+
+    def get_integration_time(self, line=1):
+        ''' The device cannot report its integration time, so this returns
+            the one last set in micro seconds, or None if it has not been set
+            since the device was reset.
+        '''
+        return self._settings.get('integration_time_us')
 
     def set_trigger_mode(self, trig, line=1):
         ''' Sets the STS trigger mode, possible modes are:
@@ -342,12 +552,15 @@ class STSVIS(object):
             continuous strobe
         '''
         if abs(trig) < 3:
-            self.immediateData[0] = trig
-            self.immediateDataLength = 1
-            self._send_command_to_device(0x00110110, line)
-            self.immediateDataLength = 0
+            self._send_setting('trigger_mode', trig, 0x00110110, '<B', line)
         else:
-            print 'Please enter and integer value 0, 1 or 2 for trigger mode'
+            print('Please enter and integer value 0, 1 or 2 for trigger mode')
+
+    def get_trigger_mode(self, line=1):
+        ''' The device cannot report its trigger mode, so this returns the one
+            last set, or 0 (the mode after a reset) if none has been.
+        '''
+        return self._settings.get('trigger_mode', 0)
 
     def simulate_trigger_pulse(self, line=1):
         ''' Causes the STS to react exactly as though an electrical rising edge
@@ -363,7 +576,24 @@ class STSVIS(object):
     def get_pixel_binning_factor(self, line=1):
         ''' Returns a single byte indicating the binning mode.
         '''
-        return self._query_device(0x00110280, line)[0]
+        factor = int(self._query_device(0x00110280, line)[0])
+        self._settings['binning_factor'] = factor
+        return factor
+
+    def get_active_binning_factor(self, line=1):
+        ''' Returns the binning factor in use, as last set or read. The device
+            is only asked if it is not known, e.g. after a reset.
+        '''
+        factor = self._settings.get('binning_factor')
+        if factor is None:
+            factor = self.get_pixel_binning_factor(line)
+        return factor
+
+    def get_pixel_count(self, line=1):
+        ''' Returns the number of pixels in a spectrum with the binning factor
+            in use, 1024 halved for each step of binning.
+        '''
+        return _PIXELS >> self.get_active_binning_factor(line)
 
     def get_max_binning_factor(self, line=1):
         ''' Returns a single byte representing the largest binning factor that
@@ -380,21 +610,18 @@ class STSVIS(object):
         ''' Takes a single byte indicating the binning mode. This is used for
             this bus until the device is reset.
         '''
-        self.immediateData[0] = factor
-        self.immediateDataLength = 1
-        self._send_command_to_device(0x00110290, line)
-        self.immediateDataLength = 0
+        self._send_setting('binning_factor', int(factor), 0x00110290, '<B', \
+            line)
 
     def set_default_binning_factor(self, factor=None, line=1):
         ''' Takes a single byte indicating the default binning mode. If no
             factor is given, this will reset to factory default. This is
             used for this bus until the device is reset.
         '''
-        if factor != None:
-            self.immediateData[0] = factor
-            self.immediateDataLength = 1
-        self._send_command_to_device(0x00110290, line)
-        self.immediateDataLength = 0
+        immediate = b''
+        if factor is not None:
+            immediate = struct.pack('<B', factor)
+        self._send_command_to_device(0x00110295, line, immediate=immediate)
 
     def set_lamp_enable(self, enable, line=1):
         ''' Refers to the external enable pin. Changes take effect at the
@@ -403,25 +630,16 @@ class STSVIS(object):
             0 = off, 1= on.
         '''
         if (enable == 0) or (enable == 1):
-            self.immediateDataLength = 1
-            self.immediateData[0] = enable
-            self._send_command_to_device(0x00110410, line)
-            self.immediateDataLength = 0
+            self._send_setting('lamp_enable', enable, 0x00110410, '<B', line)
         else:
-            print 'Please use either 0 or 1 for lamb enable configuration'
+            print('Please use either 0 or 1 for lamb enable configuration')
 
     def set_trigger_delay(self, time_us, line=1):
         ''' Sets the trigger delay on the device to be time_us in micro
             seconds.
         '''
-        a_bit = (time_us/(256**3))%256
-        b_bit = (time_us/(256**2))%256
-        c_bit = (time_us/256)%256
-        d_bit = time_us%256
-        self.immediateData[0:4] = np.array([d_bit, c_bit, b_bit, a_bit])
-        self.immediateDataLength = 4
-        self._send_command_to_device(0x00110510, line)
-        self.immediateDataLength = 0
+        self._send_setting('trigger_delay_us', int(round(time_us)), \
+            0x00110510, '<I', line)
 
     def get_scans_to_avg(self, line=1):
         ''' Returns the current setting for number of the scans to average as
@@ -429,7 +647,9 @@ class STSVIS(object):
             this may be true for other methods.
         '''
         data = self._query_device(0x00120000, line)
-        return int(data[0]+data[1]*256)
+        scans = int(struct.unpack('<H', data[0:2].tobytes())[0])
+        self._settings[('scans_to_avg', line)] = scans
+        return scans
 
     def set_scans_to_avg(self, scans, line=1):
         ''' Takes a 16-bit int indicating the number of scans to average over
@@ -438,20 +658,28 @@ class STSVIS(object):
             dependant. Be aware this may be true for other methods.
         '''
         if scans < 5001 and scans > 0:
-            self.immediateData[0] = scans%256
-            self.immediateData[1] = (scans/256)%256
-            self.immediateDataLength = 2
-            self._send_command_to_device(0x00120010, line)
+            self._send_setting(('scans_to_avg', line), int(scans), \
+                0x00120010, '<H', line)
         else:
-            print "Please enter a number between 1 and 5000 for the number"  \
-                " of Scans to average over."
-        self.immediateDataLength = 0
+            print("Please enter a number between 1 and 5000 for the number" \
+                " of Scans to average over.")
+
+    def get_active_scans_to_avg(self, line=1):
+        ''' Returns the scans to average in use on the line, as last set or
+            read. The device is only asked if it is not known.
+        '''
+        scans = self._settings.get(('scans_to_avg', line))
+        if scans is None:
+            scans = self.get_scans_to_avg(line)
+        return scans
 
     def get_boxcar(self, line=1):
         ''' Returns the boxcar width being applied to all spectra. Valid range
             is 0-15. This is also line dependant.
         '''
-        return self._query_device(0x00121000, line)[0]
+        width = int(self._query_device(0x00121000, line)[0])
+        self._settings[('boxcar', line)] = width
+        return width
 
     def set_boxcar(self, width, line=1):
         ''' Takes a single byte giving the boxcar width to apply to all
@@ -460,13 +688,76 @@ class STSVIS(object):
             both sides. This is also line dependant.
         '''
         if width < 16 and width >= 0:
-            self.immediateData[0] = width
-            self.immediateDataLength = 1
-            self._send_command_to_device(0x00121010, line)
+            self._send_setting(('boxcar', line), int(width), 0x00121010, \
+                '<B', line)
         else:
-            print "Please enter a number between 0 and 15 for the boxcar" \
-                " width."
-        self.immediateDataLength = 0
+            print("Please enter a number between 0 and 15 for the boxcar" \
+                " width.")
+
+    # ########################################### #
+    #   These are the continuous acquisition ones  #
+    # ########################################### #
+
+    def start_stream(self, line=1, capacity=64, overflow='drop_oldest', \
+        raw=False):
+        ''' Starts acquiring spectra back to back on a background thread into
+            a ring buffer of capacity spectra, see sts_stream.SpectrumStream.
+            overflow is 'drop_oldest' to overwrite the oldest spectrum when
+            the buffer is full, or 'block' to wait for the consumer.
+            Returns the stream, which also counts acquired and dropped frames.
+        '''
+        self.stop_stream()
+        self._stream = SpectrumStream(self, line, capacity, overflow, raw)
+        self._stream.start()
+        return self._stream
+
+    def iter_spectra(self, timeout=None):
+        ''' Yields the spectra of the stream started by start_stream as
+            (timestamp, sequence, spectrum) frames. Stops when the stream
+            is stopped or no spectrum arrives within timeout seconds.
+        '''
+        if self._stream is None:
+            raise STS_Error('No stream has been started')
+        return self._stream.iter_spectra(timeout)
+
+    def stop_stream(self):
+        ''' Stops the stream started by start_stream, if there is one.
+        '''
+        if self._stream is not None:
+            self._stream.stop()
+
+    # ########################################### #
+    #   These are the instrumentation functions   #
+    # ########################################### #
+
+    def add_transaction_hook(self, hook):
+        ''' Calls hook with a Transaction (see sts_stats) after every message
+            sent to the device and its reply. Hooks are called in the thread
+            which sent the message, with the line still locked, so should
+            return quickly.
+        '''
+        self._hooks = self._hooks + [hook]
+
+    def remove_transaction_hook(self, hook):
+        ''' Stops calling a hook added by add_transaction_hook.
+        '''
+        self._hooks = [added for added in self._hooks if added != hook]
+
+    def enable_stats(self):
+        ''' Starts keeping a TransactionStats of the messages sent, in the
+            stats attribute, and returns it.
+        '''
+        if self.stats is None:
+            self.stats = TransactionStats()
+            self.add_transaction_hook(self.stats)
+        return self.stats
+
+    def disable_stats(self):
+        ''' Stops keeping the stats started by enable_stats.
+        '''
+        if self.stats is not None:
+            self.remove_transaction_hook(self.stats)
+            self.stats = None
 
     # ########################################### #
     #     These are the calibration functions     #
@@ -480,22 +771,21 @@ class STSVIS(object):
     def get_wav_coeff(self, index, line=1):
         ''' Returns the wavelength coefficient specified by 'index'
         '''
-        self.immediateDataLength = 1
-        self.immediateData[0] = index
-        data = self._query_device(0x00180101, line)
-        self.immediateDataLength = 0
-        return struct.unpack('<f', struct.pack('<4B', data[0], data[1], \
-            data[2], data[3]))[0]
+        data = self._query_device(0x00180101, line, struct.pack('<B', index))
+        return struct.unpack('<f', data[0:4].tobytes())[0]
+
+    def get_wav_coeffs(self, line=1):
+        ''' Returns all the wavelength coefficients as an array, in order of
+            index. The requests for them are sent together.
+        '''
+        return self._get_coeffs(0x00180101, self.get_wav_coeff_count(line), \
+            line)
 
     def set_wav_coeff(self, index, coeff, line=1):
         ''' Sets the wavelength coefficient with the index given to be coeff.
         '''
-        self.immediateData[0] = index
-        self.immediateData[1:5] = struct.unpack('<4B', struct.pack('<f', \
-            coeff))
-        self.immediateDataLength = 5
-        self._send_command_to_device(0x00180111, line)
-        self.immediateDataLength = 0
+        self._send_command_to_device(0x00180111, line, \
+            immediate=struct.pack('<Bf', index, coeff))
 
     def get_nonlin_coeff_count(self, line=1):
         ''' Returns the number of non linearity coefficients
@@ -505,38 +795,35 @@ class STSVIS(object):
     def get_nonlin_coeff(self, index, line=1):
         ''' Returns the non linearity coefficient specified by 'index'
         '''
-        self.immediateDataLength = 1
-        self.immediateData[0] = index
-        data = self._query_device(0x00181101, line)
-        self.immediateDataLength = 0
-        return struct.unpack('<f', struct.pack('<4B', data[0], data[1], \
-            data[2], data[3]))[0]
+        data = self._query_device(0x00181101, line, struct.pack('<B', index))
+        return struct.unpack('<f', data[0:4].tobytes())[0]
+
+    def get_nonlin_coeffs(self, line=1):
+        ''' Returns all the non linearity coefficients as an array, in order
+            of index. The requests for them are sent together.
+        '''
+        return self._get_coeffs(0x00181101, \
+            self.get_nonlin_coeff_count(line), line)
 
     def set_nonlin_coeff(self, index, coeff, line=1):
         ''' Sets the non linearity coefficient with the index given to be coeff.
         '''
-        self.immediateData[0] = index
-        self.immediateData[1:5] = struct.unpack('<4B', struct.pack('<f', coeff))
-        self.immediateDataLength = 5
-        self._send_command_to_device(0x00181111, line)
-        self.immediateDataLength = 0
+        self._send_command_to_device(0x00181111, line, \
+            immediate=struct.pack('<Bf', index, coeff))
 
     def get_irrad_calib(self, line=1):
         ''' Reply has up to 4096 bytes (whatever has been stored previously),
             intended for 1024 x 4-byte floats. If nothing has been stored, the
             reply will have NACK bit set in flags.
         '''
-        try:
-            data = self._query_device(0x00182001, line)
-        except STS_Error:
-            print 'There is no data for irradiance calibration.'
-        else:
-            calib = np.zeros(len(data)/4)
-            for ab in range(len(calib)):
-                calib[ab] = struct.unpack('<f', struct.pack('<4B', \
-                    data[0+ab*4], data[1+ab*4], data[2+ab*4], \
-                    data[3+ab*4]))[0]
-            return calib
+        with self._line_lock(line): #The reply buffer is reused by the line
+            try:
+                data = self._query_device(0x00182001, line)
+            except STS_DeviceError:
+                print('There is no data for irradiance calibration.')
+            else:
+                count = len(data)//4
+                return data[0:count*4].view('<f4').astype(np.float64)
 
     def get_irrad_calib_count(self, line=1):
         ''' Reply is a 4-byte integer indicating the total number of 4-byte
@@ -544,7 +831,7 @@ class STSVIS(object):
             including the zero values
         '''
         data = self._query_device(0x00182002, line)
-        return int(data[0]+256*(data[1]+256*(data[2]+256*data[3])))
+        return int(struct.unpack('<I', data[0:4].tobytes())[0])
 
     def get_irrad_calib_area(self, line=1):
         ''' If a collection area has been set, it is returned as a 4-byte float
@@ -552,11 +839,10 @@ class STSVIS(object):
         '''
         try:
             data = self._query_device(0x00182003, line)
-        except STS_Error:
-            print 'There is no area for collection set.'
+        except STS_DeviceError:
+            print('There is no area for collection set.')
         else:
-            area = struct.unpack('<f', struct.pack('<4B', data[0], data[1], \
-                data[2], data[3]))[0]
+            area = struct.unpack('<f', data[0:4].tobytes())[0]
             return area
 
     def set_irrad_calib(self, calibration, line=1):
@@ -565,34 +851,20 @@ class STSVIS(object):
             zero-length buffer will delete any irradiance calibration from STS.
             No reply. This is data storage. 
         '''
-        ind = 0
-        count = 0
-        data = np.zeros(len(calibration)*4)
-        for index in calibration:
-            data[ind] = index%256
-            ind += 1
-            data[ind] = (index/256)%256
-            ind += 1
-            data[ind] = (index/(256**2))%256
-            ind += 1
-            data[ind] = (index/(256**3))%256
-            ind += 1
-            
-            self._update_bytes_remaining(len(data))
-            self._send_command_to_device(0x00186010, line, \
+        data = np.asarray(calibration, dtype='<f4').tobytes()
+        if len(data) <= 16:
+            self._send_command_to_device(0x00182010, line, immediate=data)
+        else:
+            self._send_command_to_device(0x00182010, line, \
                 payload=True, data=data)
-            self._update_bytes_remaining(0)
 
     def set_irrad_calib_area(self, area, line=1):
         ''' Sets the colection area for irradiance calibration, Sending a
             zero-length buffer will delete any collection area previously
             stored.
         '''
-        self.immediateData[0:4] = struct.unpack('<4B', struct.pack('<f', \
-            area))
-        self.immediateDataLength = 4
-        self._send_command_to_device(0x00182011, line)
-        self.immediateDataLength = 0
+        self._send_command_to_device(0x00182011, line, \
+            immediate=struct.pack('<f', area))
 
     def get_stray_light_coeff_count(self, line=1):
         ''' Returns the number of stray light coefficients
@@ -603,34 +875,32 @@ class STSVIS(object):
         ''' Returns the non linearity coefficient with the order of the
             coefficient, specified by 'order'
         '''
-        self.immediateDataLength = 1
-        self.immediateData[0] = order
-        data = self._query_device(0x00183101, line)
-        self.immediateDataLength = 0
-        return struct.unpack('<f', struct.pack('<4B', data[0], data[1], \
-            data[2], data[3]))[0]
+        data = self._query_device(0x00183101, line, struct.pack('<B', order))
+        return struct.unpack('<f', data[0:4].tobytes())[0]
+
+    def get_stray_light_coeffs(self, line=1):
+        ''' Returns all the stray light coefficients as an array, in order
+            of their order. The requests for them are sent together.
+        '''
+        return self._get_coeffs(0x00183101, \
+            self.get_stray_light_coeff_count(line), line)
 
     def set_stray_light_coeff(self, order, coeff, line=1):
         ''' Sets the stray light coefficient of order given by
             'order' to be 'coeff'.
         '''
-        self.immediateData[0] = order
-        self.immediateData[1:5] = struct.unpack('<4B', struct.pack('<f', coeff))
-        self.immediateDataLength = 5
-        self._send_command_to_device(0x00183111, line)
-        self.immediateDataLength = 0
+        self._send_command_to_device(0x00183111, line, \
+            immediate=struct.pack('<Bf', order, coeff))
 
     def get_hot_pixel_index(self, line=1):
         ''' Reply is up to 52 x 2-byte integers. This returns an array of
             integer indexes of the stored hot pixels of the device.
             If nothing has been stored this will return a NACK in Flags.
         '''
-        data = self._query_device(0x00186000, line)
-        ind = len(data)/2
-        indices = np.zeros(ind)
-        for ab in range(ind):
-            indices[ab] = 256*data[ab*2 + 1] +data[ab*2]
-        return indices
+        with self._line_lock(line): #The reply buffer is reused by the line
+            data = self._query_device(0x00186000, line)
+            ind = len(data)//2
+            return data[0:ind*2].view('<u2').astype(np.float64)
 
     def set_hot_pixel_index(self, indices, line=1):
         ''' Sets the hot pixel indices of the device. It is suggested that the
@@ -638,35 +908,21 @@ class STSVIS(object):
             indices onto the end of this np array and then sends it to this
             method as the indices array
         '''
-        ind = 0
-        count = 0
-        data = np.zeros(len(indices)*2)
-        for index in indices:
-            data[ind] = index%256
-            ind += 1
-            data[ind] = (index/256)%256
-            ind += 1
-            if len(data) <= 16:
-                self.immediateData[count] = data[count]
-                count += 1
-                self.immediateData[count] = data[count]
-                count += 1
-                self.immediateDataLength = ind
-                self._send_command_to_device(0x00186010, line)
-                self.immediateDataLength = 0
-            else:
-                self._update_bytes_remaining(len(data))
-                self._send_command_to_device(0x00186010, line, \
-                    payload=True, data=data)
-                self._update_bytes_remaining(0)
+        data = np.asarray(indices).astype('<u2').tobytes()
+        if len(data) <= 16:
+            self._send_command_to_device(0x00186010, line, immediate=data)
+        else:
+            self._send_command_to_device(0x00186010, line, \
+                payload=True, data=data)
 
     def get_bench_ID(self, line=1):
         ''' Reply is up to 32 byte ASCII string in output.
         '''
-        string = self._query_device(0x001B0000, line)
-        result = ''
-        for ab in range(len(string)):
-            result += str(unichr(int(string[ab])))
+        with self._line_lock(line): #The reply buffer is reused by the line
+            string = self._query_device(0x001B0000, line)
+            result = ''
+            for ab in range(len(string)):
+                result += str(chr(int(string[ab])))
         return result
 
     def get_bench_serial(self, line=1):
@@ -675,21 +931,21 @@ class STSVIS(object):
         string = self._query_device(0x001B0100, line)
         result = ''
         for ab in range(len(string)):
-            result += str(unichr(int(string[ab])))
+            result += str(chr(int(string[ab])))
         return result
 
     def get_slit_width(self, line=1):
         ''' Reply is a two byte integer of the slit width.
         '''
         data = self._query_device(0x001B0200, line)
-        width = data[0] + 256*data[10]
+        width = struct.unpack('<H', data[0:2].tobytes())[0]
         return width
 
     def get_fiber_diameter(self, line=1):
         ''' Reply is a two byte integer of the fiber diameter.
         '''
         data = self._query_device(0x001B0300, line)
-        width = data[0] + 256*data[1]
+        width = struct.unpack('<H', data[0:2].tobytes())[0]
         return width
 
     def get_grating(self, line=1):
@@ -698,7 +954,7 @@ class STSVIS(object):
         string = self._query_device(0x001B0400, line)
         result = ''
         for ab in range(len(string)):
-            result += str(unichr(int(string[ab])))
+            result += str(chr(int(string[ab])))
         return result    
 
     def get_filter(self, line=1):
@@ -707,7 +963,7 @@ class STSVIS(object):
         string = self._query_device(0x001B0500, line)
         result = ''
         for ab in range(len(string)):
-            result += str(unichr(int(string[ab])))
+            result += str(chr(int(string[ab])))
         return result
 
     def get_coating(self, line=1):
@@ -716,7 +972,7 @@ class STSVIS(object):
         string = self._query_device(0x001B0600, line)
         result = ''
         for ab in range(len(string)):
-            result += str(unichr(int(string[ab])))
+            result += str(chr(int(string[ab])))
         return result
 
     # ########################################### #
@@ -775,12 +1031,8 @@ class STSVIS(object):
                 1 = Reserved/Internal Use
                 2 = Microcontroller Sensor Temperature
         '''
-        self.immediateDataLength = 1
-        self.immediateData[0] = sensor
-        data = self._query_device(0x00400001, line)
-        self.immediateDataLength = 0
-        return struct.unpack('<f', struct.pack('<4B', data[0], data[1], \
-            data[2], data[3]))[0]
+        data = self._query_device(0x00400001, line, struct.pack('<B', sensor))
+        return struct.unpack('<f', data[0:4].tobytes())[0]
 
     def read_all_temperature(self, line=1):
         ''' Reply is 3 4-bytes corresponding to 3 single precision floats.
@@ -788,247 +1040,563 @@ class STSVIS(object):
             read_temperature_sensor() for all 3 possible indices.
         '''
         data = self._query_device(0x00400002, line)
-        self.immediateDataLength = 0
-        return struct.unpack('<3f', struct.pack('<12B', data[0], data[1], \
-            data[2], data[3], data[4], data[5], data[6], data[7], data[8], \
-            data[9], data[10], data[11]))
+        return struct.unpack('<3f', data[0:12].tobytes())
 
     # ########################################### #
     # The user doesn't need to see these function #
     # ########################################### #
 
-    def _send_command_to_device(self, command, line, payload=False, data=None):
+    @_observed
+    def _send_command_to_device(self, command, line, payload=False, \
+        data=None, immediate=b'', regarding=_NO_REGARDING):
         ''' This function writes the packet to the device, and does a single
-            read to look for the ACK.
+            read to look for the ACK. immediate is up to 16 bytes sent in the
+            header, if payload is True data is sent after the header instead.
         '''
         if payload == True:
-            if data == None:
-                print "No Payload Present"
-            else:
-                # print "Payload Received"
-                packet = self._build_packet(command, 4, data)
-                sends = len(packet)/64
-
-                # Send to the correct line then wait a small amount of time
-                for ab in range(sends):
-                    n = 64*ab
-                    if line == 1:
-                        self._dev.write(self._EP1_out, packet[n:n+64])
-                    elif line == 2:
-                        self._dev.write(self._EP2_out, packet[n:n+64])
-                    else:
-                        print 'Please enter correct line choice. 1 or 2'
-                        raise _OOError('Wrong endpoint line choice')
-                    time.sleep(.1)
-
+            if data is None:
+                print("No Payload Present")
+                return
         else:
-            packet = self._build_packet(command, 4)
+            data = None
+        message = _Message(command, immediate, data, regarding)
+        timeout = self._response_timeout(command, line)
 
-            #Send to the correct line then wait a small amount of time
-            if line == 1:
-                self._dev.write(self._EP1_out, packet)
-            elif line == 2:
-                self._dev.write(self._EP2_out, packet)
-            else:
-                print 'Please enter correct line choice. 1 or 2'
-                raise _OOError('Wrong endpoint line choice')
-            time.sleep(.1)
-
-        if command != 0: #If we didn't send the reset command
-            read = self._read_device(line)
-            # print read
-            if read[4] != 3: #If "dead" data, read what is on the line
-                read = self._read_device(line)
-                # print read
-                if read[4] != 3: #If still wrong, manage the error
-                    self._error_management(read[6])
-
-    def _query_device(self, command, line):
+        def exchange():
+            packet = self._build_packet(message, 4, line)
+            self._write_device(line, packet)
+            if command != 0: #If we didn't send the reset command
+                self._read_reply(line, timeout, command)
+
+        with self._line_lock(line):
+            self._with_retries(command, line, exchange)
+
+    @_observed
+    def _query_device(self, command, line, immediate=b''):
         ''' This function also writes the packet to the device, but this time
             it is for a data request, so it does the initial read looking for
             the response and when found it will return that data. If the
             response has a payload then an external read is called looking for
             the amount of data specified in the bytesRemaining field of the
             first packet, else the internal read is called looking for only
-            the immediateData field with length given by immediateDataLength
+            the immediateData field with length given by immediateDataLength.
+            immediate is up to 16 bytes sent with the request.
+        '''
+        message = _Message(command, immediate, None, _NO_REGARDING)
+        timeout = self._response_timeout(command, line)
+
+        def exchange():
+            packet = self._build_packet(message, 0, line)
+            self._write_device(line, packet)
+            return self._read_response(line, timeout, command)
+
+        with self._line_lock(line):
+            return self._with_retries(command, line, exchange)
+
+    @_observed
+    def _query_device_pipelined(self, command, line, immediates):
+        ''' Sends a request of message type command for each of immediates
+            before reading any of the replies, so the device answers them
+            back to back instead of waiting a round trip for each. Returns
+            the data of each reply, in the order of immediates.
+        '''
+        timeout = self._response_timeout(command, line)
+
+        def exchange():
+            for immediate in immediates:
+                message = _Message(command, immediate, None, _NO_REGARDING)
+                self._write_device(line, self._build_packet(message, 0, line))
+            #Copied as a payload reply is in a buffer the next one reuses
+            return [self._read_response(line, timeout, command).copy() \
+                for immediate in immediates]
+
+        with self._line_lock(line):
+            return self._with_retries(command, line, exchange)
+
+    @_observed
+    def _query_device_armed(self, command, line, out, timestamps, depth, \
+        timeout):
+        ''' Keeps depth requests of message type command armed, sending the
+            next as soon as each reply arrives (before decoding it), until a
+            reply for every row of out has been read or one times out. Not
+            retried, as a request sent again would be taken on a later
+            trigger. Returns the number of replies decoded into out.
+        '''
+        count = len(out)
+        armed = received = 0
+        failed = True
+        with self._line_lock(line):
+            try:
+                while armed < min(depth, count):
+                    self._write_request(command, line)
+                    armed += 1
+                while received < count:
+                    try:
+                        data = self._read_response(line, timeout, command)
+                    except STS_TimeoutError:
+                        break
+                    timestamps[received] = time.time()
+                    if armed < count:
+                        self._write_request(command, line)
+                        armed += 1
+                    self._decode_spectrum(data, out[received])
+                    received += 1
+                failed = False
+            finally:
+                try:
+                    self._disarm(command, line, armed - received, timeout)
+                except Exception:
+                    #The error that ended the burst is the one to report
+                    if not failed:
+                        raise
+        return received
+
+    def _disarm(self, command, line, outstanding, timeout):
+        ''' Completes the outstanding requests of message type command still
+            armed on the device by simulated trigger pulses, sent on the other
+            line, and discards their replies. The caller holds the locks of
+            both lines.
+        '''
+        other = 2 if line == 1 else 1
+        for request in range(outstanding):
+            self.simulate_trigger_pulse(other)
+            self._read_response(line, timeout, command)
+
+    def _write_request(self, command, line):
+        ''' Writes a request of message type command with no data, for the
+            reply to be read later by _read_response. The caller holds the
+            lock of the line.
+        '''
+        message = _Message(command, b'', None, _NO_REGARDING)
+        self._write_device(line, self._build_packet(message, 0, line))
+
+    def _read_response(self, line, timeout, command=None):
+        ''' Reads the reply to a request of message type command (or any
+            message type if None) already written on the line and returns its
+            data. The caller holds the lock of the line.
+        '''
+        read = self._read_reply(line, timeout, command)
+        bytes_left = _bytes_remaining(read)
+        if bytes_left == 20:
+            to_read = read[23]
+            return self._internal_read(read, to_read)
+        else: return self._external_read(line, read, bytes_left, timeout)
+
+    def _read_reply(self, line, timeout, command=None):
+        ''' Reads the first packet of the reply to command and returns it.
+            Packets which don't start with the header, and replies to other
+            message types (such as one that came after its request timed
+            out), are discarded. Raises STS_DeviceError for a NACK and
+            STS_ProtocolError if the reply can't be found or a single packet
+            reply doesn't end with the footer.
+        '''
+        for skipped in range(_MAX_SKIPPED_PACKETS):
+            read = self._read_device(line, timeout)
+            if len(read) == 64 and read[0] == _HEADER_BYTES[0] and \
+                read[1] == _HEADER_BYTES[1]:
+                if command is None or _message_type(read) == command:
+                    break
+                #A whole reply to another request, discard the rest of it
+                if _bytes_remaining(read) > 20:
+                    self._discard(line, _bytes_remaining(read) - 20, timeout)
+            self._count_retry(line)
+        else:
+            raise STS_ProtocolError('No reply found in %d packets' % \
+                _MAX_SKIPPED_PACKETS, command)
+
+        if read[4] & _NACK_FLAG:
+            self._error_management(read[6] + 256*read[7], command)
+        if _bytes_remaining(read) == 20 and \
+            tuple(read[60:64]) != _FOOTER_BYTES:
+            raise STS_ProtocolError('Reply without the footer', command)
+        return read
+
+    def _with_retries(self, command, line, exchange):
+        ''' Calls exchange, which writes a message and reads its reply, and
+            returns what it returns. After a timeout or a garbled reply the
+            line is drained and exchange is called again, up to retries
+            times with the backoff doubling each time, unless the message
+            can't be sent twice. The caller holds the lock of the line.
+        '''
+        attempt = 0
+        while True:
+            try:
+                return exchange()
+            except (STS_TimeoutError, STS_ProtocolError):
+                if attempt >= self.retries or not self._can_retry(command):
+                    raise
+            self._count_retry(line)
+            time.sleep(self.retry_backoff_s*2**attempt)
+            attempt += 1
+            self._drain(line)
+
+    def _can_retry(self, command):
+        ''' Whether a message of type command can be sent again when its
+            reply is lost. A spectrum in a triggered mode can't be, as the
+            first request may still be waiting for its trigger.
+        '''
+        if command in _NO_RETRY_COMMANDS:
+            return False
+        if command in _SPECTRUM_COMMANDS:
+            return self._settings.get('trigger_mode', 0) == 0
+        return True
+
+    def _drain(self, line):
+        ''' Reads and discards whatever is waiting on the line, until nothing
+            arrives for _DRAIN_TIMEOUT_MS.
+        '''
+        while True:
+            try:
+                self._read_device(line, _DRAIN_TIMEOUT_MS)
+            except STS_TimeoutError:
+                return
+
+    def _discard(self, line, size, timeout):
+        ''' Reads and discards size bytes from the line.
+        '''
+        endpoint = self._EP1_in if line == 1 else self._EP2_in
+        while size > 0:
+            size -= len(self._read_endpoint(endpoint, size, timeout))
+
+    def _send_setting(self, key, value, command, fmt, line):
+        ''' Sends value, packed with the struct format fmt, with the message
+            type command unless the device is known to have it already.
+            Returns whether it was sent. The setting is recorded under key
+            once the device has acknowledged it.
+        '''
+        with self._line_lock(line):
+            if self._settings.get(key) == value:
+                return False
+            #Not known until the ACK, e.g. if the write times out
+            self._settings.pop(key, None)
+            self._send_command_to_device(command, line, \
+                immediate=struct.pack(fmt, value))
+            self._settings[key] = value
+            return True
+
+    def _get_coeffs(self, command, count, line):
+        ''' Queries the count coefficients of message type command, which
+            take the index as a byte and reply with a float, in one pipeline.
+        '''
+        immediates = [struct.pack('<B', index) for index in range(count)]
+        replies = self._query_device_pipelined(command, line, immediates)
+        coeffs = np.zeros(count)
+        for index, data in enumerate(replies):
+            coeffs[index] = struct.unpack('<f', data[0:4].tobytes())[0]
+        return coeffs
+
+    def _response_timeout(self, command, line):
+        ''' Returns the time in milliseconds to wait for the reply to the
+            message type command. Spectra are allowed twice the integration
+            time multiplied by the scans to average, so a read returns as soon
+            as the device replies rather than after a fixed sleep. In a
+            triggered mode _TRIGGER_WAIT_MS is added for the trigger, unless
+            trigger_timeout_ms is set. A time in the timeouts dictionary
+            replaces any of these.
+        '''
+        if command in self.timeouts:
+            return self.timeouts[command]
+        if command in _SPECTRUM_COMMANDS:
+            triggered = self._settings.get('trigger_mode', 0) != 0
+            if triggered and self.trigger_timeout_ms is not None:
+                return self.trigger_timeout_ms
+            scans = self.get_active_scans_to_avg(line)
+            exposure = self._settings.get('integration_time_us', \
+                _MAX_INTEGRATION_US)*scans + \
+                self._settings.get('trigger_delay_us', 0)
+            timeout = _RESPONSE_TIMEOUT_MS + int(2*exposure/1000)
+            if triggered:
+                timeout += _TRIGGER_WAIT_MS
+            return timeout
+        elif command in _FLASH_COMMANDS:
+            return _FLASH_TIMEOUT_MS
+        return _RESPONSE_TIMEOUT_MS
+
+    def _count_retry(self, line):
+        ''' Counts a reply discarded as dead data in the transaction on the
+            line, if it is observed.
+        '''
+        tally = self._tallies[line]
+        if tally is not None:
+            tally.retries += 1
+
+    def _line_lock(self, line):
+        ''' Returns the lock held while a message and its reply are on the
+            given line.
+        '''
+        if line not in self._line_locks:
+            print('Please enter correct line choice. 1 or 2')
+            raise STS_Error('Wrong endpoint line choice')
+        return self._line_locks[line]
+
+    def _write_device(self, line, packet):
+        ''' This function writes the packet to the OUT endpoint of the line,
+            as a single transfer (or 64 bytes at a time with the fixed
+            delays).
         '''
-        packet = self._build_packet(command, 0)
-
-        #Send to the correct line then wait a small amount of time
         if line == 1:
-            self._dev.write(self._EP1_out, packet)
+            endpoint = self._EP1_out
         elif line == 2:
-            self._dev.write(self._EP2_out, packet)
+            endpoint = self._EP2_out
         else:
-            print 'Please enter correct line choice. 1 or 2'
-            raise _OOError('Wrong endpoint line choice')
-        time.sleep(.1)
-
-        read = self._read_device(line)
-        # print read
-        if read[4] != 1: #If "dead" data, read the data on the line already
-            read = self._read_device(line)
-            # print read
-            if read[4] != 1: #If still wrong, manage the error
-                self._error_management(read[6])
-            else:
-                bytes_left = read[40] + 256*(read[41] + 256*(read[42] + \
-                    256*(read[43])))
-                if bytes_left == 20:
-                    to_read = read[23]
-                    return self._internal_read(read, to_read)
-                else: return self._external_read(line, read, bytes_left)
-
-    def _read_device(self, line):
+            print('Please enter correct line choice. 1 or 2')
+            raise STS_Error('Wrong endpoint line choice')
+        if self.fixed_delays:
+            for n in range(0, len(packet), 64):
+                self._dev.write(endpoint, packet[n:n+64])
+                time.sleep(.1)
+        else:
+            self._dev.write(endpoint, packet)
+        tally = self._tallies[line]
+        if tally is not None and tally.written is None:
+            #Only the first write, so a lost reply counts as time reading
+            tally.written = time.time()
+            tally.bytes_out += len(packet)
+
+    def _read_device(self, line, timeout=_RESPONSE_TIMEOUT_MS):
         ''' This function reads the device on the correct line. It is called
             by a function which the user can see and that function defines the
-            repeating reads or not
+            repeating reads or not, and the time in milliseconds to wait for
+            the data.
         '''
         if line == 1:
-            ret = self._dev.read(self._EP1_in, 64, timeout=1000000)
+            ret = self._read_endpoint(self._EP1_in, 64, timeout)
         elif line == 2:
-            ret = self._dev.read(self._EP2_in, 64, timeout=1000000)
+            ret = self._read_endpoint(self._EP2_in, 64, timeout)
         else:
-            print 'Please enter correct line choice. 1 or 2'
-            raise _OOError('Wrong endpoint line choice')
+            print('Please enter correct line choice. 1 or 2')
+            raise STS_Error('Wrong endpoint line choice')
+        tally = self._tallies[line]
+        if tally is not None:
+            tally.packets += 1
+            tally.bytes_in += len(ret)
+            if len(ret) > 7 and ret[4] & 8: #NACK, with the error number
+                tally.nacks += 1
+                tally.error_code = ret[6] + 256*ret[7]
         return ret
 
-    def _build_packet(self, commandtype, flags_up, data=None):
-        ''' This is the function that constructs the packet from the internal
-            data structures and returns it.
+    def _read_endpoint(self, endpoint, size_or_buffer, timeout):
+        ''' Reads from the IN endpoint as usb.core.Device.read, raising
+            STS_TimeoutError if nothing arrives within timeout milliseconds.
         '''
-        package = struct.pack('<8B', self.headerTop[0], self.headerTop[1], \
-            self.protocolVersion[0], self.protocolVersion[1], \
-            (self.flags[0] + flags_up), self.flags[1], self.errorNumber[0], \
-            self.errorNumber[1])
-
-        package += struct.pack('<I', commandtype)
-
-        package += struct.pack('<12B', self.regarding[0], self.regarding[1], \
-            self.regarding[2], self.regarding[3], 0, 0, 0, 0, 0, 0, \
-            self.checksumType, self.immediateDataLength)
-
-        for ii in range(16):
-            package += struct.pack('<B', self.immediateData[ii])
-
-        package += struct.pack('<4B', self.bytesRemaining[0], \
-            self.bytesRemaining[1], self.bytesRemaining[2], \
-            self.bytesRemaining[3])
-
-        if data != None:
-            #Need to be able to add the payload in somehow
-            for jj in range(len(data)):
-                package += struct.pack('<B', data[jj])
-            while len(package) % 64 != 44:
-                package += struct.pack('<B', 0)
+        try:
+            return self._dev.read(endpoint, size_or_buffer, timeout=timeout)
+        except usb.core.USBError as error:
+            if _timed_out(error):
+                raise STS_TimeoutError('No reply within %d ms' % timeout)
+            raise
+
+    def _build_packet(self, message, flags_up, line=1):
+        ''' This is the function that constructs the packet for a _Message
+            and returns it. The first 12 bytes only depend on the message type
+            and flags so are cached, the rest is packed into a bytearray which
+            is reused for the next packet of the same size on the line.
+        '''
+        key = (message.command, flags_up)
+        header = self._header_cache.get(key)
+        if header is None:
+            header = _COMMAND_HEADER.pack(self.headerTop[0], \
+                self.headerTop[1], self.protocolVersion[0], \
+                self.protocolVersion[1], (self.flags[0] + flags_up), \
+                self.flags[1], self.errorNumber[0], self.errorNumber[1], \
+                message.command)
+            self._header_cache[key] = header
+
+        data = message.payload
+        if data is None:
+            length = 0
+        elif isinstance(data, (bytes, bytearray)):
+            length = len(data)
+        else:
+            data = np.asarray(data).astype(np.uint8).tobytes()
+            length = len(data)
+        #The payload goes between the header and the checksum and footer
+        size = 64 + length
 
+        package = self._packet_buffers.get((line, size))
+        if package is None:
+            package = bytearray(size)
+            package[size - 20:] = self._footer_bytes
+            self._packet_buffers[(line, size)] = package
 
-        for ii in range(16):  #Reserved BYTES
-            package += struct.pack('<B', self.checksum[ii])
+        regarding = message.regarding
+        _PACKET_HEADER.pack_into(package, 0, header, regarding[0], \
+            regarding[1], regarding[2], regarding[3], self.checksumType, \
+            len(message.immediate), message.immediate, size - 44)
 
-        package += struct.pack('<4B', self.footer[0], self.footer[1], \
-            self.footer[2], self.footer[3])
+        if length:
+            package[44:44 + length] = data
 
         return package
 
     def _internal_read(self, read, bytes_for_reading):
         ''' This function will read a single packet off the device and return
-            just the data from this packet
+            just the data from this packet, as an array of bytes viewing the
+            packet rather than a copy of it.
         '''
-        data = np.zeros(bytes_for_reading)
-        for ab in range(bytes_for_reading):
-            data[ab] = read[24 + ab]
-        return data
+        return np.frombuffer(read, dtype=np.uint8, count=bytes_for_reading, \
+            offset=24)
 
-    def _external_read(self, line, read, bytes_for_reading):
+    def _external_read(self, line, read, bytes_for_reading, \
+        timeout=_RESPONSE_TIMEOUT_MS):
         ''' This function will read all the remaining packets in the data
-            stream and returns the data of interest
-        '''
-        to_read = bytes_for_reading/64
-        for kk in range(to_read):
-            read += self._read_device(line)
+            stream in a single bulk transfer and returns the data of interest.
+            The data is returned in a buffer which is reused by the next read
+            of the same size on this line.
+        '''
+        #The rest of the payload and the 20 byte footer are left to read,
+        #    the payload being bytesRemaining less the 20 bytes of footer.
+        size = bytes_for_reading - 20
+        key = (line, size)
+        if key not in self._receive_buffers:
+            self._receive_buffers[key] = (array.array('B', [0])*size, \
+                np.zeros(size, dtype=np.uint8))
+        transfer, data = self._receive_buffers[key]
 
-        #Takes the data off the read packets.
-        data = np.zeros(to_read*64) #Needs this not 'bytes' to ignore last 20
-        for  ll in range(to_read*64):
-            data[ll] = read[44 + ll]
+        if line == 1:
+            endpoint = self._EP1_in
+        elif line == 2:
+            endpoint = self._EP2_in
+        else:
+            print('Please enter correct line choice. 1 or 2')
+            raise STS_Error('Wrong endpoint line choice')
+        received = self._read_endpoint(endpoint, transfer, timeout)
+        transfers = 1
+        rest = np.frombuffer(transfer, dtype=np.uint8)
+        footer = rest[max(received - 4, 0):received]
+
+        #The first 20 bytes of data came in the packet with the header.
+        head = min(size, 20)
+        data[0:head] = np.frombuffer(read, dtype=np.uint8, count=head, \
+            offset=44)
+        count = max(min(received, size - 20), 0)
+        data[20:20 + count] = rest[0:count]
+        while received < size: #A short transfer, read what is left
+            more = self._read_endpoint(endpoint, size - received, timeout)
+            more = np.frombuffer(more, dtype=np.uint8)
+            count = max(min(len(more), size - 20 - received), 0)
+            data[20 + received:20 + received + count] = more[0:count]
+            received += len(more)
+            transfers += 1
+            footer = np.concatenate((footer, more))[-4:]
+        tally = self._tallies[line]
+        if tally is not None:
+            tally.packets += transfers
+            tally.bytes_in += received
+        if tuple(footer) != _FOOTER_BYTES:
+            raise STS_ProtocolError('Reply without the footer')
         return data
 
-    def _update_bytes_remaining(self, change):
-        ''' This function updtes the data field which is concerned with the
-            number of bytes remaining in the package. An input value of 0 in
-            the change field will reset it to the default 20, which corresponds
-            to no payload.
+    def _decode_spectrum(self, data, out=None):
+        ''' This function interprets the data of a spectrum reply in place as
+            little-endian 16 bit pixel values. These are copied into out if it
+            is given, otherwise into a new float array.
         '''
-        val = change + 20
-        a_bit = (val/(256**3))%256
-        b_bit = (val/(256**2))%256
-        c_bit = (val/256)%256
-        d_bit = val%256
-        self.bytesRemaining = np.array([d_bit, c_bit, b_bit, a_bit])
+        with sts_trace.span('decode'):
+            counts = data[0:len(data)//2*2].view('<u2')
+            if out is None:
+                return counts.astype(np.float64)
+            out[...] = counts
+            return out
 
-    def _update_immediate_data(self, length, data):
-        ''' This function will replace the code in many of the sending command
-            functions that make up the interface, this will just tidy up the
-            code somewhat.
+    def _error_management(self, error, command=None):
+        ''' This function is the error handler, it raises an STS_DeviceError
+            carrying the error number sent back by the device for a message
+            of type command, which prints the error Type and the message that
+            comes with that error out for the user.
         '''
-        raise NotImplementedError
+        raise STS_DeviceError(error, command)
 
-    def _error_management(self, error):
-        ''' This function is the error handler, it will just print the error
-            Type and the message that comes with that error out for the user.
-        '''
-        if error == 0:
-            print "No detectable errors"
-        elif error == 1:
-            print "Invalid/unsupported protocol"
-        elif error == 2:
-            print "Unknown message type"
-        elif error == 3:
-            print "Bad checksum"
-        elif error == 4:
-            print "Message too large"
-        elif error == 5:
-            print "Payload length does not match message type"
-        elif error == 6:
-            print "Payload data invalid"
-        elif error == 7:
-            print "Device not ready for given message type"
-        elif error == 8:
-            print "Unknown checksum type"
-        elif error == 9:
-            print "Device reset unexpectedly"
-        elif error == 10:
-            print "Too many buses (Commands have come from too many bus" \
-                "interfaces)"
-        elif error == 11:
-            print "Out of memory. Failed to allocate enough space to" \
-                "complete request."
-        elif error == 12:
-            print "Command is valid, but desired information does not exist."
-        elif error == 13:
-            print "Int Device Error. May be unrecoverable."
-        elif error == 100:
-            print "Could not decrypt properly"
-        elif error == 101:
-            print "Firmware layout invalid"
-        elif error == 102:
-            print "Data packet was wrong size (not 64 bytes)"
-        elif error == 103:
-            print "Hardware revision not compatible with firmware "
-        elif error == 104:
-            print "Existing flash map not compatible with firmware"
-        elif error == 255:
-            print "Operation/Response Deferred. Operation will take some" \
-                "time to complete. Do not ACK or NACK yet."
-        else:
-            print "Error Undetermined"
+def _ascii(text):
+    ''' Returns the bytes of a string to send to the device.
+    '''
+    return text.encode('ascii')
+
+def _bytes_remaining(read):
+    ''' Returns the bytesRemaining field of the first packet of a reply.
+    '''
+    return read[40] + 256*(read[41] + 256*(read[42] + 256*(read[43])))
+
+def _message_type(read):
+    ''' Returns the message type of the first packet of a reply.
+    '''
+    return read[8] + 256*(read[9] + 256*(read[10] + 256*(read[11])))
 
-        raise STS_Error('Device %s sent back error' % (self._dev, ))
+def _timed_out(error):
+    ''' Whether a usb.core.USBError is a timeout.
+    '''
+    timeout_error = getattr(usb.core, 'USBTimeoutError', None)
+    if timeout_error is not None and isinstance(error, timeout_error):
+        return True
+    return getattr(error, 'errno', None) == errno.ETIMEDOUT
+
+def find_devices(find=None):
+    ''' Returns the list of connected STS-VIS spectrometers, in the order
+        used for the index of STSVIS. find replaces usb.core.find as in STSVIS.
+    '''
+    if find is None:
+        find = usb.core.find
+    return list(find(find_all=True, idVendor=0x2457, idProduct=0x4000))
+
+def bin_pixels(values, factor):
+    ''' Returns the mean of each group of 2**factor neighbouring values, as
+        the pixels of the detector are combined by the binning factor. The
+        last axis is binned, so a stack of spectra can be given.
+    '''
+    values = np.asarray(values, dtype=float)
+    if factor == 0:
+        return values
+    width = 1 << factor
+    shape = values.shape[:-1] + (values.shape[-1]//width, width)
+    return values[..., 0:shape[-2]*width].reshape(shape).mean(axis=-1)
+
+def pixel_ranges(wavelengths, wavelength_ranges):
+    ''' Returns the (first pixel, number of pixels) of the pixels whose
+        centre wavelength is within each (low, high) range, for the partial
+        spectrum mode. wavelengths is the wavelength of each pixel, in
+        increasing order.
+    '''
+    ranges = []
+    for low, high in wavelength_ranges:
+        start = int(np.searchsorted(wavelengths, min(low, high), 'left'))
+        stop = int(np.searchsorted(wavelengths, max(low, high), 'right'))
+        if stop <= start:
+            raise STS_Error('No pixel between %g and %g nm' % (low, high))
+        ranges.append((start, stop - start))
+    return ranges
 
 class STS_Error(Exception):
     ''' This is the error class which is raised by the Driver in its error
         management function.
     '''
     def __init__(self, value):
-        print value
\ No newline at end of file
+        Exception.__init__(self, value)
+        print(value)
+
+class STS_DeviceError(STS_Error):
+    ''' Raised when the device sends back a NACK. code is the OBP error
+        number, description its meaning and command the message type (or
+        None if not known).
+    '''
+    def __init__(self, code, command=None):
+        self.code = code
+        self.command = command
+        self.description = _ERROR_MESSAGES.get(code, 'Error Undetermined')
+        STS_Error.__init__(self, 'Device sent back error %d: %s' % (code, \
+            self.description))
+
+class STS_TimeoutError(STS_Error):
+    ''' Raised when no reply arrives in the time allowed. It is not printed,
+        as the transaction is usually retried.
+    '''
+    def __init__(self, value, command=None):
+        Exception.__init__(self, value)
+        self.command = command
+
+class STS_ProtocolError(STS_Error):
+    ''' Raised when a reply can't be found on the line or doesn't end with
+        the footer. It is not printed, as the transaction is usually retried.
+    '''
+    def __init__(self, value, command=None):
+        Exception.__init__(self, value)
+        self.command = command
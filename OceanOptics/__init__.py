@@ -20,6 +20,7 @@
 
     Email: wesma651@student.otago.ac.nz
 '''
-from STS import STSVIS
-from STS import STS_Error
-import sts_utils
\ No newline at end of file
+from .STS import STSVIS
+from .STS import STS_Error
+from .STS import STS_DeviceError, STS_TimeoutError, STS_ProtocolError
+from . import sts_utils
\ No newline at end of file
@@ -0,0 +1,254 @@
+''' Binary archive of STS spectra. Spectra are appended as fixed size records
+    (timestamp, integration time, scans to average, temperatures and the
+    uint16 counts of each pixel) to one file per device and day, so logging
+    around the clock at several spectra a second gives a single file a day
+    instead of a text file per spectrum:
+
+        writer = ArchiveWriter('/data', spec.get_serial())
+        writer.log(spec)
+
+        day = ArchiveFile(archive_path('/data', 'S05123', '2016-03-01'))
+        records = day.between(start, end)
+        records['spectrum'], records['timestamp']
+
+    Records are appended in time order, so the timestamp column is the index
+    of the file: a time range is found by a binary search of the memory
+    mapped column and only the pages of the records in the range are read.
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import datetime
+import os
+import struct
+import time
+
+import numpy as np
+
+MAGIC = b'STSARCH1'
+VERSION = 1
+
+# The 64 byte file header: magic, version, pixels per spectrum, size of a
+#    record and the serial number of the device.
+_FILE_HEADER = struct.Struct('<8sHHI16s32x')
+
+
+def record_dtype(pixels=1024):
+    ''' The numpy dtype of a record holding a spectrum of pixels values.
+    '''
+    return np.dtype([('timestamp', '<f8'), ('integration_us', '<u4'),
+                     ('scans_to_avg', '<u2'), ('binning', '<u1'),
+                     ('reserved', '<u1'), ('temperatures', '<f4', (3, )),
+                     ('spectrum', '<u2', (pixels, ))])
+
+
+def archive_path(base_path, serial, day, pixels=1024):
+    ''' The file holding the spectra of serial taken on day (a date, or a
+        'YYYY-MM-DD' string) in UTC. Spectra binned to fewer pixels are kept
+        in their own file.
+    '''
+    if not isinstance(day, str):
+        day = day.strftime('%Y-%m-%d')
+    name = '%s_%s' % (serial, day)
+    if pixels != 1024:
+        name += '_p%d' % pixels
+    return os.path.join(base_path, serial, name + '.sts')
+
+
+class ArchiveWriter(object):
+    """ class ArchiveWriter:
+        Appends spectra of the device serial to the archive in base_path,
+        starting a new file at midnight UTC. If flush is True each record is
+        flushed to the disk as it is written.
+    """
+
+    def __init__(self, base_path, serial, flush=True):
+        self.base_path = base_path
+        self.serial = serial
+        self.flush = flush
+        self.path = None
+        self._file = None
+        self._record = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, spectrum, timestamp=None, integration_us=0,
+               scans_to_avg=1, binning=0, temperatures=None):
+        ''' Appends a spectrum (rounded to uint16 counts) with its metadata.
+            timestamp is in seconds since the epoch, now if not given.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        record = self._prepare(len(spectrum))
+        record['spectrum'][0] = np.rint(spectrum)
+        self._write(record, timestamp, integration_us, scans_to_avg, binning,
+                    temperatures)
+
+    def log(self, spec, line=1, temperatures=True):
+        ''' Takes a raw spectrum from spec and appends it, read straight into
+            the record, with the time it was received, the integration time
+            and scans to average set and (if temperatures is True) the three
+            temperatures of the device.
+        '''
+        record = self._prepare(spec.get_pixel_count(line))
+        spec.get_raw_spectrum(line, out=record['spectrum'][0])
+        timestamp = time.time()
+        if temperatures:
+            temperatures = spec.read_all_temperature(line)
+        else:
+            temperatures = None
+        integration_us = spec.get_integration_time(line) or 0
+        self._write(record, timestamp, integration_us,
+                    spec.get_active_scans_to_avg(line),
+                    spec.get_active_binning_factor(line), temperatures)
+
+    def close(self):
+        ''' Closes the file being written.
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.path = None
+
+    def _prepare(self, pixels):
+        ''' Returns the record buffer for a spectrum of pixels.
+        '''
+        if self._record is None or self._record.dtype != record_dtype(pixels):
+            self._record = np.zeros(1, dtype=record_dtype(pixels))
+        return self._record
+
+    def _write(self, record, timestamp, integration_us, scans_to_avg,
+               binning, temperatures):
+        ''' Fills in the metadata of record and appends it to the file for
+            the day of timestamp, opening it if need be.
+        '''
+        pixels = record['spectrum'].shape[1]
+        path = archive_path(self.base_path, self.serial, _utc_day(timestamp),
+                            pixels)
+        if path != self.path:
+            self.close()
+            self._file = _open_for_append(path, self.serial, pixels)
+            self.path = path
+        record['timestamp'] = timestamp
+        record['integration_us'] = integration_us
+        record['scans_to_avg'] = scans_to_avg
+        record['binning'] = binning
+        if temperatures is None:
+            record['temperatures'] = np.nan
+        else:
+            record['temperatures'][0] = temperatures
+        self._file.write(record.tobytes())
+        if self.flush:
+            self._file.flush()
+
+
+def _open_for_append(path, serial, pixels):
+    ''' Opens the archive file at path to append to, writing the header of a
+        new file. A record left incomplete (by a crash while writing) is cut
+        off so that the records stay aligned.
+    '''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    size = record_dtype(pixels).itemsize
+    if os.path.exists(path) and os.path.getsize(path) >= _FILE_HEADER.size:
+        archive = ArchiveFile(path)
+        if archive.pixels != pixels:
+            raise ValueError('%s holds spectra of %d pixels' %
+                             (path, archive.pixels))
+        count = len(archive)
+        del archive
+        f = open(path, 'r+b')
+        f.truncate(_FILE_HEADER.size + count*size)
+        f.seek(0, os.SEEK_END)
+        return f
+    f = open(path, 'wb')
+    f.write(_FILE_HEADER.pack(MAGIC, VERSION, pixels, size,
+                              serial.encode('ascii')))
+    return f
+
+
+class ArchiveFile(object):
+    """ class ArchiveFile:
+        Reads the archive file at path. records is a structured array of all
+        the complete records, memory mapped so only the parts used are read
+        from the disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(_FILE_HEADER.size)
+        if len(header) < _FILE_HEADER.size:
+            raise ValueError('%s is not an STS archive' % path)
+        magic, version, pixels, size, serial = _FILE_HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError('%s is not an STS archive' % path)
+        if version != VERSION:
+            raise ValueError('%s is an archive of version %d' % (path,
+                                                                 version))
+        self.pixels = pixels
+        self.serial = serial.rstrip(b'\x00').decode('ascii')
+        self.dtype = record_dtype(pixels)
+        count = (os.path.getsize(path) - _FILE_HEADER.size)//size
+        if count == 0:
+            self.records = np.zeros(0, dtype=self.dtype)
+        else:
+            self.records = np.memmap(path, dtype=self.dtype, mode='r',
+                                     offset=_FILE_HEADER.size,
+                                     shape=(count, ))
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    def between(self, start=None, end=None):
+        ''' Returns the records with start <= timestamp < end (either may be
+            None for no limit), as a view of the file.
+        '''
+        first = 0 if start is None else \
+            int(np.searchsorted(self.timestamps, start, 'left'))
+        last = len(self) if end is None else \
+            int(np.searchsorted(self.timestamps, end, 'left'))
+        return self.records[first:last]
+
+
+def read_range(base_path, serial, start, end, pixels=1024):
+    ''' Returns the records of serial with start <= timestamp < end, from
+        each day's file in turn, as a list of arrays (views of the files).
+    '''
+    records = []
+    day = _utc_day(start)
+    last = _utc_day(end)
+    while day <= last:
+        path = archive_path(base_path, serial, day, pixels)
+        if os.path.exists(path):
+            part = ArchiveFile(path).between(start, end)
+            if len(part):
+                records.append(part)
+        day += datetime.timedelta(days=1)
+    return records
+
+
+def _utc_day(timestamp):
+    ''' The date in UTC of a time in seconds since the epoch.
+    '''
+    return datetime.date(*time.gmtime(timestamp)[0:3])
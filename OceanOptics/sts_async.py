@@ -0,0 +1,129 @@
+''' asyncio interface to the STS driver (Python 3.7 or later). AsyncSTSVIS
+    wraps an STSVIS so that its methods can be awaited, the blocking USB
+    transfers run on a worker thread and the waits for the device become
+    awaits, so the event loop keeps running while a spectrum is acquired:
+
+        spec = await AsyncSTSVIS.open()
+        await spec.set_integration_time(100000)
+        spectrum = await spec.get_corrected_spectrum()
+
+    Every method of STSVIS is available and returns an awaitable. Each device
+    has a single worker thread, so commands reach it in the order they were
+    awaited.
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .STS import STSVIS
+
+
+class AsyncSTSVIS(object):
+    """ class AsyncSTSVIS:
+        Awaitable version of the STSVIS spec. Use AsyncSTSVIS.open() to also
+        open the device without blocking the event loop.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.closed = False
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @classmethod
+    async def open(cls, index=0, find=None):
+        ''' Opens the index-th STS (see STSVIS) on a worker thread.
+        '''
+        loop = asyncio.get_running_loop()
+        spec = await loop.run_in_executor(
+            None, functools.partial(STSVIS, index, find))
+        return cls(spec)
+
+    def close(self):
+        ''' Stops any stream and then the worker thread, once the commands
+            already awaited are done. Returns without waiting for them.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self._executor.submit(self.spec.stop_stream)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._run(self.spec.stop_stream)
+        self.close()
+
+    def _run(self, function, *args, **kwargs):
+        ''' Runs function on the worker thread, called from a coroutine.
+        '''
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self._executor, functools.partial(function, *args, **kwargs))
+
+    def __getattr__(self, name):
+        ''' Any other STSVIS method is run on the worker thread.
+        '''
+        method = getattr(self.spec, name)
+        if name.startswith('_') or not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def awaitable(*args, **kwargs):
+            return await self._run(method, *args, **kwargs)
+        return awaitable
+
+    async def get_corrected_spectrum(self, line=1, out=None):
+        ''' Awaits a corrected spectrum, see STSVIS.get_corrected_spectrum.
+        '''
+        return await self._run(self.spec.get_corrected_spectrum, line, out)
+
+    async def get_raw_spectrum(self, line=1, out=None):
+        ''' Awaits a raw spectrum, see STSVIS.get_raw_spectrum.
+        '''
+        return await self._run(self.spec.get_raw_spectrum, line, out)
+
+    async def read_all_temperature(self, line=1):
+        ''' Awaits the three temperatures, see STSVIS.read_all_temperature.
+        '''
+        return await self._run(self.spec.read_all_temperature, line)
+
+    async def reset_device(self, line=1):
+        ''' Resets the device, then sleeps for its reset_time without holding
+            up the event loop.
+        '''
+        await self._run(self.spec.reset_device, line, wait=False)
+        await asyncio.sleep(self.spec.reset_time)
+
+    async def iter_spectra(self, line=1, capacity=64,
+                           overflow='drop_oldest', timeout=None, raw=False):
+        ''' Starts a continuous acquisition (see STSVIS.start_stream) and
+            yields its frames as they arrive, of raw spectra if raw is True.
+            The stream is stopped when the iteration ends.
+        '''
+        stream = await self._run(self.spec.start_stream, line, capacity,
+                                 overflow, raw)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                frame = await loop.run_in_executor(None, stream.get, timeout)
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            await self._run(stream.stop)
@@ -0,0 +1,101 @@
+''' Burst capture of externally triggered STS spectra. In a trigger mode the
+    device only starts a spectrum it has been asked for, so with one request
+    at a time every trigger arriving while the host reads a spectrum and
+    sends the next request is missed. capture_burst keeps depth requests
+    armed on the device, and sends the next as soon as each spectrum arrives
+    (before decoding it), so the device is ready for the next trigger as soon
+    as it has read out the last:
+
+        burst = capture_burst(spec, 100, trigger_period=0.01)
+        burst.spectra, burst.timestamps, burst.missed_triggers
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import collections
+
+import numpy as np
+
+from .STS import STS_Error
+
+# The result of capture_burst. spectra has a row for each spectrum received,
+#    timestamps the time.time() each was received and sequence the number of
+#    the trigger it was taken on, counted from the first. missed_triggers is
+#    the number of triggers between the first and last spectrum which gave
+#    no spectrum, or None if the trigger period was not given.
+Burst = collections.namedtuple('Burst', ['spectra', 'timestamps', 'sequence',
+                                         'missed_triggers', 'complete'])
+
+# Time allowed for a spectrum beyond the trigger period and exposure, in
+#    seconds
+_MARGIN_S = 0.5
+
+
+def capture_burst(spec, count, line=1, depth=2, trigger_mode=1, timeout=None,
+                  trigger_period=None, raw=False):
+    ''' Puts spec in trigger_mode (1 or 2) and collects count spectra, with
+        depth requests armed on the device at a time, then restores the
+        trigger mode it was in. Waits up to timeout seconds for each spectrum,
+        if none arrives the burst ends early with complete False. By default
+        this is two trigger periods plus twice the exposure if trigger_period
+        (in seconds) is given, otherwise as for any triggered spectrum. The
+        gaps between the receive times are used to number the triggers and
+        count those missed if trigger_period is given.
+    '''
+    if trigger_mode not in (1, 2):
+        raise STS_Error('A burst needs trigger mode 1 or 2')
+    if depth < 1:
+        raise ValueError('depth must be at least 1')
+    if timeout is None and trigger_period is not None:
+        timeout = _default_timeout(spec, line, trigger_period)
+    timeout_ms = None if timeout is None else int(timeout*1000)
+
+    spectra = np.zeros((count, spec.get_pixel_count(line)))
+    timestamps = np.zeros(count)
+    previous = spec.get_trigger_mode(line)
+    spec.set_trigger_mode(trigger_mode, line)
+    failed = True
+    try:
+        received = spec.get_triggered_spectra(spectra, timestamps, depth,
+                                              timeout_ms, raw, line)
+        failed = False
+    finally:
+        try:
+            spec.set_trigger_mode(previous, line)
+        except Exception:
+            if not failed:
+                raise
+
+    spectra = spectra[0:received]
+    timestamps = timestamps[0:received]
+    if trigger_period is None or received == 0:
+        sequence = np.arange(received)
+        missed = None
+    else:
+        steps = np.rint(np.diff(timestamps)/trigger_period).astype(int)
+        sequence = np.concatenate(([0], np.cumsum(np.maximum(steps, 1))))
+        missed = int(sequence[-1]) - (received - 1)
+    return Burst(spectra, timestamps, sequence, missed, received == count)
+
+
+def _default_timeout(spec, line, trigger_period):
+    ''' The time in seconds to wait for each spectrum of a burst with
+        triggers every trigger_period seconds, so that one missed trigger
+        does not end it.
+    '''
+    integration_us = spec.get_integration_time(line)
+    if integration_us is None:
+        return None
+    exposure = integration_us*spec.get_active_scans_to_avg(line)*1e-6
+    return 2*trigger_period + 2*exposure + _MARGIN_S
@@ -0,0 +1,218 @@
+''' Calibration data of an STS spectrometer, and a cache of it on disk. Reading
+    the wavelength, non linearity and stray light coefficients, irradiance
+    calibration and hot pixels takes many queries, while they only change
+    when the device is recalibrated, so they are kept in a file per serial
+    number and firmware revision:
+
+        cache = CalibrationCache()
+        calibration = cache.load(spec)
+        bins = calibration.wavelengths()
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import tempfile
+
+import numpy as np
+
+from .STS import STS_DeviceError, bin_pixels
+
+PIXELS = 1024
+
+# The arrays stored for each calibration, in the order of Calibration's
+#    arguments after the serial number and firmware revision.
+_FIELDS = ('wavelength_coeffs', 'nonlin_coeffs', 'stray_light_coeffs',
+           'irradiance', 'irradiance_area', 'hot_pixels')
+
+
+class Calibration(object):
+    """ class Calibration:
+        The calibration stored on one spectrometer. irradiance and
+        irradiance_area are None if the device has no irradiance calibration.
+    """
+
+    def __init__(self, serial, firmware_revision, wavelength_coeffs,
+                 nonlin_coeffs, stray_light_coeffs, irradiance=None,
+                 irradiance_area=None, hot_pixels=()):
+        self.serial = serial
+        self.firmware_revision = firmware_revision
+        self.wavelength_coeffs = np.asarray(wavelength_coeffs, dtype=float)
+        self.nonlin_coeffs = np.asarray(nonlin_coeffs, dtype=float)
+        self.stray_light_coeffs = np.asarray(stray_light_coeffs, dtype=float)
+        if irradiance is not None:
+            irradiance = np.asarray(irradiance, dtype=float)
+        self.irradiance = irradiance
+        self.irradiance_area = irradiance_area
+        self.hot_pixels = np.asarray(hot_pixels, dtype=int)
+
+    def wavelengths(self, binning_factor=0):
+        ''' Returns the wavelength at the centre of each pixel, from the
+            wavelength coefficients, for the binning factor given.
+        '''
+        return bin_pixels(np.polyval(self.wavelength_coeffs[::-1],
+                                     np.arange(PIXELS)), binning_factor)
+
+    def binned_irradiance(self, binning_factor=0):
+        ''' Returns the irradiance calibration of each pixel for the binning
+            factor given, or None if there is none. A binned pixel reads the
+            mean counts of the pixels it combines but is 2**binning_factor
+            times as wide, so its calibration is the sum of theirs and the
+            irradiance of a binned spectrum matches the unbinned one.
+        '''
+        if self.irradiance is None:
+            return None
+        return (1 << binning_factor)*bin_pixels(self.irradiance[0:PIXELS],
+                                                binning_factor)
+
+    def binned_hot_pixels(self, binning_factor=0):
+        ''' Returns the indices of the pixels, for the binning factor given,
+            which include a hot pixel.
+        '''
+        return np.unique(self.hot_pixels >> binning_factor)
+
+    def __eq__(self, other):
+        if not isinstance(other, Calibration):
+            return NotImplemented
+        if (self.serial, self.firmware_revision, self.irradiance_area) != \
+                (other.serial, other.firmware_revision,
+                 other.irradiance_area):
+            return False
+        for name in _FIELDS:
+            if name == 'irradiance_area':
+                continue
+            mine, theirs = getattr(self, name), getattr(other, name)
+            if (mine is None) != (theirs is None):
+                return False
+            if mine is not None and not np.array_equal(mine, theirs):
+                return False
+        return True
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+
+def read_calibration(spec, line=1):
+    ''' Queries the spectrometer spec for all of its calibration data and
+        returns it as a Calibration. A device with no hot pixels stored
+        answers their query with a NACK, which gives an empty index.
+    '''
+    try:
+        hot_pixels = spec.get_hot_pixel_index(line)
+    except STS_DeviceError:
+        hot_pixels = ()
+    return Calibration(spec.get_serial(line),
+                       spec.get_firmware_revision(line),
+                       spec.get_wav_coeffs(line), spec.get_nonlin_coeffs(line),
+                       spec.get_stray_light_coeffs(line),
+                       spec.get_irrad_calib(line),
+                       spec.get_irrad_calib_area(line), hot_pixels)
+
+
+def cache_directory():
+    ''' The directory data kept between runs is stored in by default,
+        $XDG_CACHE_HOME/OceanOptics (~/.cache/OceanOptics).
+    '''
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'OceanOptics')
+
+
+class CalibrationCache(object):
+    """ class CalibrationCache:
+        Keeps the Calibration of each spectrometer in the directory, by
+        default cache_directory(), in a .npz file named by its serial number
+        and firmware revision.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = cache_directory()
+        self.directory = directory
+
+    def path(self, serial, firmware_revision):
+        ''' The file the calibration of the given device is kept in.
+        '''
+        return os.path.join(self.directory, '%s_%04x.npz' %
+                            (serial, firmware_revision))
+
+    def load(self, spec, refresh=False, line=1):
+        ''' Returns the Calibration of spec. Only the serial number and
+            firmware revision are queried if the calibration is in the cache,
+            otherwise (or if refresh is True) it is read from the device and
+            stored.
+        '''
+        serial = spec.get_serial(line)
+        firmware = spec.get_firmware_revision(line)
+        if not refresh:
+            calibration = self.get(serial, firmware)
+            if calibration is not None:
+                return calibration
+        calibration = read_calibration(spec, line)
+        self.save(calibration)
+        return calibration
+
+    def get(self, serial, firmware_revision):
+        ''' Returns the cached Calibration, or None if there is none (or the
+            file cannot be read).
+        '''
+        path = self.path(serial, firmware_revision)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as stored:
+                arrays = dict((name, stored[name]) for name in _FIELDS)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        if len(arrays['irradiance']) == 0:
+            arrays['irradiance'] = None
+        if len(arrays['irradiance_area']) == 0:
+            arrays['irradiance_area'] = None
+        else:
+            arrays['irradiance_area'] = float(arrays['irradiance_area'][0])
+        return Calibration(serial, firmware_revision, **arrays)
+
+    def save(self, calibration):
+        ''' Stores the calibration, replacing any already cached for the
+            device. The file is written under another name and then renamed,
+            so a reader never sees half of it.
+        '''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        arrays = {}
+        for name in _FIELDS:
+            value = getattr(calibration, name)
+            if value is None:
+                value = []
+            arrays[name] = np.atleast_1d(value)
+        handle, temporary = tempfile.mkstemp(suffix='.npz',
+                                             dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, **arrays)
+            os.rename(temporary, self.path(calibration.serial,
+                                           calibration.firmware_revision))
+        except Exception:
+            os.remove(temporary)
+            raise
+
+    def invalidate(self, serial, firmware_revision):
+        ''' Removes the cached calibration of the device, if there is one.
+        '''
+        path = self.path(serial, firmware_revision)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,237 @@
+''' A library of dark spectra for STS spectrometers. Each dark is kept with
+    the serial number, integration time, binning factor and detector
+    temperature it was taken at, and darks for other integration times and
+    temperatures are interpolated from them, so a dark need not be taken
+    before every measurement:
+
+        library = DarkLibrary()
+        library.take_dark(spec)            # With the light blocked
+        library.save()
+        dark = library.dark_for(spec, 250000)
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import collections
+import os
+import tempfile
+
+import numpy as np
+
+from .sts_calibration import cache_directory
+
+# A dark spectrum and the conditions it was taken in
+DarkFrame = collections.namedtuple('DarkFrame', ['serial', 'integration_us',
+                                                 'binning', 'temperature',
+                                                 'spectrum'])
+
+
+class DarkLibrary(object):
+    """ class DarkLibrary:
+        Dark spectra by serial number and binning factor, loaded from and
+        saved to path (by default darks.npz in cache_directory()). Darks taken
+        within temperature_step degrees C of each other count as the same
+        temperature.
+    """
+
+    def __init__(self, path=None, temperature_step=0.5):
+        if path is None:
+            path = os.path.join(cache_directory(), 'darks.npz')
+        self.path = path
+        self.temperature_step = temperature_step
+        self.frames = []
+        self._interpolated = {}
+        if os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, serial, integration_us, binning, temperature, spectrum):
+        ''' Adds a dark spectrum, replacing one taken with the same serial,
+            integration time, binning and (within temperature_step)
+            temperature.
+        '''
+        frame = DarkFrame(serial, int(integration_us), int(binning),
+                          float(temperature),
+                          np.array(spectrum, dtype=float))
+        self.frames = [old for old in self.frames
+                       if not self._same(old, frame)]
+        self.frames.append(frame)
+        self._interpolated.clear()
+        return frame
+
+    def take_dark(self, spec, line=1):
+        ''' Takes a spectrum from spec with its current settings, which must
+            be with no light reaching the detector, and adds it.
+        '''
+        spectrum = spec.get_corrected_spectrum(line)
+        integration_us = spec.get_integration_time(line)
+        if integration_us is None:
+            raise ValueError('Set the integration time before taking a dark')
+        return self.add(spec.get_serial(line), integration_us,
+                        spec.get_active_binning_factor(line),
+                        spec.read_temperature_sensor(0, line), spectrum)
+
+    def dark(self, serial, integration_us, binning=0, temperature=None):
+        ''' Returns the dark spectrum for the conditions given. Each pixel is
+            interpolated linearly in integration time between the darks at
+            each temperature, and then linearly in temperature (the nearest
+            is used outside the range taken). Other integration times are
+            only extrapolated from darks taken at two or more, so a
+            temperature with darks at just one is only used for that one.
+            The temperature is rounded to a multiple of temperature_step, the
+            interpolated darks being kept for each. If temperature is None
+            the darks at all temperatures are used as one. Raises KeyError if
+            there is no dark for the serial and binning, or none which can
+            give the integration time. Returns a new array each call.
+        '''
+        integration_us = int(integration_us)
+        if temperature is not None:
+            temperature = (round(temperature/self.temperature_step)*
+                           self.temperature_step)
+        key = (serial, integration_us, binning, temperature)
+        if key in self._interpolated:
+            return self._interpolated[key].copy()
+
+        frames = [frame for frame in self.frames
+                  if frame.serial == serial and frame.binning == binning]
+        if not frames:
+            raise KeyError('No dark for %s with binning %d' % (serial,
+                                                               binning))
+        if temperature is None:
+            result = _interpolate_time(frames, integration_us)
+        else:
+            groups = collections.defaultdict(list)
+            for frame in frames:
+                groups[round(frame.temperature/self.temperature_step)].append(
+                    frame)
+            levels = []
+            darks = []
+            for level in sorted(groups):
+                dark = _interpolate_time(groups[level], integration_us)
+                if dark is not None:
+                    levels.append(level)
+                    darks.append(dark)
+            result = None
+            if darks:
+                result = _interpolate(np.array(levels)*self.temperature_step,
+                                      darks, temperature)
+        if result is None:
+            raise KeyError('No dark for %s can give %d us, take one at that '
+                           'integration time or at two others' %
+                           (serial, integration_us))
+        self._interpolated[key] = result
+        return result.copy()
+
+    def dark_for(self, spec, integration_us=None, line=1):
+        ''' Returns the dark for spec at its current binning and detector
+            temperature, for integration_us or else the integration time it
+            is set to.
+        '''
+        if integration_us is None:
+            integration_us = spec.get_integration_time(line)
+            if integration_us is None:
+                raise ValueError('The integration time is not known')
+        return self.dark(spec.get_serial(line), integration_us,
+                         spec.get_active_binning_factor(line),
+                         spec.read_temperature_sensor(0, line))
+
+    def save(self, path=None):
+        ''' Writes the library to path (by default the one it was loaded
+            from). The file is written under another name and then renamed.
+        '''
+        if path is None:
+            path = self.path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        arrays = {
+            'serial': np.array([frame.serial for frame in self.frames],
+                               dtype=np.str_),
+            'integration_us': np.array([frame.integration_us
+                                        for frame in self.frames], dtype=int),
+            'binning': np.array([frame.binning for frame in self.frames],
+                                dtype=int),
+            'temperature': np.array([frame.temperature
+                                     for frame in self.frames]),
+        }
+        for index, frame in enumerate(self.frames):
+            arrays['spectrum_%d' % index] = frame.spectrum
+        handle, temporary = tempfile.mkstemp(suffix='.npz', dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, **arrays)
+            os.rename(temporary, path)
+        except Exception:
+            os.remove(temporary)
+            raise
+
+    def load(self, path=None):
+        ''' Replaces the darks with those stored in path (by default the
+            library's path).
+        '''
+        if path is None:
+            path = self.path
+        with np.load(path) as stored:
+            self.frames = [DarkFrame(str(stored['serial'][index]),
+                                     int(stored['integration_us'][index]),
+                                     int(stored['binning'][index]),
+                                     float(stored['temperature'][index]),
+                                     stored['spectrum_%d' % index])
+                           for index in range(len(stored['serial']))]
+        self._interpolated.clear()
+
+    def _same(self, one, other):
+        return one.serial == other.serial and \
+            one.integration_us == other.integration_us and \
+            one.binning == other.binning and \
+            round(one.temperature/self.temperature_step) == \
+            round(other.temperature/self.temperature_step)
+
+
+def _interpolate_time(frames, integration_us):
+    ''' The dark at integration_us from frames taken at the same temperature,
+        the mean of those taken at each integration time being used. None if
+        they were all taken at another integration time, as the dark current
+        can't be told from the offset with one.
+    '''
+    times = collections.defaultdict(list)
+    for frame in frames:
+        times[frame.integration_us].append(frame.spectrum)
+    levels = sorted(times)
+    if len(levels) == 1 and levels[0] != integration_us:
+        return None
+    darks = [np.mean(times[level], axis=0) for level in levels]
+    return _interpolate(np.array(levels, dtype=float), darks, integration_us,
+                        extrapolate=True)
+
+
+def _interpolate(points, darks, value, extrapolate=False):
+    ''' Interpolates linearly between the darks taken at the sorted points.
+        Outside them the nearest two are extrapolated if extrapolate is True
+        (the dark grows linearly with integration time), otherwise the
+        nearest dark is returned.
+    '''
+    if len(points) == 1:
+        return darks[0]
+    if not extrapolate:
+        if value <= points[0]:
+            return darks[0]
+        if value >= points[-1]:
+            return darks[-1]
+    upper = int(np.clip(np.searchsorted(points, value), 1, len(points) - 1))
+    lower = upper - 1
+    fraction = (value - points[lower])/(points[upper] - points[lower])
+    return darks[lower] + fraction*(darks[upper] - darks[lower])
@@ -0,0 +1,111 @@
+''' Automatic exposure for the STS. auto_expose finds the integration time
+    which puts the brightest pixel at a target fraction of full scale. Each
+    shot measures the counts per microsecond at the peak, from which the
+    integration time for the target is predicted, so it usually converges in
+    two or three spectra:
+
+        result = auto_expose(spec, target=0.8)
+        print(result.integration_time_us, result.shots)
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import collections
+import time
+
+import numpy as np
+
+from .sts_planner import MAX_COUNTS, MIN_INTEGRATION_US, MAX_INTEGRATION_US
+
+# The outcome of auto_expose. The device is left at integration_time_us,
+#    peak_counts is the peak of the last spectrum taken and converged is
+#    False if the target was not reached (too dark or bright for the limits
+#    of the integration time, or out of time or shots).
+ExposureResult = collections.namedtuple('ExposureResult', [
+    'integration_time_us', 'peak_counts', 'shots', 'converged', 'elapsed_s'])
+
+# Largest change of the integration time in one step, as the counts of a
+#    very dark spectrum give a poor estimate of the slope.
+_MAX_STEP = 50.0
+# Step down after a saturated spectrum, whose slope is unknown.
+_SATURATED_STEP = 8.0
+
+
+def auto_expose(spec, target=0.8, tolerance=0.05, start_us=None,
+                dark_level=1500.0, budget_s=5.0, max_shots=10,
+                saturation=0.98*MAX_COUNTS, line=1):
+    ''' Adjusts the integration time of spec until the peak of the corrected
+        spectrum is within tolerance (a fraction of full scale) of target.
+        Starts from start_us, or the integration time set. dark_level is
+        the counts with no light, refined from the spectra once two have
+        been taken. Stops after max_shots spectra, or before a spectrum that
+        would end after budget_s seconds.
+    '''
+    start = time.time()
+    integration_us = start_us or spec.get_integration_time(line) or 10000
+    integration_us = int(np.clip(integration_us, MIN_INTEGRATION_US,
+                                 MAX_INTEGRATION_US))
+    scans = spec.get_active_scans_to_avg(line)
+    goal = target*MAX_COUNTS
+    shots = []  # (integration time, peak) of unsaturated spectra
+    peak = None
+    taken = 0
+
+    while taken < max_shots:
+        expected = scans*integration_us*1e-6 + 0.005
+        if taken and time.time() - start + expected > budget_s:
+            break
+        spec.set_integration_time(integration_us, line)
+        spectrum = spec.get_corrected_spectrum(line)
+        taken += 1
+        peak = float(np.max(spectrum))
+
+        if peak >= saturation:
+            following = integration_us/_SATURATED_STEP
+        else:
+            if abs(peak - goal) <= tolerance*MAX_COUNTS:
+                return ExposureResult(integration_us, peak, taken, True,
+                                      time.time() - start)
+            shots.append((integration_us, peak))
+            offset, rate = _fit(shots, dark_level)
+            if rate <= 0:
+                following = integration_us*_MAX_STEP
+            else:
+                following = (goal - offset)/rate
+            following = min(max(following, integration_us/_MAX_STEP),
+                            integration_us*_MAX_STEP)
+        following = int(np.clip(following, MIN_INTEGRATION_US,
+                                 MAX_INTEGRATION_US))
+        if following == integration_us:
+            break  # At a limit of the integration time
+        integration_us = following
+
+    return ExposureResult(spec.get_integration_time(line), peak, taken,
+                          False, time.time() - start)
+
+
+def _fit(shots, dark_level):
+    ''' Returns the dark offset and counts per microsecond of the peak from
+        the unsaturated shots, a line through the last two if their
+        integration times differ, otherwise from dark_level.
+    '''
+    integration_us, peak = shots[-1]
+    for earlier_us, earlier in reversed(shots[:-1]):
+        if earlier_us != integration_us:
+            rate = (peak - earlier)/float(integration_us - earlier_us)
+            offset = peak - rate*integration_us
+            if rate > 0 and 0 <= offset < peak:
+                return offset, rate
+            break
+    return dark_level, (peak - dark_level)/float(integration_us)
@@ -0,0 +1,174 @@
+''' Acquisition from several STS spectrometers at once. The STSManager opens
+    every connected spectrometer in its own worker thread and runs commands on
+    all of them in parallel, so taking a spectrum from each of n heads costs
+    the time of one acquisition rather than n of them:
+
+        manager = STSManager()
+        manager.call('set_integration_time', 100000)
+        frames = manager.acquire()
+        frames.frames['S05123'].spectrum
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import collections
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .STS import STSVIS, STS_Error, find_devices
+from .sts_stream import Frame
+
+# The spectra acquired together by STSManager.acquire, timestamp is the
+#    time.time() the requests were sent and frames maps the serial number of
+#    each spectrometer to its Frame.
+FrameSet = collections.namedtuple('FrameSet', ['timestamp', 'sequence',
+                                               'frames'])
+
+
+class STSManager(object):
+    """ class STSManager:
+        Opens every connected STS (or the indices given) with one worker
+        thread per device. The devices are available by serial number in
+        the devices dictionary, in the order found in serials.
+    """
+
+    def __init__(self, indices=None, find=None, line=1):
+        if indices is None:
+            indices = range(len(find_devices(find)))
+        if not indices:
+            raise STS_Error('No OceanOptics STS-VIS spectrometer found!')
+        self.line = line
+        self.sequence = 0
+
+        workers = [_Worker(index, find) for index in indices]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.opened.wait()
+        errors = [worker.error for worker in workers if worker.error]
+        if errors:
+            for worker in workers:
+                worker.requests.put(None)
+            raise errors[0]
+
+        self._workers = collections.OrderedDict(
+            (worker.serial, worker) for worker in workers)
+        self.serials = list(self._workers)
+        self.devices = dict((serial, worker.spec)
+                            for serial, worker in self._workers.items())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def call(self, method, *args, **kwargs):
+        ''' Calls the STSVIS method (a name, or a function taking the STSVIS
+            as its first argument) on every device in parallel. Returns a
+            dictionary of the results by serial number. If any device raised
+            an error, the first one is raised once all have finished.
+        '''
+        if not callable(method):
+            method = getattr(STSVIS, method)
+        for worker in self._workers.values():
+            worker.requests.put((method, args, kwargs))
+        results = {}
+        error = None
+        for serial, worker in self._workers.items():
+            ok, result = worker.results.get()
+            if ok:
+                results[serial] = result
+            elif error is None:
+                error = result
+        if error is not None:
+            raise error
+        return results
+
+    def acquire(self, raw=False):
+        ''' Requests a spectrum from every device at the same time and returns
+            them as a FrameSet. Each Frame has the time its spectrum was
+            received.
+        '''
+        sequence = self.sequence
+        self.sequence += 1
+        start = time.time()
+        results = self.call(_acquire, self.line, raw, sequence)
+        return FrameSet(start, sequence, results)
+
+    def iter_frame_sets(self, count=None, raw=False):
+        ''' Yields FrameSets acquired back to back, count of them or forever
+            if count is None.
+        '''
+        taken = 0
+        while count is None or taken < count:
+            yield self.acquire(raw)
+            taken += 1
+
+    def close(self):
+        ''' Stops the worker threads.
+        '''
+        for worker in self._workers.values():
+            worker.requests.put(None)
+        for worker in self._workers.values():
+            worker.join()
+
+
+def _acquire(spec, line, raw, sequence):
+    if raw:
+        spectrum = spec.get_raw_spectrum(line)
+    else:
+        spectrum = spec.get_corrected_spectrum(line)
+    return Frame(time.time(), sequence, spectrum)
+
+
+class _Worker(threading.Thread):
+    ''' Opens the device with the given index and then runs the requests
+        put on its queue one at a time, putting (ok, result) on results.
+    '''
+
+    def __init__(self, index, find):
+        threading.Thread.__init__(self, name='STS worker %d' % index)
+        self.daemon = True
+        self.index = index
+        self.find = find
+        self.spec = None
+        self.serial = None
+        self.error = None
+        self.opened = threading.Event()
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+
+    def run(self):
+        try:
+            self.spec = STSVIS(self.index, self.find)
+            self.serial = self.spec.get_serial()
+        except Exception as error:
+            self.error = error
+        self.opened.set()
+
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            method, args, kwargs = request
+            try:
+                self.results.put((True, method(self.spec, *args, **kwargs)))
+            except Exception as error:
+                self.results.put((False, error))
@@ -0,0 +1,169 @@
+''' Planning of an STS acquisition. Averaging can be done on the device (scans
+    to average, up to 5000 per spectrum) or on the host (taking a spectrum
+    several times). plan_acquisition chooses the integration time, scans to
+    average and host repeats which reach a total exposure or signal to noise
+    goal in the least time, with the fewest spectra sent over USB and without
+    saturating the detector:
+
+        plan = plan_acquisition(total_exposure_s=30, peak_rate=2e5)
+        print(plan.report())
+        spectrum = run_plan(spec, plan)
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import collections
+import math
+
+import numpy as np
+
+MAX_COUNTS = 16383
+MIN_INTEGRATION_US = 10
+MAX_INTEGRATION_US = 10000000
+MAX_SCANS_TO_AVG = 5000
+
+
+class AcquisitionPlan(collections.namedtuple('AcquisitionPlan', [
+        'integration_time_us', 'scans_to_avg', 'repeats', 'expected_time_s',
+        'expected_snr', 'peak_counts'])):
+    """ class AcquisitionPlan:
+        The settings chosen by plan_acquisition. repeats spectra are taken on
+        the host, each the average of scans_to_avg scans on the device.
+        expected_snr and peak_counts are None if the signal was not given.
+    """
+
+    @property
+    def total_exposure_s(self):
+        return self.integration_time_us*1e-6*self.scans_to_avg*self.repeats
+
+    def report(self):
+        ''' Returns a description of the plan to show before running it.
+        '''
+        text = '%d x %d scans of %g ms: %.3f s of exposure in about %.3f s' % \
+            (self.repeats, self.scans_to_avg, self.integration_time_us/1e3,
+             self.total_exposure_s, self.expected_time_s)
+        if self.expected_snr is not None:
+            text += ', peak %.0f counts, SNR %.1f' % (self.peak_counts,
+                                                      self.expected_snr)
+        return text
+
+
+def plan_acquisition(total_exposure_s=None, snr=None, peak_rate=None,
+                     dark_level=1500.0, read_noise=12.0, headroom=0.9,
+                     readout_s=0.001, transfer_s=0.003):
+    ''' Plans an acquisition with at least total_exposure_s seconds of
+        integration and (if snr is given) a signal to noise ratio of snr at
+        the brightest pixel. peak_rate is the counts per second above the dark
+        level at that pixel, so that the counts stay below headroom of the
+        full scale; it is needed for an snr goal. dark_level and read_noise
+        are in counts. readout_s is the time the device takes to read out a
+        scan, transfer_s the time to request and transfer a spectrum.
+    '''
+    if total_exposure_s is None and snr is None:
+        raise ValueError('A total exposure or a signal to noise goal is '
+                         'needed')
+    if total_exposure_s is not None and total_exposure_s <= 0:
+        raise ValueError('total_exposure_s must be positive')
+    if snr is not None and snr <= 0:
+        raise ValueError('snr must be positive')
+    if peak_rate is not None and peak_rate < 0:
+        raise ValueError('peak_rate must not be negative')
+    if snr is not None and not peak_rate:
+        raise ValueError('peak_rate is needed to plan for a signal to noise '
+                         'ratio')
+
+    longest = MAX_INTEGRATION_US*1e-6
+    if peak_rate:
+        longest = min(longest, (headroom*MAX_COUNTS - dark_level)/peak_rate)
+        if longest < MIN_INTEGRATION_US*1e-6:
+            raise ValueError('The signal saturates at the shortest '
+                             'integration time')
+    # The longest scans make best use of the time, as every scan adds read
+    #    noise and readout time, but no longer than the goal needs.
+    if total_exposure_s is not None:
+        seconds = min(longest, total_exposure_s)
+    else:
+        signal = _signal_for_snr(snr, read_noise)
+        seconds = min(longest, signal/peak_rate)
+    scans = 1
+    if total_exposure_s is not None:
+        scans = int(math.ceil(total_exposure_s/seconds - 1e-9))
+        seconds = total_exposure_s/scans  # Spread evenly over the scans
+    integration_us = int(math.ceil(min(max(seconds*1e6, MIN_INTEGRATION_US),
+                                       MAX_INTEGRATION_US)))
+    seconds = integration_us*1e-6
+
+    expected_snr = peak_counts = None
+    if peak_rate:
+        scan_snr = _scan_snr(peak_rate*seconds, read_noise)
+        if snr is not None and scan_snr*math.sqrt(scans) < snr:
+            scans = int(math.ceil((snr/scan_snr)**2 - 1e-9))
+            # Only as long as the goal needs with this many scans
+            needed = _signal_for_snr(snr/math.sqrt(scans),
+                                     read_noise)/peak_rate
+            if total_exposure_s is not None:
+                needed = max(needed, total_exposure_s/scans)
+            integration_us = int(math.ceil(min(
+                max(needed*1e6, MIN_INTEGRATION_US), integration_us)))
+            seconds = integration_us*1e-6
+            scan_snr = _scan_snr(peak_rate*seconds, read_noise)
+        peak_counts = dark_level + peak_rate*seconds
+
+    # As few spectra as possible are sent, each averaging up to the most
+    #    scans the device allows.
+    repeats = int(math.ceil(scans/float(MAX_SCANS_TO_AVG)))
+    scans_to_avg = int(math.ceil(scans/float(repeats)))
+    if peak_rate:
+        expected_snr = math.sqrt(repeats*scans_to_avg)*scan_snr
+    expected_time = repeats*(transfer_s + scans_to_avg*(seconds + readout_s))
+    return AcquisitionPlan(integration_us, scans_to_avg, repeats,
+                           expected_time, expected_snr, peak_counts)
+
+
+def estimate_peak_rate(spectrum, integration_time_us, dark=None,
+                       dark_level=1500.0):
+    ''' Estimates the peak_rate for plan_acquisition from a spectrum taken
+        with integration_time_us, less the dark spectrum (or dark_level).
+    '''
+    if dark is None:
+        dark = dark_level
+    signal = float(np.max(np.asarray(spectrum) - dark))
+    return max(signal, 0.0)/(integration_time_us*1e-6)
+
+
+def run_plan(spec, plan, line=1):
+    ''' Applies the plan to spec and returns the mean of its repeats
+        spectra.
+    '''
+    spec.set_integration_time(plan.integration_time_us, line)
+    spec.set_scans_to_avg(plan.scans_to_avg, line)
+    total = spec.get_corrected_spectrum(line)
+    if plan.repeats > 1:
+        spectrum = np.empty(len(total))
+        for repeat in range(plan.repeats - 1):
+            total += spec.get_corrected_spectrum(line, out=spectrum)
+    return total/plan.repeats
+
+
+def _scan_snr(signal, read_noise):
+    ''' The signal to noise ratio of a single scan with signal counts.
+    '''
+    return signal/math.sqrt(read_noise**2 + signal)
+
+
+def _signal_for_snr(snr, read_noise):
+    ''' The signal in counts for which a single scan has the given signal to
+        noise ratio, with shot noise and read noise.
+    '''
+    return (snr**2 + math.sqrt(snr**4 + 4*snr**2*read_noise**2))/2
@@ -0,0 +1,142 @@
+''' Processing of STS spectra into calibrated irradiance. A SpectrumProcessor
+    is built once from a device's Calibration (see sts_calibration) and then
+    applies the dark subtraction, hot pixel repair, non linearity correction
+    and irradiance calibration of sts_utils to each spectrum in a single pass
+    over preallocated buffers:
+
+        processor = SpectrumProcessor(calibration, 0.1, dark)
+        irradiance = processor.process(spec.get_corrected_spectrum())
+
+    A 2-D stack of spectra (one per row) is processed in the same way.
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import numpy as np
+
+from . import sts_trace
+from . import sts_utils
+from .STS import bin_pixels
+
+
+class SpectrumProcessor(object):
+    """ class SpectrumProcessor:
+        Turns spectra of counts into irradiance using calibration, for spectra
+        integrated over integration_sec seconds. dark is the dark spectrum in
+        counts per second (as used by sts_utils.do_non_lin), or None. If the
+        device has no irradiance calibration the result is the linearised
+        counts. Hot pixels are replaced by the mean of their neighbours
+        unless fix_hot_pixels is False. For spectra taken with pixel binning
+        the binning_factor of the device is given, a dark spectrum taken
+        without binning is then binned to match.
+    """
+
+    def __init__(self, calibration, integration_sec, dark=None,
+                 fix_hot_pixels=True, binning_factor=0):
+        self.calibration = calibration
+        self.binning_factor = binning_factor
+        self.wavelengths = calibration.wavelengths(binning_factor)
+        self.pixels = len(self.wavelengths)
+        self.bin_factor = sts_utils.find_bin_factor(self.wavelengths)
+        # Highest order first, as evaluated by Horner's method
+        self._nonlin = np.asarray(calibration.nonlin_coeffs, dtype=float)[::-1]
+
+        self.hot_pixel_mask = np.zeros(self.pixels, dtype=bool)
+        if fix_hot_pixels:
+            hot = calibration.binned_hot_pixels(binning_factor)
+            self.hot_pixel_mask[hot[(hot >= 0) & (hot < self.pixels)]] = True
+        self._hot, self._left, self._right = _neighbours(self.hot_pixel_mask)
+
+        if dark is not None:
+            dark = np.asarray(dark, dtype=float)
+            if dark.shape[-1] != self.pixels:
+                dark = bin_pixels(dark, binning_factor)
+        self._dark = dark
+        self._scratch = {}
+        self.set_integration_time(integration_sec)
+
+    def set_integration_time(self, integration_sec):
+        ''' Recomputes the dark offset and the irradiance multiplication for
+            spectra integrated over integration_sec seconds.
+        '''
+        self.integration_sec = integration_sec
+        if self._dark is None:
+            self.dark_offset = None
+        else:
+            self.dark_offset = self._dark*integration_sec
+        irradiance = self.calibration.binned_irradiance(self.binning_factor)
+        if irradiance is None:
+            self.multiplication = None
+        else:
+            self.multiplication = sts_utils.get_multiplication(
+                self.calibration.serial, self.bin_factor, irradiance,
+                integration_sec)
+
+    def process(self, spectra, out=None):
+        ''' Processes a spectrum, or a 2-D array with a spectrum per row, and
+            returns the result in out (which may be spectra itself) or a new
+            array.
+        '''
+        spectra = np.asarray(spectra)
+        if out is None:
+            out = np.empty(spectra.shape)
+        with sts_trace.span('dark'):
+            if self.dark_offset is None:
+                if out is not spectra:
+                    out[...] = spectra
+            else:
+                np.subtract(spectra, self.dark_offset, out=out)
+            if len(self._hot):
+                out[..., self._hot] = 0.5*(out[..., self._left] +
+                                           out[..., self._right])
+        with sts_trace.span('nonlinearity'):
+            self.linearise(out, out)
+        if self.multiplication is not None:
+            with sts_trace.span('calibration'):
+                out *= self.multiplication
+        return out
+
+    def linearise(self, counts, out=None):
+        ''' Divides the dark subtracted counts by the non linearity
+            polynomial of the device, evaluated in place by Horner's method.
+        '''
+        if out is None:
+            out = np.empty(np.shape(counts))
+        if len(self._nonlin) == 0:
+            out[...] = counts
+            return out
+        poly = self._scratch.get(out.shape)
+        if poly is None:
+            poly = self._scratch[out.shape] = np.empty(out.shape)
+        poly.fill(self._nonlin[0])
+        for coeff in self._nonlin[1:]:
+            poly *= counts
+            poly += coeff
+        np.divide(counts, poly, out=out)
+        return out
+
+
+def _neighbours(mask):
+    ''' Returns the indices of the pixels set in mask, and of the nearest
+        pixel to the left and right of each that is not set.
+    '''
+    hot = np.flatnonzero(mask)
+    good = np.flatnonzero(~mask)
+    if len(hot) == 0 or len(good) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), \
+            np.zeros(0, dtype=int)
+    place = np.searchsorted(good, hot)
+    left = good[np.clip(place - 1, 0, len(good) - 1)]
+    right = good[np.clip(place, 0, len(good) - 1)]
+    return hot, left, right
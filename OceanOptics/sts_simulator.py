@@ -0,0 +1,591 @@
+''' Loopback simulator for the OceanOptics STS-VIS spectrometer. It speaks the
+    same Ocean Binary Protocol (OBP) packets as the real device, so it can be
+    handed to the driver in place of usb.core.find:
+
+        sim = STSSimulator()
+        spec = STSVIS(find=sim.find)
+
+    The simulator decodes the 64 byte packets produced by the driver, answers
+    every message type the driver uses and models the integration time, scan
+    averaging and USB transfer time of the real device, so it can be used to
+    benchmark and profile the driver without a spectrometer connected.
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import array
+import struct
+import threading
+import time
+
+import numpy as np
+import usb.core
+
+# Flags used in the OBP header
+RESPONSE_FLAG = 1
+ACK_FLAG = 2
+ACK_REQUESTED_FLAG = 4
+NACK_FLAG = 8
+
+# Layout of the 44 byte header and the 20 byte footer of an OBP message
+_HEADER = struct.Struct('<2B2BHHI4B6xBB16sI')
+_FOOTER = struct.Struct('<16s4B')
+_FOOTER_BYTES = b'\xc5\xc4\xc3\xc2'
+
+PIXELS = 1024
+MAX_COUNTS = 16383
+
+
+class STSSimulator(object):
+    """ class STSSimulator:
+        A stand in for the usb.core.Device of an STS-VIS. Writes to the OUT
+        endpoints (0x01, 0x02) are decoded as OBP messages and the replies
+        are queued on the matching IN endpoint (0x81, 0x82). A read blocks
+        until the reply is ready, which for spectra is after the integration
+        time multiplied by the number of scans to average.
+
+        The timing parameters are in seconds:
+            command_latency: time for the device to process a message.
+            packet_time: USB transfer time of a single 64 byte packet.
+            readout_time: detector readout time for each scan.
+
+        Faults of the USB link can be injected: the next lost_replies replies
+        are never sent, the next corrupted_replies have a damaged footer and
+        inject_stale_data puts bytes on a line ahead of the replies.
+    """
+
+    def __init__(self, serial='S05123', seed=0, command_latency=0.0005,
+                 packet_time=0.00005, readout_time=0.001):
+        self.serial = serial
+        self.command_latency = command_latency
+        self.packet_time = packet_time
+        self.readout_time = readout_time
+
+        self.idVendor = 0x2457
+        self.idProduct = 0x4000
+
+        self.hardware_revision = 2
+        self.firmware_revision = 0x0104
+        self.alias = ''
+        self.user_strings = ['']
+        self.user_string_length = 16
+        self.bench_id = 'STS-VIS'
+        self.bench_serial = 'B' + serial
+        self.slit_width = 25
+        self.fiber_diameter = 400
+        self.grating = 'Grating #1'
+        self.filter = 'None'
+        self.coating = 'None'
+        self.gpio_pins = 8
+
+        self.wav_coeffs = [337.0, 0.4653, -1.87e-5, -2.5e-9]
+        self.nonlin_coeffs = [0.95, 1.2e-5, -2.1e-9, 1.5e-13, -4.0e-18,
+                              0.0, 0.0, 0.0]
+        self.stray_light_coeffs = [0.0]
+        self.irrad_calib = list(np.linspace(2.0e-6, 8.0e-7, PIXELS))
+        self.irrad_area = 0.001257
+        self.hot_pixels = [17, 311, 640]
+        self.temperatures = [22.5, 0.0, 31.0]
+
+        # Light falling on the detector, in counts per second of integration
+        # at each pixel, and the electronic offset of the ADC.
+        pixels = np.arange(PIXELS)
+        self.signal_rate = 12000.0*np.exp(-((pixels - 480.0)/220.0)**2)
+        self.dark_level = 1500.0
+        self.read_noise = 12.0
+
+        self._rng = np.random.RandomState(seed)
+        self._lock = threading.Condition()
+        self._in_buffers = {0x01: bytearray(), 0x02: bytearray()}
+        self._replies = {0x81: [], 0x82: []}
+        self._waiting_trigger = []
+        self._acquiring_until = 0.0
+        self.triggers = 0
+        self.missed_triggers = 0
+        self._busy_until = 0.0
+        self.lost_replies = 0
+        self.corrupted_replies = 0
+        self.reset_defaults()
+
+        self._handlers = {
+            0x00000000: self._reset,
+            0x00000001: self._reset_defaults,
+            0x00000080: lambda msg: self._u8(self.hardware_revision),
+            0x00000090: lambda msg: struct.pack('<H', self.firmware_revision),
+            0x00000100: lambda msg: self._text(self.serial),
+            0x00000101: lambda msg: self._u8(16),
+            0x00000200: lambda msg: self._text(self.alias),
+            0x00000201: lambda msg: self._u8(16),
+            0x00000210: self._set_alias,
+            0x00000300: lambda msg: self._u8(len(self.user_strings)),
+            0x00000301: lambda msg: struct.pack('<H',
+                                                self.user_string_length),
+            0x00000302: self._get_user_string,
+            0x00000310: self._set_user_string,
+            0x00001010: lambda msg: None,
+            0x000FFF00: lambda msg: None,
+            0x00101000: self._spectrum,
+            0x00101100: self._spectrum,
+            0x00100928: self._spectrum,
+            0x00102080: self._get_partial_mode,
+            0x00102090: self._set_partial_mode,
+            0x00110010: self._set_setting('integration_time_us', '<I', 10,
+                                          10000000),
+            0x00110110: self._set_setting('trigger_mode', '<B', 0, 2),
+            0x00110120: self._trigger_pulse,
+            0x00110280: lambda msg: self._u8(self.binning_factor),
+            0x00110281: lambda msg: self._u8(3),
+            0x00110285: lambda msg: self._u8(self.default_binning_factor),
+            0x00110290: self._set_setting('binning_factor', '<B', 0, 3),
+            0x00110295: self._set_default_binning,
+            0x00110410: self._set_setting('lamp_enable', '<B', 0, 1),
+            0x00110510: self._set_setting('trigger_delay_us', '<I', 0,
+                                          32000000),
+            0x00120000: lambda msg: struct.pack(
+                '<H', self.scans_to_avg[msg['line']]),
+            0x00120010: self._set_line_setting('scans_to_avg', '<H', 1,
+                                               5000),
+            0x00121000: lambda msg: self._u8(self.boxcar[msg['line']]),
+            0x00121010: self._set_line_setting('boxcar', '<B', 0, 15),
+            0x00180100: lambda msg: self._u8(len(self.wav_coeffs)),
+            0x00180101: self._get_coeff('wav_coeffs'),
+            0x00180111: self._set_coeff('wav_coeffs'),
+            0x00181100: lambda msg: self._u8(len(self.nonlin_coeffs)),
+            0x00181101: self._get_coeff('nonlin_coeffs'),
+            0x00181111: self._set_coeff('nonlin_coeffs'),
+            0x00182001: self._get_irrad_calib,
+            0x00182002: lambda msg: struct.pack('<I', len(self.irrad_calib)),
+            0x00182003: self._get_irrad_area,
+            0x00182010: self._set_irrad_calib,
+            0x00182011: self._set_irrad_area,
+            0x00183100: lambda msg: self._u8(len(self.stray_light_coeffs)),
+            0x00183101: self._get_coeff('stray_light_coeffs'),
+            0x00183111: self._set_coeff('stray_light_coeffs'),
+            0x00186000: self._get_hot_pixels,
+            0x00186010: self._set_hot_pixels,
+            0x001B0000: lambda msg: self._text(self.bench_id),
+            0x001B0100: lambda msg: self._text(self.bench_serial),
+            0x001B0200: lambda msg: struct.pack('<H', self.slit_width),
+            0x001B0300: lambda msg: struct.pack('<H', self.fiber_diameter),
+            0x001B0400: lambda msg: self._text(self.grating),
+            0x001B0500: lambda msg: self._text(self.filter),
+            0x001B0600: lambda msg: self._text(self.coating),
+            0x00200000: lambda msg: self._u8(self.gpio_pins),
+            0x00400000: lambda msg: self._u8(len(self.temperatures)),
+            0x00400001: self._read_temperature,
+            0x00400002: lambda msg: struct.pack('<3f', *self.temperatures),
+        }
+
+    def reset_defaults(self):
+        ''' Puts the acquisition settings back to their power on values.
+        '''
+        self.integration_time_us = 100000
+        self.trigger_mode = 0
+        self.trigger_delay_us = 0
+        self.binning_factor = 0
+        self.default_binning_factor = 0
+        self.lamp_enable = 0
+        self.scans_to_avg = {1: 1, 2: 1}
+        self.boxcar = {1: 0, 2: 0}
+        self.partial_ranges = None
+
+    # ################################################# #
+    #   The part of the usb.core.Device interface used  #
+    # ################################################# #
+
+    def find(self, find_all=False, idVendor=None, idProduct=None):
+        ''' Drop in replacement for usb.core.find returning this simulator.
+        '''
+        return simulated_bus([self])(find_all, idVendor, idProduct)
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def detach_kernel_driver(self, interface):
+        pass
+
+    def write(self, endpoint, data, timeout=None):
+        ''' Accepts the bytes of an OBP message. Once a complete message has
+            arrived it is processed and the reply is queued.
+        '''
+        data = bytearray(data)
+        with self._lock:
+            buf = self._in_buffers[endpoint]
+            buf.extend(data)
+            if len(buf) < 44:
+                return len(data)
+            bytes_remaining = struct.unpack_from('<I', buf, 40)[0]
+            if len(buf) < 44 + bytes_remaining or \
+                    buf[-4:] != bytearray(_FOOTER_BYTES):
+                return len(data)
+            message = bytes(buf)
+            del buf[:]
+            self._process(message, endpoint)
+            self._lock.notify_all()
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        ''' Returns the next reply queued on the IN endpoint, waiting for it
+            to be ready. Follows usb.core.Device.read, if an array is passed
+            it is filled and the number of bytes read is returned.
+        '''
+        if isinstance(size_or_buffer, array.array):
+            size = len(size_or_buffer)
+        else:
+            size = size_or_buffer
+        if timeout is None:
+            timeout = 1000
+        deadline = time.time() + timeout/1000.0
+
+        with self._lock:
+            while True:
+                queue = self._replies[endpoint]
+                now = time.time()
+                if queue and queue[0][0] is not None and queue[0][0] <= now:
+                    break
+                if now >= deadline:
+                    raise usb.core.USBError('Operation timed out',
+                                            errno=110)
+                wait = deadline - now
+                if queue and queue[0][0] is not None:
+                    wait = min(wait, queue[0][0] - now)
+                self._lock.wait(wait)
+            reply = queue[0]
+            chunk = reply[1][:size]
+            del reply[1][:size]
+            if not reply[1]:
+                queue.pop(0)
+
+        if isinstance(size_or_buffer, array.array):
+            size_or_buffer[:len(chunk)] = array.array('B', bytes(chunk))
+            return len(chunk)
+        return array.array('B', bytes(chunk))
+
+    def inject_stale_data(self, line, size=64):
+        ''' Queues size bytes which are not part of any reply on the IN
+            endpoint of the line, ahead of the replies still to come.
+        '''
+        with self._lock:
+            self._replies[line | 0x80].insert(0, [time.time(),
+                                                  bytearray(size)])
+            self._lock.notify_all()
+
+    def pulse_trigger(self):
+        ''' Applies a rising edge to the external trigger pin. The first
+            acquisition waiting on a trigger (trigger modes 1 and 2) starts
+            now. If none is waiting, or the detector is still acquiring, the
+            trigger is missed and counted in missed_triggers.
+        '''
+        with self._lock:
+            self._fire_trigger()
+            self._lock.notify_all()
+
+    def start_trigger_train(self, period, count):
+        ''' Pulses the trigger count times, every period seconds starting a
+            period from now, from a background thread which is returned.
+        '''
+        def run():
+            start = time.time() + period
+            for pulse in range(count):
+                delay = start + pulse*period - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                self.pulse_trigger()
+        thread = threading.Thread(target=run, name='STS trigger train')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    # ########################################### #
+    #    Decoding messages and queueing replies   #
+    # ########################################### #
+
+    def _process(self, message, endpoint):
+        fields = _HEADER.unpack_from(message)
+        flags = fields[4]
+        command = fields[6]
+        immediate_length = fields[12]
+        bytes_remaining = fields[14]
+        msg = {
+            'command': command,
+            'line': endpoint,
+            'regarding': fields[7:11],
+            'immediate': bytearray(fields[13][:immediate_length]),
+            'payload': bytearray(message[44:24 + bytes_remaining]),
+        }
+
+        handler = self._handlers.get(command)
+        if handler is None:
+            self._queue_reply(msg, flags, error=2)
+            return
+        try:
+            data = handler(msg)
+        except (IndexError, ValueError, struct.error):
+            self._queue_reply(msg, flags, error=6)
+            return
+        except _NoData:
+            self._queue_reply(msg, flags, error=12)
+            return
+        if command == 0x00000000:
+            return
+        if isinstance(data, _Deferred):
+            self._queue_reply(msg, flags, data.data, ready=data.ready)
+        else:
+            self._queue_reply(msg, flags, data)
+
+    def _queue_reply(self, msg, flags, data=None, error=0, ready=0.0):
+        ''' Builds the reply packets and puts them on the IN endpoint. A
+            reply with ready set to None waits for a trigger.
+        '''
+        if error:
+            reply_flags = RESPONSE_FLAG | NACK_FLAG
+        elif flags & ACK_REQUESTED_FLAG:
+            reply_flags = RESPONSE_FLAG | ACK_FLAG
+        elif data is None:
+            return
+        else:
+            reply_flags = RESPONSE_FLAG
+        if data is None:
+            data = b''
+
+        regarding = msg['regarding']
+        if len(data) <= 16:
+            immediate = bytes(data)
+            length = len(data)
+            payload = b''
+        else:
+            immediate = b''
+            length = 0
+            payload = bytes(data)
+        packet = _HEADER.pack(0xC1, 0xC0, 17, 0, reply_flags, error,
+                              msg['command'], regarding[0],
+                              regarding[1], regarding[2], regarding[3], 0,
+                              length, immediate, len(payload) + 20)
+        packet += payload + _FOOTER.pack(b'', 0xC5, 0xC4, 0xC3, 0xC2)
+        if self.lost_replies:
+            self.lost_replies -= 1
+            return
+        if self.corrupted_replies:
+            self.corrupted_replies -= 1
+            packet = packet[:-1] + b'\x00'
+
+        now = time.time()
+        start = max(now, self._busy_until) + self.command_latency
+        transfer = self.packet_time*(len(packet)//64)
+        if ready is None:
+            self._waiting_trigger.append((transfer, packet, msg['line']))
+            return
+        ready = max(start, ready) + transfer
+        self._busy_until = ready
+        self._replies[msg['line'] | 0x80].append([ready, bytearray(packet)])
+
+    def _fire_trigger(self):
+        now = time.time()
+        self.triggers += 1
+        if not self._waiting_trigger or now < self._acquiring_until:
+            self.missed_triggers += 1
+            return
+        transfer, packet, line = self._waiting_trigger.pop(0)
+        self._acquiring_until = now + self.trigger_delay_us*1e-6 + \
+            self._acquisition_time(line)
+        ready = self._acquiring_until + transfer
+        self._busy_until = max(self._busy_until, ready)
+        self._replies[line | 0x80].append([ready, bytearray(packet)])
+
+    # ########################################### #
+    #            Message type handlers            #
+    # ########################################### #
+
+    def _u8(self, value):
+        return struct.pack('<B', value)
+
+    def _text(self, text):
+        return text.encode('ascii')
+
+    def _reset(self, msg):
+        self.reset_defaults()
+        del self._waiting_trigger[:]
+
+    def _reset_defaults(self, msg):
+        self.reset_defaults()
+
+    def _set_alias(self, msg):
+        self.alias = bytes(msg['immediate']).decode('ascii')
+
+    def _get_user_string(self, msg):
+        return self._text(self.user_strings[msg['immediate'][0]])
+
+    def _set_user_string(self, msg):
+        data = msg['immediate'] or msg['payload']
+        text = bytes(data[1:]).rstrip(b'\x00').decode('ascii')
+        self.user_strings[data[0]] = text[:self.user_string_length]
+
+    def _set_setting(self, name, fmt, low, high):
+        def handler(msg):
+            value = struct.unpack(fmt, bytes(msg['immediate']))[0]
+            if not low <= value <= high:
+                raise ValueError(name)
+            setattr(self, name, value)
+        return handler
+
+    def _set_line_setting(self, name, fmt, low, high):
+        def handler(msg):
+            value = struct.unpack(fmt, bytes(msg['immediate']))[0]
+            if not low <= value <= high:
+                raise ValueError(name)
+            getattr(self, name)[msg['line']] = value
+        return handler
+
+    def _get_coeff(self, name):
+        def handler(msg):
+            return struct.pack('<f', getattr(self, name)[msg['immediate'][0]])
+        return handler
+
+    def _set_coeff(self, name):
+        def handler(msg):
+            index = msg['immediate'][0]
+            value = struct.unpack('<f', bytes(msg['immediate'][1:5]))[0]
+            getattr(self, name)[index] = value
+        return handler
+
+    def _get_irrad_calib(self, msg):
+        return struct.pack('<%df' % len(self.irrad_calib), *self.irrad_calib)
+
+    def _set_irrad_calib(self, msg):
+        data = bytes(msg['immediate'] or msg['payload'])
+        count = len(data)//4
+        self.irrad_calib = list(struct.unpack('<%df' % count,
+                                              data[:4*count]))
+
+    def _get_irrad_area(self, msg):
+        return struct.pack('<f', self.irrad_area)
+
+    def _set_irrad_area(self, msg):
+        self.irrad_area = struct.unpack('<f', bytes(msg['immediate']))[0]
+
+    def _get_hot_pixels(self, msg):
+        if not self.hot_pixels:
+            raise _NoData()
+        return struct.pack('<%dH' % len(self.hot_pixels), *self.hot_pixels)
+
+    def _set_hot_pixels(self, msg):
+        data = bytes(msg['immediate'] or msg['payload'])
+        count = len(data)//2
+        self.hot_pixels = list(struct.unpack('<%dH' % count,
+                                             data[:2*count]))
+
+    def _set_default_binning(self, msg):
+        if msg['immediate']:
+            self.default_binning_factor = msg['immediate'][0]
+        else:
+            self.default_binning_factor = 0
+
+    def _get_partial_mode(self, msg):
+        if self.partial_ranges is None:
+            raise _NoData()
+        values = [value for pair in self.partial_ranges for value in pair]
+        return struct.pack('<%dH' % (1 + len(values)), 1, *values)
+
+    def _set_partial_mode(self, msg):
+        ''' Mode 1 is followed by up to 3 (first pixel, number of pixels)
+            ranges, of the pixels at the binning factor set.
+        '''
+        data = bytes(msg['immediate'])
+        if len(data) < 6 or len(data) % 4 != 2:
+            raise ValueError('partial spectrum mode')
+        values = struct.unpack('<%dH' % (len(data)//2), data)
+        if values[0] != 1 or len(values) > 7:
+            raise ValueError('partial spectrum mode')
+        ranges = [(values[n], values[n + 1])
+                  for n in range(1, len(values), 2)]
+        for start, count in ranges:
+            if count < 1 or start + count > PIXELS >> self.binning_factor:
+                raise ValueError('partial spectrum range')
+        self.partial_ranges = ranges
+
+    def _read_temperature(self, msg):
+        return struct.pack('<f', self.temperatures[msg['immediate'][0]])
+
+    def _trigger_pulse(self, msg):
+        self._fire_trigger()
+
+    def _acquisition_time(self, line):
+        return self.scans_to_avg[line]*(self.integration_time_us*1e-6 +
+                                        self.readout_time)
+
+    def _spectrum(self, msg):
+        ''' Takes a spectrum with the current settings. The reply is ready
+            once all the scans to average have been integrated.
+        '''
+        line = msg['line']
+        scans = self.scans_to_avg[line]
+        seconds = self.integration_time_us*1e-6
+        counts = self.dark_level + self.signal_rate*seconds
+        noise = np.sqrt(self.read_noise**2 + self.signal_rate*seconds)
+        counts = counts + self._rng.standard_normal(PIXELS)*noise / \
+            np.sqrt(scans)
+        counts[self.hot_pixels] += 4000.0*seconds + 300.0
+        if msg['command'] != 0x00101100:
+            for pixel in self.hot_pixels:
+                if 0 < pixel < PIXELS - 1:
+                    counts[pixel] = (counts[pixel - 1] + counts[pixel + 1])/2
+        width = self.boxcar[line]
+        if width:
+            kernel = np.ones(2*width + 1)/(2*width + 1.0)
+            counts = np.convolve(counts, kernel, mode='same')
+        if self.binning_factor:
+            # Binned pixels are the mean of the pixels combined
+            counts = counts.reshape(-1, 1 << self.binning_factor).mean(axis=1)
+        counts = np.clip(np.round(counts), 0, MAX_COUNTS).astype('<u2')
+        if msg['command'] == 0x00100928:
+            if self.partial_ranges is None:
+                raise _NoData()
+            counts = np.concatenate([counts[start:start + count]
+                                     for start, count in self.partial_ranges])
+
+        if self.trigger_mode:
+            return _Deferred(counts.tobytes(), None)
+        ready = max(time.time(), self._busy_until) + \
+            self.trigger_delay_us*1e-6 + self._acquisition_time(line)
+        return _Deferred(counts.tobytes(), ready)
+
+
+class _NoData(Exception):
+    ''' Raised by a handler when the value asked for has not been set, the
+        reply is a NACK with error 12.
+    '''
+
+
+class _Deferred(object):
+    ''' Reply data which is not available until the time given by ready.
+    '''
+    def __init__(self, data, ready):
+        self.data = data
+        self.ready = ready
+
+
+def simulated_bus(devices):
+    ''' Returns a function which can be used in place of usb.core.find to
+        locate the simulated devices given in the list devices.
+    '''
+    def find(find_all=False, idVendor=None, idProduct=None):
+        found = [dev for dev in devices
+                 if idVendor in (None, dev.idVendor) and
+                 idProduct in (None, dev.idProduct)]
+        if find_all:
+            return found
+        if found:
+            return found[0]
+        return None
+    return find
@@ -0,0 +1,207 @@
+''' Instrumentation of the messages sent to an STS. When a hook is added to an
+    STSVIS every transaction (a request and its reply, or a command and its
+    ACK) is passed to it as a Transaction once complete. TransactionStats is
+    such a hook, keeping counts, a latency histogram and bytes in and out for
+    each message type:
+
+        stats = spec.enable_stats()
+        spec.get_corrected_spectrum()
+        print(stats.report())
+        stats[0x00101000].mean_s
+
+    With no hook added the driver only checks an empty list per transaction.
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bisect
+import collections
+import threading
+import time
+
+# A completed transaction. started, written and finished are the time.time()
+#    the transaction began, its first packet was written and its last reply
+#    read (written is None if nothing was written), so the time taken by a
+#    retry counts as reading. packets counts the USB reads, retries the
+#    packets discarded looking for the reply and the times the message was
+#    sent again, nacks the replies with the NACK flag and error_code the OBP
+#    error number of the last of them (or None). exception is the exception
+#    which ended the transaction.
+Transaction = collections.namedtuple('Transaction', [
+    'command', 'line', 'started', 'written', 'finished', 'bytes_out',
+    'bytes_in', 'packets', 'retries', 'nacks', 'error_code', 'exception'])
+
+# Names of the message types used most, for reports
+COMMAND_NAMES = {
+    0x00000100: 'serial',
+    0x00101000: 'corrected spectrum',
+    0x00101100: 'raw spectrum',
+    0x00100928: 'partial spectrum',
+    0x00102090: 'partial mode',
+    0x00110010: 'integration time',
+    0x00110110: 'trigger mode',
+    0x00110120: 'trigger pulse',
+    0x00110280: 'binning factor',
+    0x00110290: 'set binning',
+    0x00120000: 'scans to avg',
+    0x00120010: 'set scans to avg',
+    0x00121010: 'set boxcar',
+    0x00180101: 'wavelength coeff',
+    0x00181101: 'nonlinearity coeff',
+    0x00183101: 'stray light coeff',
+    0x00400001: 'temperature',
+    0x00400002: 'temperatures',
+}
+
+# Upper edges of the latency histogram bins, in seconds. The last bin holds
+#    everything longer.
+LATENCY_BINS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02,
+                0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+
+class _Tally(object):
+    """ class _Tally:
+        What the driver counts during a transaction on a line.
+    """
+    __slots__ = ('written', 'bytes_out', 'bytes_in', 'packets', 'retries',
+                 'nacks', 'error_code')
+
+    def __init__(self):
+        self.written = None
+        self.bytes_out = self.bytes_in = self.packets = 0
+        self.retries = self.nacks = 0
+        self.error_code = None
+
+
+class CommandStats(object):
+    """ class CommandStats:
+        The totals of the transactions of one message type.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.count = 0
+        self.failures = 0
+        self.retries = 0
+        self.nacks = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.packets = 0
+        self.total_s = 0.0
+        self.write_s = 0.0
+        self.min_s = None
+        self.max_s = 0.0
+        self.histogram = [0]*(len(LATENCY_BINS) + 1)
+        self.error_codes = collections.Counter()
+
+    @property
+    def name(self):
+        return COMMAND_NAMES.get(self.command, '0x%08X' % self.command)
+
+    @property
+    def mean_s(self):
+        return self.total_s/self.count if self.count else 0.0
+
+    def add(self, transaction):
+        ''' Adds a transaction of this message type.
+        '''
+        latency = transaction.finished - transaction.started
+        self.count += 1
+        self.failures += transaction.exception is not None
+        self.retries += transaction.retries
+        self.nacks += transaction.nacks
+        self.bytes_out += transaction.bytes_out
+        self.bytes_in += transaction.bytes_in
+        self.packets += transaction.packets
+        self.total_s += latency
+        if transaction.written is not None:
+            self.write_s += transaction.written - transaction.started
+        if self.min_s is None or latency < self.min_s:
+            self.min_s = latency
+        self.max_s = max(self.max_s, latency)
+        self.histogram[bisect.bisect_left(LATENCY_BINS, latency)] += 1
+        if transaction.error_code is not None:
+            self.error_codes[transaction.error_code] += 1
+
+    def percentile(self, percent):
+        ''' The upper edge of the histogram bin holding the given percentile
+            of the latencies (max_s for the last bin).
+        '''
+        if not self.count:
+            return 0.0
+        wanted = percent/100.0*self.count
+        total = 0
+        for index, count in enumerate(self.histogram):
+            total += count
+            if total >= wanted and count:
+                break
+        if index == len(LATENCY_BINS):
+            return self.max_s
+        return min(LATENCY_BINS[index], self.max_s)
+
+
+class TransactionStats(object):
+    """ class TransactionStats:
+        A transaction hook which keeps a CommandStats for each message type,
+        available as stats[command]. It can be shared by several devices and
+        threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, transaction):
+        with self._lock:
+            stats = self.commands.get(transaction.command)
+            if stats is None:
+                stats = self.commands[transaction.command] = \
+                    CommandStats(transaction.command)
+            stats.add(transaction)
+
+    def __getitem__(self, command):
+        return self.commands[command]
+
+    def __contains__(self, command):
+        return command in self.commands
+
+    def reset(self):
+        ''' Clears the totals.
+        '''
+        self.commands = {}
+        self.started = time.time()
+
+    def report(self):
+        ''' Returns a table of the totals of each message type, with the
+            latencies in milliseconds.
+        '''
+        lines = ['%-20s %7s %9s %9s %9s %9s %9s %9s %5s %5s' % (
+            'message', 'count', 'mean ms', 'p95 ms', 'max ms', 'write ms',
+            'bytes out', 'bytes in', 'retry', 'nack')]
+        with self._lock:
+            commands = sorted(self.commands.values(),
+                              key=lambda stats: -stats.total_s)
+            for stats in commands:
+                lines.append('%-20s %7d %9.3f %9.3f %9.3f %9.3f %9d %9d '
+                             '%5d %5d' % (
+                                 stats.name, stats.count, stats.mean_s*1e3,
+                                 stats.percentile(95)*1e3, stats.max_s*1e3,
+                                 stats.write_s*1e3/stats.count,
+                                 stats.bytes_out, stats.bytes_in,
+                                 stats.retries, stats.nacks))
+                if stats.error_codes:
+                    lines.append('    error codes: %s' % ', '.join(
+                        '%d x %d' % (code, count) for code, count in
+                        sorted(stats.error_codes.items())))
+        return '\n'.join(lines)
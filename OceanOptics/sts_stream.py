@@ -0,0 +1,187 @@
+''' Continuous acquisition for the STS driver. A SpectrumStream runs a thread
+    which requests spectra back to back and stores each one, with the time it
+    was received and a sequence number, in a preallocated ring buffer. The
+    consumer takes spectra out of the buffer at its own pace, so processing
+    no longer cuts into the time the spectrometer spends acquiring.
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import collections
+import threading
+import time
+
+import numpy as np
+
+# A spectrum taken from a stream, timestamp is the time.time() at which it
+#    was received and sequence counts the spectra acquired by the stream.
+Frame = collections.namedtuple('Frame', ['timestamp', 'sequence',
+                                         'spectrum'])
+
+OVERFLOW_POLICIES = ('drop_oldest', 'block')
+
+
+class SpectrumStream(object):
+    """ class SpectrumStream:
+        Acquires spectra from spec on a background thread into a ring buffer
+        holding capacity spectra. When the buffer is full the overflow policy
+        decides what happens:
+            'drop_oldest': the oldest spectrum is overwritten and counted in
+        dropped, acquisition never waits for the consumer.
+            'block': acquisition waits until the consumer has taken a
+        spectrum out of the buffer.
+        If raw is True raw rather than corrected spectra are acquired.
+    """
+
+    def __init__(self, spec, line=1, capacity=64, overflow='drop_oldest',
+                 raw=False):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of %s' %
+                             (OVERFLOW_POLICIES, ))
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.spec = spec
+        self.line = line
+        self.capacity = capacity
+        self.overflow = overflow
+        self.raw = raw
+
+        self.acquired = 0
+        self.dropped = 0
+        self.error = None
+
+        # One slot more than the capacity, which the next spectrum is
+        #    acquired into while all the others hold spectra.
+        self._slots = capacity + 1
+        self._spectra = None  # Allocated once the pixel count is known
+        self._timestamps = np.zeros(self._slots)
+        self._sequence = np.zeros(self._slots, dtype=np.int64)
+        self._head = 0
+        self._count = 0
+        self._running = False
+        self._thread = None
+        self._lock = threading.Condition()
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        ''' Starts the acquisition thread.
+        '''
+        if self.running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name='STS spectrum stream')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        ''' Stops acquiring, the spectra already in the buffer can still be
+            taken out. Waits for a request in progress to finish.
+        '''
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        if self._thread is not None and \
+                self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def get(self, timeout=None):
+        ''' Takes the oldest spectrum out of the buffer and returns it as a
+            Frame. Waits up to timeout seconds (forever if None) for one to
+            arrive and returns None if none did, or if the stream stopped.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._count == 0:
+                if self.error is not None:
+                    raise self.error
+                if not self._running:
+                    return None
+                if deadline is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._lock.wait(remaining)
+            slot = self._head
+            frame = Frame(self._timestamps[slot], int(self._sequence[slot]),
+                          self._spectra[slot].copy())
+            self._head = (self._head + 1) % self._slots
+            self._count -= 1
+            self._lock.notify_all()
+        return frame
+
+    def iter_spectra(self, timeout=None):
+        ''' Yields Frames as they are acquired until the stream is stopped
+            and the buffer is empty, or no spectrum arrives within timeout.
+        '''
+        while True:
+            frame = self.get(timeout)
+            if frame is None:
+                return
+            yield frame
+
+    __iter__ = iter_spectra
+
+    def _acquire(self, out=None):
+        if self.raw:
+            return self.spec.get_raw_spectrum(self.line, out=out)
+        return self.spec.get_corrected_spectrum(self.line, out=out)
+
+    def _run(self):
+        try:
+            while True:
+                with self._lock:
+                    while self._count == self.capacity and \
+                            self.overflow == 'block' and self._running:
+                        self._lock.wait()
+                    if not self._running:
+                        return
+                    slot = (self._head + self._count) % self._slots
+
+                # The slot is not visible to the consumer until it is counted,
+                # so the spectrum is written into it without holding the lock.
+                if self._spectra is None:
+                    spectrum = self._acquire()
+                    self._spectra = np.zeros((self._slots, len(spectrum)))
+                    self._spectra[slot] = spectrum
+                else:
+                    self._acquire(self._spectra[slot])
+                received = time.time()
+
+                with self._lock:
+                    # Only dropped if the consumer has not made room while
+                    # the spectrum was acquired
+                    if self._count == self.capacity:
+                        self._head = (self._head + 1) % self._slots
+                        self._count -= 1
+                        self.dropped += 1
+                    self._timestamps[slot] = received
+                    self._sequence[slot] = self.acquired
+                    self.acquired += 1
+                    self._count += 1
+                    self._lock.notify_all()
+        except Exception as error:
+            with self._lock:
+                self.error = error
+                self._running = False
+                self._lock.notify_all()
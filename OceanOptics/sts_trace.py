@@ -0,0 +1,209 @@
+''' Tracing of STS acquisitions for offline profiling. A Tracer records every
+    transaction with the attached spectrometers (with its write and read as
+    separate spans) and the processing stages (decode, nonlinearity,
+    calibration) on each thread, and writes them as Chrome trace events to be
+    viewed in a timeline viewer such as chrome://tracing or Perfetto:
+
+        with Tracer([spec], 'session.json'):
+            data = sts_utils.do_collection(spec, coefficients, 0.1)
+
+    Only one tracer is active at a time. With none active, timing a stage
+    costs a function call and an empty with block.
+
+    This STS-Driver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    It is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with the software.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import json
+import os
+import threading
+import time
+
+from .sts_stats import COMMAND_NAMES
+
+# The tracer started last, which the stage spans are recorded to
+_active = None
+
+
+class _NoSpan(object):
+    """ class _NoSpan:
+        The span returned when no tracer is active, which does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, category='processing', **args):
+    ''' Returns a context manager timing the stage name, recorded by the
+        active tracer with args, or doing nothing if there is none.
+    '''
+    if _active is None:
+        return _NO_SPAN
+    return _Span(_active, name, category, args)
+
+
+class _Span(object):
+    """ class _Span:
+        A stage being timed by a tracer.
+    """
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add_span(self.name, self.started, time.time(),
+                             self.category, self.args)
+        return False
+
+
+class Tracer(object):
+    """ class Tracer:
+        Records the transactions of the STSVIS devices in specs and the
+        processing stages while started, keeping up to max_events events.
+        Used as a context manager it is started on entry, and stopped and
+        written to path (if given) on exit.
+    """
+
+    def __init__(self, specs=(), path=None, max_events=1000000):
+        self.specs = list(specs)
+        self.path = path
+        self.max_events = max_events
+        self.events = []
+        self.dropped = 0
+        self.origin = time.time()
+        self.running = False
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        if self.path is not None:
+            self.write()
+        return False
+
+    def attach(self, spec):
+        ''' Adds an STSVIS to record the transactions of.
+        '''
+        self.specs.append(spec)
+        if self.running:
+            spec.add_transaction_hook(self)
+
+    def start(self):
+        ''' Starts recording, making this the active tracer.
+        '''
+        global _active
+        if not self.running:
+            for spec in self.specs:
+                spec.add_transaction_hook(self)
+            self.running = True
+        _active = self
+
+    def stop(self):
+        ''' Stops recording.
+        '''
+        global _active
+        if self.running:
+            for spec in self.specs:
+                spec.remove_transaction_hook(self)
+            self.running = False
+        if _active is self:
+            _active = None
+
+    def __call__(self, transaction):
+        ''' Records a Transaction, the transaction hook of the devices, as a
+            span with a write span up to its first packet written and a read
+            span for the rest, including any retries.
+        '''
+        command = transaction.command
+        args = {'command': '0x%08X' % command, 'line': transaction.line,
+                'bytes_out': transaction.bytes_out,
+                'bytes_in': transaction.bytes_in,
+                'packets': transaction.packets}
+        if transaction.retries:
+            args['retries'] = transaction.retries
+        if transaction.nacks:
+            args['nacks'] = transaction.nacks
+            args['error_code'] = transaction.error_code
+        if transaction.exception is not None:
+            args['exception'] = repr(transaction.exception)
+        self.add_span(COMMAND_NAMES.get(command, args['command']),
+                      transaction.started, transaction.finished, 'usb', args)
+        if transaction.written is not None:
+            self.add_span('write', transaction.started, transaction.written,
+                          'usb')
+            self.add_span('read', transaction.written, transaction.finished,
+                          'usb')
+
+    def span(self, name, category='processing', **args):
+        ''' Returns a context manager timing the stage name with this tracer,
+            whether or not it is the active one.
+        '''
+        return _Span(self, name, category, args)
+
+    def add_span(self, name, started, finished, category='processing',
+                 args=None):
+        ''' Records a span of the current thread from started to finished
+            (time.time() values).
+        '''
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        thread = threading.current_thread()
+        if thread.ident not in self._threads:
+            with self._lock:
+                self._threads[thread.ident] = thread.name
+        event = {'name': name, 'cat': category, 'ph': 'X',
+                 'ts': (started - self.origin)*1e6,
+                 'dur': (finished - started)*1e6,
+                 'pid': os.getpid(), 'tid': thread.ident}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def trace_events(self):
+        ''' Returns the events recorded, with the names of the threads, as
+            the dictionary of the Chrome trace event format.
+        '''
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                  'tid': ident, 'args': {'name': name}}
+                 for ident, name in sorted(self._threads.items())]
+        return {'traceEvents': names + list(self.events),
+                'displayTimeUnit': 'ms',
+                'otherData': {'origin': self.origin,
+                              'dropped': self.dropped}}
+
+    def write(self, path=None):
+        ''' Writes the trace to path (by default the tracer's path) as JSON.
+        '''
+        if path is None:
+            path = self.path
+        with open(path, 'w') as f:
+            json.dump(self.trace_events(), f)
@@ -24,17 +24,17 @@
     Email: wesma651@student.otago.ac.nz
 '''
 
-from STS import STSVIS
+from .STS import STSVIS, bin_pixels
+from . import sts_trace
 import struct
 import usb.core as core
 import time
 import numpy as np
-from scipy import interpolate
-from scipy import optimize
 import datetime
 import sys, os, errno
 
-import matplotlib.pyplot as plt
+# scipy is only imported by the functions that use it, importing it here
+#    would add seconds to the start of every script using the driver.
 
 def mkdir_p(path):
     ''' This function checks to see if path exists in the OS directory
@@ -50,63 +50,71 @@ def mkdir_p(path):
 def find_bin_factor(bins):
     ''' This function looks at the centre of the wavelength bins returned from
         the spectrometer and calulates the width of those bins for unit
-        conversion to get the intensity of light.
+        conversion to get the intensity of light. bins may be binned to fewer
+        than 1024 pixels.
     '''
-
-    bin_factor = np.zeros(1024)
+    pixels = len(bins)
+    bin_factor = np.zeros(pixels)
     bin_factor[0] = bins[1] - bins[0]
-    bin_factor[1:1023] = (bins[2:1024] - bins[0:1022]) / 2
-    bin_factor[1023] = bins[1023] - bins[1022]
+    bin_factor[1:pixels-1] = (bins[2:pixels] - bins[0:pixels-2]) / 2
+    bin_factor[pixels-1] = bins[pixels-1] - bins[pixels-2]
     return bin_factor
 
 def get_multiplication(serial, bin_factor, calibration, integration_sec):
     ''' This function returns the coefficients to multiply the 
         counts - baseline value by to get the intensity.
     '''
-    core_cm = 0.04
-    area = np.pi*((core_cm/2)**2)
-    return calibration/integration_sec/area/bin_factor
+    with sts_trace.span('calibration'):
+        core_cm = 0.04
+        area = np.pi*((core_cm/2)**2)
+        return calibration/integration_sec/area/bin_factor
 
-def calculate_wavlengths(spec):
+def calculate_wavlengths(spec, calibration=None, binning_factor=None):
     ''' This function asks the spectrometer for the wavelength that is the
-        centre of the bins and returns an array of those wavelengths.
+        centre of the bins and returns an array of those wavelengths. If a
+        Calibration (see sts_calibration) is given the device is not queried
+        for the coefficients. The bins are those of the binning factor in use
+        unless binning_factor is given.
     '''
-    coef1 = spec.get_wav_coeff(0)
-    coef2 = spec.get_wav_coeff(1)
-    coef3 = spec.get_wav_coeff(2)
-    coef4 = spec.get_wav_coeff(3)
-    wave = np.zeros(1024)
-    for index in range(1024):
-        wave[index] = coef1 + coef2*index + coef3*(index**2) + coef4*(index**3)
-    return wave
-
-def get_non_linear_correction(spec):
+    if binning_factor is None:
+        binning_factor = spec.get_active_binning_factor()
+    if calibration is not None:
+        return calibration.wavelengths(binning_factor)
+    coeffs = spec.get_wav_coeffs()
+    return bin_pixels(np.polyval(coeffs[::-1], np.arange(1024)),
+                      binning_factor)
+
+def get_non_linear_correction(spec, calibration=None):
     ''' This function gets the array of coefficients to be multiplied by the
         result of the scan to take into account the non linearity of the
-        device.
+        device. If a Calibration is given the device is not queried.
     '''
-    coeff = np.zeros(8)
-    for aa in range(8):
-        coeff[aa] = spec.get_nonlin_coeff(aa)
-
-    return coeff
+    if calibration is not None:
+        return calibration.nonlin_coeffs
+    return spec.get_nonlin_coeffs()
 
 def do_non_lin(data, coeff, dark_spec, integration_sec):
     ''' This function does the non linearity correction by multiplying by
         the coefficients in the manner laid out in the STS spec sheet
-        provided by Ocean Optics.
+        provided by Ocean Optics. The polynomial is evaluated in place by
+        Horner's method, for repeated use see sts_processing.SpectrumProcessor.
     '''
-    step_1 = data - dark_spec*integration_sec
-    poly = coeff[0] + coeff[1]*step_1 + coeff[2]*(step_1**2) + \
-        coeff[3]*(step_1**3) + coeff[4]*(step_1**4) + \
-        coeff[5]*(step_1**5) + coeff[6]*(step_1**6) + coeff[7]*(step_1**7)
-    lin_data = step_1/poly
-    return lin_data
+    with sts_trace.span('nonlinearity'):
+        step_1 = data - dark_spec*integration_sec
+        poly = np.empty(np.shape(step_1))
+        poly.fill(coeff[len(coeff) - 1])
+        for cc in coeff[len(coeff) - 2::-1]:
+            poly *= step_1
+            poly += cc
+        step_1 /= poly
+        return step_1
 
 def get_lamp_data(bins):
     ''' This is a function used in calibration which loads the lamp file for
         the calibrated source.
     '''
+    from scipy import interpolate
+
     actual = np.loadtxt('lmp.LMP')
     wave_limited = actual[:,0]
     rad_limited = actual[:,1]
@@ -114,21 +122,35 @@ def get_lamp_data(bins):
     rad = f(bins)
     return rad
 
-def do_collection(spec, coefficients ,integration_sec, length="", averaging=1):
+def do_collection(spec, coefficients ,integration_sec, length="", averaging=1,
+                  dark_library=None):
     ''' This function does the data collection from the spectrometer using a
         sum over a loop method to improve the signal to noise via increased
-        integration time, without the device saturating.
+        integration time, without the device saturating. A dark spectrum
+        taken without binning is binned to match the spectra. If a
+        DarkLibrary (see sts_darks) is given the dark is taken from it for
+        the integration time, binning and temperature rather than the file.
     '''
-    serial = spec.get_serial()
-    dark_spec = np.loadtxt('../{0}/{0}_{1}_dark.txt'.format(serial,length))
-    scan_data = np.zeros(1024)
     spec.set_integration_time(integration_sec*1e6, 1)
+    pixels = spec.get_pixel_count()
+    if dark_library is not None:
+        # do_non_lin takes the dark per second of integration
+        dark_spec = dark_library.dark_for(spec)/integration_sec
+    else:
+        serial = spec.get_serial()
+        dark_spec = np.loadtxt('../{0}/{0}_{1}_dark.txt'.format(serial,
+                                                                length))
+        if len(dark_spec) != pixels:
+            dark_spec = bin_pixels(dark_spec,
+                                   spec.get_active_binning_factor())
+    scan_data = np.zeros(pixels)
 
     for scan in range(int(averaging)):
-
-        raw_data = spec.get_corrected_spectrum(1)
-        data = do_non_lin(raw_data, coefficients, dark_spec, integration_sec)
-        scan_data += data
+        with sts_trace.span('scan', index=scan):
+            raw_data = spec.get_corrected_spectrum(1)
+            data = do_non_lin(raw_data, coefficients, dark_spec,
+                              integration_sec)
+            scan_data += data
     
     return scan_data
 
@@ -149,5 +171,5 @@ def get_time_stamp(base_path):
     return ts, p
 
     class OOError(Exception):
-        print "An Error has Occurred"
+        print("An Error has Occurred")
         pass
\ No newline at end of file
@@ -0,0 +1,25 @@
+''' The fixture of the tests which need a device: each test gets an STSVIS
+    connected to a new STSSimulator. The tests are run with
+
+        python -m unittest discover tests
+'''
+
+import unittest
+
+from OceanOptics import STSVIS
+from OceanOptics.sts_simulator import STSSimulator
+
+
+class SimulatorTestCase(unittest.TestCase):
+    """ class SimulatorTestCase:
+        Sets up self.sim, a simulated spectrometer, and self.spec, the driver
+        talking to it, set to integration_us (if not None) for each test.
+    """
+
+    integration_us = 2000
+
+    def setUp(self):
+        self.sim = STSSimulator()
+        self.spec = STSVIS(find=self.sim.find)
+        if self.integration_us is not None:
+            self.spec.set_integration_time(self.integration_us)
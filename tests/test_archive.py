@@ -0,0 +1,52 @@
+''' Tests of the binary archive of spectra.
+'''
+
+import calendar
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from OceanOptics import sts_archive
+from OceanOptics.sts_archive import ArchiveFile, ArchiveWriter, archive_path
+
+from simulated import SimulatorTestCase
+
+
+class _Clock(object):
+    """ class _Clock:
+        Stands in for the time module, returning the times given in turn.
+    """
+
+    def __init__(self, *times):
+        self.times = list(times)
+        self.gmtime = time.gmtime
+
+    def time(self):
+        return self.times.pop(0) if len(self.times) > 1 else self.times[0]
+
+
+class ArchiveTest(SimulatorTestCase):
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        sts_archive.time = time
+        shutil.rmtree(self.directory)
+
+    def test_record_is_filed_by_its_own_timestamp(self):
+        midnight = calendar.timegm((2016, 3, 2, 0, 0, 0))
+        sts_archive.time = _Clock(midnight - 0.001, midnight + 0.001)
+        with ArchiveWriter(self.directory, 'S1') as writer:
+            writer.log(self.spec, temperatures=False)
+        archive = ArchiveFile(archive_path(self.directory, 'S1', '2016-03-01'))
+        self.assertEqual(len(archive), 1)
+        self.assertTrue(archive.records['timestamp'][0] < midnight)
+        del archive
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+''' Tests of the asyncio interface, which needs Python 3.7. The coroutines are
+    run with run_until_complete so that this module also loads on Python 2.
+'''
+
+import sys
+import threading
+import unittest
+
+import numpy as np
+
+from OceanOptics.sts_simulator import STSSimulator
+
+
+@unittest.skipIf(sys.version_info < (3, 7), 'asyncio needs Python 3.7')
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        import asyncio
+        from OceanOptics.sts_async import AsyncSTSVIS
+        self.sim = STSSimulator()
+        self.loop = asyncio.new_event_loop()
+        self.spec = self.wait(AsyncSTSVIS.open(find=self.sim.find))
+        self.wait(self.spec.set_integration_time(2000))
+
+    def tearDown(self):
+        self.spec.close()
+        self.loop.close()
+
+    def wait(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def test_methods_are_awaitable(self):
+        spectrum = self.wait(self.spec.get_corrected_spectrum())
+        self.assertEqual(len(spectrum), 1024)
+        self.assertEqual(self.wait(self.spec.get_serial()), 'S05123')
+        self.assertEqual(self.wait(self.spec.get_integration_time()), 2000)
+
+    def test_iter_spectra_streams_raw_spectra(self):
+        frames = self.spec.iter_spectra(timeout=1.0, raw=True)
+        first = self.wait(frames.__anext__())
+        second = self.wait(frames.__anext__())
+        self.wait(frames.aclose())
+        self.assertEqual((first.sequence, second.sequence), (0, 1))
+        self.assertTrue(np.all(first.spectrum == np.rint(first.spectrum)))
+        self.assertFalse(self.spec.spec._stream.running)
+
+    def test_stream_is_not_stopped_on_the_loop_thread(self):
+        stopped_on = []
+        stream = self.wait(self.spec.start_stream())
+        stop = stream.stop
+        stream.stop = lambda *args: (stopped_on.append(
+            threading.current_thread()), stop(*args))
+        self.spec.close()
+        self.spec._executor.shutdown(wait=True)
+        self.assertEqual(len(stopped_on), 1)
+        self.assertIsNot(stopped_on[0], threading.current_thread())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+''' Tests that the pixel binning factor changes the resolution of a spectrum
+    but not the irradiance it is calibrated to.
+'''
+
+import unittest
+
+import numpy as np
+
+from OceanOptics import STS_Error
+from OceanOptics.sts_calibration import read_calibration
+from OceanOptics.sts_processing import SpectrumProcessor
+
+from simulated import SimulatorTestCase
+
+
+class BinningTest(SimulatorTestCase):
+
+    integration_us = 100000
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.sim.read_noise = 0.0
+        self.calibration = read_calibration(self.spec)
+
+    def irradiance_at(self, factor, wavelength):
+        self.spec.set_pixel_binning_factor(factor)
+        processor = SpectrumProcessor(self.calibration, 0.1,
+                                      dark=np.full(1024, 15000.0),
+                                      fix_hot_pixels=False,
+                                      binning_factor=factor)
+        irradiance = processor.process(self.spec.get_corrected_spectrum())
+        return np.interp(wavelength, processor.wavelengths, irradiance)
+
+    def test_binning_leaves_irradiance_unchanged(self):
+        unbinned = self.irradiance_at(0, 560.0)
+        for factor in (1, 2, 3):
+            self.assertAlmostEqual(self.irradiance_at(factor, 560.0)/unbinned,
+                                   1.0, delta=0.03)
+
+    def test_partial_ranges_use_binned_pixels(self):
+        self.spec.set_pixel_binning_factor(2)
+        wavelengths = self.spec.set_partial_wavelength_ranges([(600, 610)])
+        self.assertTrue(len(wavelengths) > 0)
+        self.assertEqual(len(self.spec.get_partial_corrected()),
+                         len(wavelengths))
+        self.assertRaises(STS_Error, self.spec.set_partial_spectrum_mode,
+                          [(200, 100)])
+
+
+if __name__ == '__main__':
+    unittest.main()
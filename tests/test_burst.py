@@ -0,0 +1,48 @@
+''' Tests of the burst capture of triggered spectra.
+'''
+
+import threading
+import unittest
+
+from OceanOptics.sts_burst import capture_burst
+
+from simulated import SimulatorTestCase
+
+
+class BurstTest(SimulatorTestCase):
+
+    def test_burst_is_observed_and_restores_trigger_mode(self):
+        stats = self.spec.enable_stats()
+        train = self.sim.start_trigger_train(0.02, 10)
+        burst = capture_burst(self.spec, 10, trigger_period=0.02)
+        train.join()
+        self.assertTrue(burst.complete)
+        self.assertEqual(len(burst.spectra), 10)
+        self.assertEqual(self.spec.get_trigger_mode(), 0)
+        self.assertEqual(stats[0x00101000].count, 1)
+        self.assertEqual(stats[0x00101000].failures, 0)
+
+    def test_burst_without_triggers_ends_early(self):
+        burst = capture_burst(self.spec, 5, timeout=0.05)
+        self.assertFalse(burst.complete)
+        self.assertEqual(len(burst.spectra), 0)
+        self.assertEqual(self.spec.get_trigger_mode(), 0)
+        self.assertEqual(len(self.spec.get_corrected_spectrum()), 1024)
+
+    def test_bursts_on_both_lines_do_not_deadlock(self):
+        bursts = {}
+
+        def capture(line):
+            bursts[line] = capture_burst(self.spec, 3, line, timeout=0.05)
+        threads = [threading.Thread(target=capture, args=(line, ))
+                   for line in (1, 2)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(5.0)
+        self.assertEqual(sorted(bursts), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
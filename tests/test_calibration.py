@@ -0,0 +1,27 @@
+''' Tests of reading the calibration stored on a device.
+'''
+
+import unittest
+
+from OceanOptics.sts_calibration import read_calibration
+
+from simulated import SimulatorTestCase
+
+
+class CalibrationTest(SimulatorTestCase):
+
+    integration_us = None
+
+    def test_hot_pixels_are_read(self):
+        calibration = read_calibration(self.spec)
+        self.assertEqual(list(calibration.hot_pixels), [17, 311, 640])
+
+    def test_no_hot_pixels_stored(self):
+        self.sim.hot_pixels = []
+        calibration = read_calibration(self.spec)
+        self.assertEqual(len(calibration.hot_pixels), 0)
+        self.assertEqual(len(calibration.wavelengths()), 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+''' Tests of reading the coefficients of a device in one pipeline.
+'''
+
+import unittest
+
+import numpy as np
+
+from simulated import SimulatorTestCase
+
+
+class CoefficientsTest(SimulatorTestCase):
+
+    integration_us = None
+
+    def check(self, pipelined, one_by_one, count):
+        coeffs = pipelined()
+        self.assertEqual(len(coeffs), count)
+        np.testing.assert_array_equal(coeffs, [one_by_one(index)
+                                               for index in range(count)])
+
+    def test_pipelined_queries_match_single_queries(self):
+        spec = self.spec
+        self.check(spec.get_wav_coeffs, spec.get_wav_coeff,
+                   spec.get_wav_coeff_count())
+        self.check(spec.get_nonlin_coeffs, spec.get_nonlin_coeff,
+                   spec.get_nonlin_coeff_count())
+        self.check(spec.get_stray_light_coeffs, spec.get_stray_light_coeff,
+                   spec.get_stray_light_coeff_count())
+
+    def test_requests_are_sent_in_one_transaction(self):
+        stats = self.spec.enable_stats()
+        self.spec.get_wav_coeffs()
+        self.assertEqual(stats[0x00180101].count, 1)
+        self.assertEqual(stats[0x00180101].packets,
+                         self.spec.get_wav_coeff_count())
+
+    def test_lost_reply_in_a_pipeline_is_recovered(self):
+        expected = self.spec.get_wav_coeffs()
+        self.spec.timeouts = {0x00180101: 50}
+        self.sim.lost_replies = 1
+        np.testing.assert_array_equal(self.spec.get_wav_coeffs(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
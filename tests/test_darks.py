@@ -0,0 +1,54 @@
+''' Tests of the interpolation of dark spectra by the dark library.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from OceanOptics.sts_darks import DarkLibrary
+
+
+class DarkLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.library = DarkLibrary(os.path.join(self.directory, 'darks.npz'))
+        self.library.add('S1', 1000, 0, 20.0, np.full(4, 100.0))
+        self.library.add('S1', 1000, 0, 30.0, np.full(4, 200.0))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_temperatures_in_a_step_give_the_same_dark(self):
+        first = self.library.dark('S1', 1000, 0, 25.1)
+        second = self.library.dark('S1', 1000, 0, 24.9)
+        np.testing.assert_array_equal(first, second)
+        np.testing.assert_array_equal(first, np.full(4, 150.0))
+
+    def test_dark_returned_is_a_copy(self):
+        self.library.dark('S1', 1000, 0, 20.0)[:] = 0
+        np.testing.assert_array_equal(self.library.dark('S1', 1000, 0, 20.0),
+                                      np.full(4, 100.0))
+        np.testing.assert_array_equal(self.library.frames[0].spectrum,
+                                      np.full(4, 100.0))
+
+    def test_single_integration_time_is_not_scaled(self):
+        self.assertRaises(KeyError, self.library.dark, 'S1', 100000, 0, 20.0)
+        self.assertRaises(KeyError, self.library.dark, 'S1', 100000)
+        np.testing.assert_array_equal(self.library.dark('S1', 1000),
+                                      np.full(4, 150.0))
+
+    def test_dark_is_extrapolated_from_two_integration_times(self):
+        self.library.add('S1', 2000, 0, 20.0, np.full(4, 110.0))
+        np.testing.assert_allclose(self.library.dark('S1', 5000, 0, 20.0),
+                                   np.full(4, 140.0))
+        # At 30 C there is only the dark at 1000 us, so 20 C is the nearest
+        np.testing.assert_allclose(self.library.dark('S1', 5000, 0, 30.0),
+                                   np.full(4, 140.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
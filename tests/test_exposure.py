@@ -0,0 +1,42 @@
+''' Tests of the automatic exposure.
+'''
+
+import unittest
+
+from OceanOptics.sts_exposure import auto_expose
+from OceanOptics.sts_planner import MAX_COUNTS
+
+from simulated import SimulatorTestCase
+
+
+class ExposureTest(SimulatorTestCase):
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.sim.signal_rate = 50*self.sim.signal_rate  # Target near 20 ms
+
+    def check_converged(self, result, max_shots):
+        self.assertTrue(result.converged)
+        self.assertTrue(result.shots <= max_shots)
+        self.assertTrue(abs(result.peak_counts - 0.8*MAX_COUNTS) <=
+                        0.05*MAX_COUNTS)
+        self.assertEqual(self.spec.get_integration_time(),
+                         result.integration_time_us)
+
+    def test_converges_from_a_short_exposure(self):
+        self.check_converged(auto_expose(self.spec, start_us=1000), 4)
+
+    def test_converges_from_a_saturated_exposure(self):
+        self.check_converged(auto_expose(self.spec, start_us=200000), 6)
+
+    def test_no_light_stops_within_the_limits(self):
+        self.sim.signal_rate = 0*self.sim.signal_rate
+        result = auto_expose(self.spec, start_us=1000, budget_s=0.5,
+                             max_shots=5)
+        self.assertFalse(result.converged)
+        self.assertTrue(result.shots <= 5)
+        self.assertTrue(result.elapsed_s < 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+''' Tests of STSManager running several spectrometers together.
+'''
+
+import unittest
+
+from OceanOptics import STS_Error
+from OceanOptics.sts_manager import STSManager
+from OceanOptics.sts_simulator import STSSimulator, simulated_bus
+
+
+def _fail_on(serial):
+    def method(spec):
+        if spec.get_serial() == serial:
+            raise STS_Error('Failed on %s' % serial)
+        return True
+    return method
+
+
+class ManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sims = [STSSimulator('S00001', seed=1),
+                     STSSimulator('S00002', seed=2)]
+        self.manager = STSManager(find=simulated_bus(self.sims))
+
+    def tearDown(self):
+        self.manager.close()
+
+    def test_devices_are_found_by_serial(self):
+        self.assertEqual(self.manager.serials, ['S00001', 'S00002'])
+        self.assertEqual(sorted(self.manager.devices), ['S00001', 'S00002'])
+
+    def test_acquire_takes_a_spectrum_from_every_device(self):
+        self.manager.call('set_integration_time', 2000)
+        first = self.manager.acquire()
+        second = self.manager.acquire(raw=True)
+        self.assertEqual((first.sequence, second.sequence), (0, 1))
+        self.assertEqual(sorted(first.frames), ['S00001', 'S00002'])
+        for frame in first.frames.values():
+            self.assertEqual(frame.sequence, 0)
+            self.assertEqual(len(frame.spectrum), 1024)
+            self.assertTrue(frame.timestamp >= first.timestamp)
+        self.assertEqual(self.sims[0].integration_time_us, 2000)
+        self.assertEqual(self.sims[1].integration_time_us, 2000)
+
+    def test_error_is_raised_once_all_devices_finish(self):
+        self.assertRaises(STS_Error, self.manager.call, _fail_on('S00002'))
+        self.assertEqual(self.manager.call(_fail_on('S00003')),
+                         {'S00001': True, 'S00002': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+''' Tests of the acquisition planner.
+'''
+
+import unittest
+
+from OceanOptics.sts_planner import (MAX_SCANS_TO_AVG, plan_acquisition,
+                                     run_plan)
+
+from simulated import SimulatorTestCase
+
+
+class PlannerTest(unittest.TestCase):
+
+    def test_total_exposure_is_met_with_the_longest_scans(self):
+        plan = plan_acquisition(total_exposure_s=2.0, peak_rate=10000.0)
+        self.assertTrue(plan.total_exposure_s >= 2.0)
+        self.assertTrue(plan.peak_counts <= 0.9*16383)
+        self.assertEqual(plan.repeats, 1)
+
+    def test_snr_goal_is_met(self):
+        plan = plan_acquisition(snr=500.0, peak_rate=20000.0)
+        self.assertTrue(plan.expected_snr >= 500.0)
+
+    def test_scans_beyond_the_device_limit_are_repeated(self):
+        plan = plan_acquisition(total_exposure_s=1.0, peak_rate=1e8)
+        self.assertTrue(plan.scans_to_avg <= MAX_SCANS_TO_AVG)
+        self.assertTrue(plan.repeats > 1)
+        self.assertTrue(plan.total_exposure_s >= 1.0)
+
+    def test_bad_goals_raise_value_error(self):
+        for arguments in ({}, {'total_exposure_s': 0},
+                          {'total_exposure_s': -1.0},
+                          {'snr': 0, 'peak_rate': 1000.0},
+                          {'snr': 100.0},
+                          {'total_exposure_s': 1.0, 'peak_rate': -5.0},
+                          {'total_exposure_s': 1.0, 'peak_rate': 1e12}):
+            self.assertRaises(ValueError, plan_acquisition, **arguments)
+
+
+class RunPlanTest(SimulatorTestCase):
+
+    def test_plan_is_applied(self):
+        plan = plan_acquisition(total_exposure_s=0.02, peak_rate=10000.0)
+        spectrum = run_plan(self.spec, plan)
+        self.assertEqual(len(spectrum), 1024)
+        self.assertEqual(self.spec.get_integration_time(),
+                         plan.integration_time_us)
+        self.assertEqual(self.spec.get_active_scans_to_avg(),
+                         plan.scans_to_avg)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+''' Tests of the settings sent to the device and the copy the driver keeps.
+'''
+
+import unittest
+
+from simulated import SimulatorTestCase
+
+
+class SettingsTest(SimulatorTestCase):
+
+    integration_us = None
+
+    def test_integration_time_is_rounded(self):
+        stats = self.spec.enable_stats()
+        self.spec.set_integration_time(0.21/1000*1e6)  # 209.99999999999997
+        self.assertEqual(self.sim.integration_time_us, 210)
+        self.assertEqual(self.spec.get_integration_time(), 210)
+        self.spec.set_integration_time(210)
+        self.assertEqual(stats[0x00110010].count, 1)
+
+    def test_trigger_delay_is_rounded(self):
+        self.spec.set_trigger_delay(0.21/1000*1e6)
+        self.assertEqual(self.sim.trigger_delay_us, 210)
+
+
+if __name__ == '__main__':
+    unittest.main()
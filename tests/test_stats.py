@@ -0,0 +1,64 @@
+''' Tests of the transaction hooks and the stats kept by TransactionStats.
+'''
+
+import unittest
+
+from OceanOptics import STS_DeviceError
+
+from simulated import SimulatorTestCase
+
+SERIAL = 0x00000100
+TEMPERATURES = 0x00400002
+
+
+class StatsTest(SimulatorTestCase):
+
+    integration_us = None
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.stats = self.spec.enable_stats()
+
+    def test_transactions_are_counted_by_message_type(self):
+        self.spec.get_serial()
+        self.spec.get_serial()
+        self.spec.read_all_temperature()
+        self.assertEqual(self.stats[SERIAL].count, 2)
+        self.assertEqual(self.stats[SERIAL].bytes_out, 2*64)
+        self.assertEqual(self.stats[SERIAL].packets, 2)
+        self.assertEqual(self.stats[TEMPERATURES].count, 1)
+        self.assertEqual(sum(self.stats[TEMPERATURES].histogram), 1)
+        self.assertTrue(self.stats[SERIAL].min_s <= self.stats[SERIAL].max_s)
+        self.assertIn('serial', self.stats.report())
+
+    def test_nack_error_code_is_counted(self):
+        self.sim.hot_pixels = []
+        self.assertRaises(STS_DeviceError, self.spec.get_hot_pixel_index)
+        stats = self.stats[0x00186000]
+        self.assertEqual((stats.count, stats.failures, stats.nacks), (1, 1, 1))
+        self.assertEqual(dict(stats.error_codes), {12: 1})
+        self.assertIn('12 x 1', self.stats.report())
+
+    def test_lost_reply_counts_as_reading(self):
+        self.spec.timeouts = {TEMPERATURES: 50}
+        self.sim.lost_replies = 1
+        self.spec.read_all_temperature()
+        stats = self.stats[TEMPERATURES]
+        self.assertEqual(stats.retries, 1)
+        self.assertTrue(stats.mean_s >= 0.05)
+        self.assertTrue(stats.write_s < 0.01)
+
+    def test_hooks_can_be_removed(self):
+        seen = []
+        self.spec.add_transaction_hook(seen.append)
+        self.spec.get_serial()
+        self.spec.remove_transaction_hook(seen.append)
+        self.spec.disable_stats()
+        self.spec.get_serial()
+        self.assertEqual([transaction.command for transaction in seen],
+                         [SERIAL])
+        self.assertEqual(self.stats[SERIAL].count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
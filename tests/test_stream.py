@@ -0,0 +1,41 @@
+''' Tests of continuous acquisition into a ring buffer.
+'''
+
+import time
+import unittest
+
+from OceanOptics.sts_stream import SpectrumStream
+
+from simulated import SimulatorTestCase
+
+
+class StreamTest(SimulatorTestCase):
+
+    def test_room_made_during_an_acquisition_is_used(self):
+        self.spec.set_integration_time(50000)
+        stream = SpectrumStream(self.spec, capacity=4)
+        stream.start()
+        while stream.acquired < 4:
+            time.sleep(0.001)
+        self.assertEqual(stream.get().sequence, 0)  # While taking the 5th
+        while stream.acquired < 5:
+            time.sleep(0.001)
+        dropped = stream.dropped
+        stream.stop()
+        self.assertEqual(dropped, 0)
+
+    def test_full_buffer_keeps_the_newest(self):
+        stream = SpectrumStream(self.spec, capacity=4)
+        stream.start()
+        while stream.acquired < 10:
+            time.sleep(0.005)
+        stream.stop()
+        self.assertEqual(len(stream), 4)
+        self.assertEqual(stream.dropped, stream.acquired - 4)
+        sequence = [frame.sequence for frame in stream]
+        self.assertEqual(sequence, list(range(stream.acquired - 4,
+                                              stream.acquired)))
+
+
+if __name__ == '__main__':
+    unittest.main()
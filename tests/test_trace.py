@@ -0,0 +1,71 @@
+''' Tests of the Chrome trace events written by Tracer.
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from OceanOptics.sts_trace import Tracer
+
+from simulated import SimulatorTestCase
+
+EVENT_KEYS = set(['name', 'cat', 'ph', 'ts', 'dur', 'pid', 'tid'])
+
+
+class TraceTest(SimulatorTestCase):
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'trace.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_trace_file_follows_the_trace_event_format(self):
+        with Tracer([self.spec], self.path):
+            self.spec.get_corrected_spectrum()
+        with open(self.path) as f:
+            trace = json.load(f)
+        self.assertEqual(trace['displayTimeUnit'], 'ms')
+        events = trace['traceEvents']
+        names = [event for event in events if event['ph'] == 'M']
+        spans = [event for event in events if event['ph'] == 'X']
+        self.assertEqual(len(names), 1)
+        self.assertEqual(names[0]['name'], 'thread_name')
+        for span in spans:
+            self.assertTrue(EVENT_KEYS <= set(span), span)
+            self.assertTrue(span['dur'] >= 0 and span['ts'] >= 0)
+        by_name = dict((span['name'], span) for span in spans)
+        spectrum = by_name['corrected spectrum']
+        self.assertEqual(spectrum['cat'], 'usb')
+        self.assertEqual(spectrum['args']['command'], '0x00101000')
+        self.assertIn('decode', by_name)
+        self.assertIn('write', by_name)
+        self.assertIn('read', by_name)
+
+    def test_lost_reply_is_traced_as_reading(self):
+        self.spec.timeouts = {0x00000100: 50}
+        self.sim.lost_replies = 1
+        tracer = Tracer([self.spec])
+        with tracer:
+            self.spec.get_serial()
+        spans = dict((event['name'], event) for event in tracer.events)
+        self.assertEqual(spans['serial']['args']['retries'], 1)
+        self.assertTrue(spans['write']['dur'] < 10e3)
+        self.assertTrue(spans['read']['dur'] >= 50e3)
+
+    def test_nothing_is_recorded_once_stopped(self):
+        tracer = Tracer([self.spec])
+        with tracer:
+            self.spec.get_serial()
+        count = len(tracer.events)
+        self.spec.get_serial()
+        self.assertEqual(len(tracer.events), count)
+        self.assertEqual(self.spec._hooks, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+''' Tests of how the driver recovers from faults of the USB link: lost
+    replies, damaged footers and stale bytes, injected by the simulator.
+'''
+
+import time
+import unittest
+
+from OceanOptics import STS_DeviceError, STS_ProtocolError, STS_TimeoutError
+
+from simulated import SimulatorTestCase
+
+SERIAL = 0x00000100
+
+
+class TransportTest(SimulatorTestCase):
+
+    integration_us = None
+
+    def setUp(self):
+        SimulatorTestCase.setUp(self)
+        self.spec.timeouts = {SERIAL: 50, 0x00182001: 50, 0x00110120: 50}
+        self.stats = self.spec.enable_stats()
+
+    def test_lost_reply_is_sent_again(self):
+        self.sim.lost_replies = 1
+        self.assertEqual(self.spec.get_serial(), 'S05123')
+        self.assertEqual(self.stats[SERIAL].retries, 1)
+        self.assertEqual(self.stats[SERIAL].failures, 0)
+
+    def test_retries_are_bounded_with_backoff(self):
+        self.spec.retry_backoff_s = 0.05
+        self.sim.lost_replies = 3
+        started = time.time()
+        self.assertRaises(STS_TimeoutError, self.spec.get_serial)
+        self.assertTrue(time.time() - started >= 0.05 + 0.1)
+        self.assertEqual(self.stats[SERIAL].retries, 2)
+        self.assertEqual(self.stats[SERIAL].failures, 1)
+        self.assertEqual(self.spec.get_serial(), 'S05123')
+
+    def test_damaged_footer_is_sent_again(self):
+        self.sim.corrupted_replies = 1
+        self.assertEqual(self.spec.get_serial(), 'S05123')
+        self.assertEqual(self.stats[SERIAL].retries, 1)
+
+    def test_damaged_footers_raise_protocol_error(self):
+        self.sim.corrupted_replies = 3
+        self.assertRaises(STS_ProtocolError, self.spec.get_serial)
+
+    def test_stale_bytes_are_skipped_to_the_header(self):
+        self.sim.inject_stale_data(1, 64)
+        self.assertEqual(self.spec.get_serial(), 'S05123')
+        self.assertEqual(self.stats[SERIAL].retries, 1)
+
+    def test_reply_to_another_message_is_skipped(self):
+        with self.spec._line_lock(1):
+            self.spec._write_request(0x00400002, 1)  # Reply never read
+        self.assertEqual(self.spec.get_serial(), 'S05123')
+        self.assertEqual(self.stats[SERIAL].retries, 1)
+
+    def test_trigger_pulse_is_not_sent_again(self):
+        self.sim.lost_replies = 1
+        self.assertRaises(STS_TimeoutError, self.spec.simulate_trigger_pulse)
+        self.assertEqual(self.stats[0x00110120].retries, 0)
+
+    def test_triggered_spectrum_is_not_requested_again(self):
+        self.spec.set_integration_time(1000)
+        self.spec.set_trigger_mode(1)
+        self.spec.trigger_timeout_ms = 50
+        self.assertRaises(STS_TimeoutError, self.spec.get_corrected_spectrum)
+        self.assertEqual(self.stats[0x00101000].retries, 0)
+        self.assertEqual(len(self.sim._waiting_trigger), 1)
+
+    def test_nack_raises_device_error(self):
+        self.sim.hot_pixels = []
+        with self.assertRaises(STS_DeviceError) as raised:
+            self.spec.get_hot_pixel_index()
+        self.assertEqual(raised.exception.code, 12)
+        self.assertEqual(raised.exception.command, 0x00186000)
+        self.assertEqual(self.stats[0x00186000].retries, 0)
+
+    def test_lost_calibration_is_not_taken_as_missing(self):
+        self.sim.lost_replies = 3
+        self.assertRaises(STS_TimeoutError, self.spec.get_irrad_calib)
+
+
+if __name__ == '__main__':
+    unittest.main()